@@ -30,6 +30,7 @@ setup(
                 'usergrid_iterator = usergrid_tools.iterators.simple_iterator:main',
                 'usergrid_data_migrator = usergrid_tools.migration.usergrid_data_migrator:main',
                 'usergrid_data_exporter = usergrid_tools.migration.usergrid_data_exporter:main',
+                'usergrid_data_importer = usergrid_tools.migration.usergrid_data_importer:main',
                 'usergrid_entity_index_test = usergrid_tools.indexing.entity_index_test:main',
                 'usergrid_batch_index_test = usergrid_tools.indexing.batch_index_test:main',
                 'usergrid_parse_importer = usergrid_tools.parse_importer.parse_importer:main',
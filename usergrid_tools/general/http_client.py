@@ -0,0 +1,271 @@
+import logging
+import socket
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('HttpClient')
+
+try:
+    from hyper.contrib import HTTP20Adapter
+
+    HTTP2_AVAILABLE = True
+
+except ImportError:
+    HTTP20Adapter = None
+    HTTP2_AVAILABLE = False
+
+# the settings get_session() uses, changed with configure_http_client()
+http_settings = {
+    'pool_size': 10,
+    'pool_hosts': 10,
+    'keep_alive': True,
+    'tcp_nodelay': True,
+    'connect_timeout': 10.0,
+    'read_timeout': 120.0,
+    'http2': False
+}
+
+
+def get_socket_options(keep_alive=True, tcp_nodelay=True):
+    """
+    :return: the socket options for new connections: Nagle is disabled so that small requests are not held back
+    waiting for the ACK of the previous one, and TCP keep-alive probes stop idle pooled connections from being dropped
+    silently by NAT and load balancers
+    """
+    options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if tcp_nodelay else 0)]
+
+    if keep_alive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+
+        # the probe timings are only settable on Linux
+        for name, value in [('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 15), ('TCP_KEEPCNT', 4)]:
+            if hasattr(socket, name):
+                options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+
+    return options
+
+
+class ConnectCountingPool(object):
+    """
+    Counts the TCP connections a connection pool opens.  urllib3 counts the connection objects it creates, but an object
+    whose socket was closed by the server reconnects without a new one being created, so that count misses the
+    reconnects which keep-alive tuning is meant to avoid.
+    """
+
+    num_connects = 0
+
+    def _new_conn(self):
+        conn = super(ConnectCountingPool, self)._new_conn()
+        connect = conn.connect
+
+        def counting_connect():
+            self.num_connects += 1
+            return connect()
+
+        conn.connect = counting_connect
+        return conn
+
+
+class CountingHTTPConnectionPool(ConnectCountingPool, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(ConnectCountingPool, HTTPSConnectionPool):
+    pass
+
+
+class HttpClientAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter with the socket options, default timeouts and pool sizes of the http client settings.  Requests
+    sent without a timeout get the default (connect, read) timeout so that a dead connection cannot hang a worker.
+    """
+
+    def __init__(self, socket_options=None, timeout=None, *args, **kwargs):
+        """
+        :param socket_options: The socket options of new connections, see get_socket_options()
+        :param timeout: The (connect, read) timeout of requests which do not specify one
+        """
+        self.socket_options = socket_options
+        self.timeout = timeout
+        super(HttpClientAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+
+        super(HttpClientAdapter, self).init_poolmanager(*args, **kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool
+        }
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return super(HttpClientAdapter, self).send(request, **kwargs)
+
+
+def configure_http_client(pool_size=10, pool_hosts=10, keep_alive=True, tcp_nodelay=True, connect_timeout=10.0,
+                          read_timeout=120.0, http2=False):
+    """
+    Sets the http client settings of the process, used by sessions created afterwards.
+
+    :param pool_size: The max number of connections kept open to each host
+    :param pool_hosts: The max number of hosts connections are kept open to
+    :param keep_alive: Whether connections are kept open between requests
+    :param tcp_nodelay: Whether Nagle's algorithm is disabled on new connections
+    :param connect_timeout: The number of seconds to wait for a connection
+    :param read_timeout: The number of seconds to wait for the server between bytes of the response
+    :param http2: Whether HTTPS requests use HTTP/2, which requires the hyper package
+    """
+    if http2 and not HTTP2_AVAILABLE:
+        raise ValueError('HTTP/2 requires the hyper package (pip install hyper)')
+
+    http_settings.update({
+        'pool_size': pool_size,
+        'pool_hosts': pool_hosts,
+        'keep_alive': keep_alive,
+        'tcp_nodelay': tcp_nodelay,
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'http2': http2
+    })
+
+
+def get_session(adapter_class=HttpClientAdapter, pool_size=None, **adapter_kwargs):
+    """
+    :param adapter_class: The HttpClientAdapter class to mount, for adapters which add to it such as rate control
+    :param pool_size: The max number of connections kept open to each host, if not the configured size
+    :param adapter_kwargs: Any other arguments of the adapter class
+    :return: a requests Session using the http client settings
+    :raises ValueError: if HTTP/2 is configured with an adapter class which adds to HttpClientAdapter, since HTTPS
+    requests would bypass it
+    """
+    if http_settings['http2'] and adapter_class is not HttpClientAdapter:
+        raise ValueError('HTTP/2 cannot be used with [%s], which HTTPS requests would bypass' % adapter_class.__name__)
+
+    session = requests.Session()
+
+    adapter = adapter_class(socket_options=get_socket_options(http_settings['keep_alive'],
+                                                              http_settings['tcp_nodelay']),
+                            timeout=(http_settings['connect_timeout'], http_settings['read_timeout']),
+                            pool_connections=http_settings['pool_hosts'],
+                            pool_maxsize=pool_size if pool_size is not None else http_settings['pool_size'],
+                            **adapter_kwargs)
+
+    session.mount('http://', adapter)
+
+    if http_settings['http2']:
+        # hyper multiplexes the requests to a host over one connection, so the pool size does not apply
+        session.mount('https://', HTTP20Adapter())
+    else:
+        session.mount('https://', adapter)
+
+    if not http_settings['keep_alive']:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def get_connection_stats(session):
+    """
+    :return: a dict of host -> the number of requests sent and connections opened to it, for the pools of the session
+    which are still open
+    """
+    stats = {}
+
+    for adapter in set(session.adapters.values()):
+        pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+
+        if pools is None:
+            continue
+
+        for key in pools.keys():
+            pool = pools.get(key)
+
+            if pool is None:
+                continue
+
+            host_stats = stats.setdefault('%s://%s:%s' % (pool.scheme, pool.host, pool.port),
+                                          {'requests': 0, 'connections': 0})
+
+            host_stats['requests'] += pool.num_requests
+            host_stats['connections'] += getattr(pool, 'num_connects', pool.num_connections)
+
+    for host_stats in stats.itervalues():
+        requests_sent = host_stats['requests']
+        host_stats['reuse_ratio'] = round(max(0.0, 1 - float(host_stats['connections']) / requests_sent), 4) \
+            if requests_sent > 0 else 0.0
+
+    return stats
+
+
+def log_connection_stats(label, session, log=None):
+    """
+    Logs how many connections were opened for the requests sent to each host, where a reuse ratio well below 1
+    points to a pool which is too small for the number of threads using it.
+    """
+    log = log if log is not None else logger
+
+    for host, host_stats in sorted(get_connection_stats(session).iteritems()):
+        log.info('Connections [%s] to [%s]: requests=[%s] connections=[%s] reuse_ratio=[%s]' % (
+            label, host, host_stats['requests'], host_stats['connections'], host_stats['reuse_ratio']))
+
+
+def add_http_arguments(parser):
+    """
+    Adds the arguments of configure_http_client() to an argparse parser, for the scripts which use get_session().
+    """
+    parser.add_argument('--http_pool_size',
+                        help='The max number of connections kept open to each host',
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--http_pool_hosts',
+                        help='The max number of hosts connections are kept open to',
+                        type=int,
+                        default=10)
+
+    parser.add_argument('--no_keep_alive',
+                        help='Close the connection after every request instead of keeping it open',
+                        dest='no_keep_alive',
+                        action='store_true')
+
+    parser.add_argument('--no_tcp_nodelay',
+                        help='Leave Nagle\'s algorithm enabled on connections',
+                        dest='no_tcp_nodelay',
+                        action='store_true')
+
+    parser.add_argument('--connect_timeout',
+                        help='The number of seconds to wait for a connection to a host',
+                        type=float,
+                        default=10.0)
+
+    parser.add_argument('--read_timeout',
+                        help='The number of seconds to wait for a response from a host',
+                        type=float,
+                        default=120.0)
+
+    parser.add_argument('--http2',
+                        help='Use HTTP/2 for HTTPS requests, which requires the hyper package.  The connection pool '
+                             'settings, timeouts and connection stats do not apply to HTTP/2 requests',
+                        action='store_true')
+
+
+def configure_http_client_from_args(config):
+    """
+    Applies the arguments added by add_http_arguments() from the parsed config dict.
+    """
+    configure_http_client(pool_size=config.get('http_pool_size'),
+                          pool_hosts=config.get('http_pool_hosts'),
+                          keep_alive=not config.get('no_keep_alive', False),
+                          tcp_nodelay=not config.get('no_tcp_nodelay', False),
+                          connect_timeout=config.get('connect_timeout'),
+                          read_timeout=config.get('read_timeout'),
+                          http2=config.get('http2', False))
@@ -0,0 +1,195 @@
+import logging
+import random
+import socket
+import threading
+import time
+
+import requests
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('Retry')
+
+# responses which indicate the request may succeed if it is sent again later
+RETRYABLE_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+# exceptions which indicate the request did not reach the server or the response was lost
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError,
+                        socket.error)
+
+# exceptions which will fail the same way every time
+NON_RETRYABLE_EXCEPTIONS = (requests.exceptions.URLRequired,
+                            requests.exceptions.MissingSchema,
+                            requests.exceptions.InvalidSchema,
+                            requests.exceptions.InvalidURL,
+                            requests.exceptions.TooManyRedirects)
+
+
+def is_retryable_status(status_code):
+    return status_code in RETRYABLE_STATUS_CODES
+
+
+def is_retryable_exception(e):
+    if isinstance(e, NON_RETRYABLE_EXCEPTIONS):
+        return False
+
+    return isinstance(e, RETRYABLE_EXCEPTIONS)
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a fraction of the requests made by this process, so that when a service is down the workers
+    stop retrying instead of multiplying the load on it.  Every request adds `ratio` tokens and every retry takes one;
+    a trickle of `min_per_second` tokens is always added so that a process which only makes a few requests can still
+    retry them.
+
+    The budget is kept in the process and is not shared, each worker process gets its own after the fork.
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=1.0, max_tokens=100.0):
+        """
+        :param ratio: The number of retries allowed per request made
+        :param min_per_second: The number of retries allowed per second regardless of the number of requests
+        :param max_tokens: The max number of retries which can be saved up
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.last_refill = time.time()
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.last_refill) * self.min_per_second)
+        self.last_refill = now
+
+    def record_request(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            self.refill()
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+
+            self.exhausted += 1
+            return False
+
+
+class RetryPolicy(object):
+    """
+    Capped exponential backoff with full jitter: the wait before retry n is a random time between 0 and
+    min(max_delay, base_delay * 2 ^ (n - 1)), so that workers which failed at the same moment do not retry at the
+    same moment.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=30.0, budget=None):
+        """
+        :param max_attempts: The max number of attempts, including the first
+        :param base_delay: The cap on the wait, in seconds, before the first retry
+        :param max_delay: The cap on the wait, in seconds, before any retry
+        :param budget: The RetryBudget to take retries from, a new one is created if not specified
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def get_delay(self, attempts):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempts - 1))))
+
+    def next_attempt(self, attempts):
+        """
+        Counts an attempt of a request which is retried by a loop of the caller rather than by request(), so that its
+        first attempt adds to the retry budget the same as a request sent by request() does.
+
+        :param attempts: The number of attempts made so far
+        :return: The number of the attempt about to be made
+        """
+        if attempts == 0:
+            self.budget.record_request()
+
+        return attempts + 1
+
+    def should_retry(self, attempts):
+        """
+        :param attempts: The number of attempts made so far
+        :return: True if another attempt is allowed by both the max attempts and the retry budget
+        """
+        if attempts >= self.max_attempts:
+            return False
+
+        if not self.budget.withdraw():
+            logger.warning('Retry budget exhausted, not retrying after [%s] attempts' % attempts)
+            return False
+
+        return True
+
+    def wait(self, attempts):
+        delay = self.get_delay(attempts)
+
+        logger.debug('Waiting [%.2f]s before attempt [%s]' % (delay, attempts + 1))
+
+        time.sleep(delay)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request, retrying connection errors and retryable responses.  Returns the last response when the
+        attempts run out, and raises exceptions which are not retryable or which happen on the last attempt.
+
+        :param method: A function which sends the request, such as session.get
+        :param url: The URL
+        :param kwargs: Passed to the method
+        """
+        attempts = 0
+
+        while True:
+            attempts = self.next_attempt(attempts)
+
+            try:
+                r = method(url, **kwargs)
+
+            except Exception, e:
+                if not is_retryable_exception(e) or not self.should_retry(attempts):
+                    raise
+
+                logger.warning('Attempt [%s] failed on URL=[%s]: %s' % (attempts, url, e))
+
+                self.wait(attempts)
+                continue
+
+            if not is_retryable_status(r.status_code) or not self.should_retry(attempts):
+                return r
+
+            logger.warning('Attempt [%s] received HTTP [%s] on URL=[%s]' % (attempts, r.status_code, url))
+
+            self.wait(attempts)
+
+
+retry_policy = RetryPolicy()
+
+
+def get_retry_policy():
+    return retry_policy
+
+
+def configure_retry_policy(max_attempts=5, base_delay=0.5, max_delay=30.0, budget_ratio=0.2):
+    """
+    Replaces the default policy used by the tools, from command line arguments.  Must be called before the worker
+    processes are started.
+    """
+    global retry_policy
+
+    retry_policy = RetryPolicy(max_attempts=max_attempts,
+                               base_delay=base_delay,
+                               max_delay=max_delay,
+                               budget=RetryBudget(ratio=budget_ratio))
+
+    return retry_policy
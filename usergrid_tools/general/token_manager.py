@@ -0,0 +1,235 @@
+import json
+import logging
+import time
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+from requests.auth import AuthBase
+
+from usergrid_tools.general.http_client import get_session
+from usergrid_tools.general.retry import get_retry_policy
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('TokenManager')
+
+token_url_template = '{api_url}/management/token'
+
+# the max length of an access token, Usergrid tokens are around 100 characters
+MAX_TOKEN_LENGTH = 2048
+
+
+class SharedToken(object):
+    """
+    The access token of one set of credentials, held in shared memory so that a token obtained by one worker process
+    is used by all of them.
+    """
+
+    def __init__(self, endpoint, username=None, password=None):
+        """
+        :param endpoint: The endpoint config with the api_url, client_id and client_secret to get the token with
+        :param username: The admin or superuser to get the token for with the password grant instead
+        :param password: The password of the user
+        """
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.token = RawArray('c', MAX_TOKEN_LENGTH)
+        self.expires_at = RawValue('d', 0)
+
+        # no token is requested before this time after a failure, so that every request does not wait for one
+        self.retry_at = RawValue('d', 0)
+        self.lock = Lock()
+
+
+class TokenManager(object):
+    """
+    Gets access tokens for the client credentials of the source and target endpoints with the client_credentials grant,
+    or for an admin user with the password grant, and refreshes them before they expire.  The credentials are
+    registered before the worker processes are forked so that the tokens are shared by all of the processes and only
+    one process requests a new token when it is needed.
+    """
+
+    def __init__(self, refresh_margin=0.1, failure_delay=30):
+        """
+        :param refresh_margin: The fraction of the lifetime of a token left when it is refreshed
+        :param failure_delay: The number of seconds to wait before requesting a token again after a failure
+        """
+        self.refresh_margin = refresh_margin
+        self.failure_delay = failure_delay
+        self.tokens = {}
+        self.session = None
+
+    def reset_session(self):
+        """
+        Drops the session the tokens are requested with, so that a worker process forked after a token was requested
+        opens its own connections instead of sharing the pooled sockets of the parent.
+        """
+        self.session = None
+
+    def register(self, name, endpoint, username=None, password=None):
+        self.tokens[name] = SharedToken(endpoint, username, password)
+
+    def get_token(self, name):
+        """
+        :return: the access token for the credentials registered as `name`, or None if one cannot be obtained
+        """
+        shared_token = self.tokens[name]
+        now = time.time()
+
+        if shared_token.expires_at.value > now:
+            return shared_token.token.value
+
+        if shared_token.retry_at.value > now:
+            return None
+
+        with shared_token.lock:
+            # another process may have refreshed the token while this one waited for the lock
+            if shared_token.expires_at.value > time.time():
+                return shared_token.token.value
+
+            if shared_token.retry_at.value > time.time():
+                return None
+
+            return self.request_token(name, shared_token)
+
+    def request_token(self, name, shared_token):
+        endpoint = shared_token.endpoint
+        token_url = token_url_template.format(**endpoint)
+
+        if shared_token.username is not None:
+            token_request = {
+                'grant_type': 'password',
+                'username': shared_token.username,
+                'password': shared_token.password
+            }
+        else:
+            token_request = {
+                'grant_type': 'client_credentials',
+                'client_id': endpoint.get('client_id'),
+                'client_secret': endpoint.get('client_secret')
+            }
+
+        # created lazily, and again after reset_session(), and without the BearerAuth it is getting a token for
+        if self.session is None:
+            self.session = get_session()
+
+        try:
+            r = get_retry_policy().request(self.session.post, token_url, data=json.dumps(token_request))
+
+            if r.status_code != 200:
+                raise ValueError('HTTP [%s]: %s' % (r.status_code, r.text))
+
+            response = r.json()
+            token = str(response['access_token'])
+            expires_in = float(response.get('expires_in', 3600))
+
+        except Exception:
+            logger.exception('Unable to get an access token [%s] from URL [%s], sending the credentials instead for '
+                             '[%s]s' % (name, token_url, self.failure_delay))
+
+            shared_token.retry_at.value = time.time() + self.failure_delay
+            return None
+
+        if len(token) >= MAX_TOKEN_LENGTH:
+            logger.error('Access token [%s] of [%s] characters is too long to share, sending the credentials '
+                         'instead' % (name, len(token)))
+
+            shared_token.retry_at.value = time.time() + expires_in
+            return None
+
+        shared_token.token.value = token
+        shared_token.expires_at.value = time.time() + expires_in * (1 - self.refresh_margin)
+
+        logger.info('Got access token [%s] from URL [%s] which expires in [%s]s' % (name, token_url, expires_in))
+
+        return token
+
+    def invalidate(self, name, token):
+        """
+        Marks the token as expired if it is still the current one, after the server rejected it.
+        """
+        shared_token = self.tokens[name]
+
+        with shared_token.lock:
+            if shared_token.token.value == token:
+                shared_token.expires_at.value = 0
+
+    def get_credentials(self, name):
+        endpoint = self.tokens[name].endpoint
+
+        return {
+            'client_id': endpoint.get('client_id'),
+            'client_secret': endpoint.get('client_secret')
+        }
+
+
+class BearerAuth(AuthBase):
+    """
+    Sends the access token of a TokenManager in the Authorization header.  A request rejected with a 401 is sent once
+    more with a new token, and if no token can be obtained the credentials are sent instead: with the fallback auth if
+    there is one, otherwise as the client credentials in the URL.
+    """
+
+    def __init__(self, token_manager, name, fallback_auth=None):
+        """
+        :param token_manager: The TokenManager which holds the token
+        :param name: The name the credentials were registered with
+        :param fallback_auth: The requests auth to use when there is no token, such as HTTPBasicAuth for a user
+        """
+        self.token_manager = token_manager
+        self.name = name
+        self.fallback_auth = fallback_auth
+
+    def add_credentials(self, r):
+        r.headers.pop('Authorization', None)
+
+        if self.fallback_auth is not None:
+            return self.fallback_auth(r)
+
+        r.prepare_url(r.url, self.token_manager.get_credentials(self.name))
+        return r
+
+    def __call__(self, r):
+        token = self.token_manager.get_token(self.name)
+
+        if token is None:
+            return self.add_credentials(r)
+        else:
+            r.headers['Authorization'] = 'Bearer %s' % token
+            r.register_hook('response', self.get_retry_hook(token))
+
+        return r
+
+    def get_retry_hook(self, token):
+        def retry_unauthorized(response, **kwargs):
+            if response.status_code != 401:
+                return response
+
+            logger.warning('Access token [%s] was rejected at URL [%s], getting a new one' % (
+                self.name, response.request.url))
+
+            self.token_manager.invalidate(self.name, token)
+
+            # the connection has to be released before the same request is sent again
+            response.content
+            response.close()
+
+            retry = response.request.copy()
+            retry.hooks = dict(retry.hooks, response=[hook for hook in retry.hooks['response']
+                                                      if getattr(hook, '__name__', None) != 'retry_unauthorized'])
+
+            new_token = self.token_manager.get_token(self.name)
+
+            if new_token is None:
+                retry = self.add_credentials(retry)
+            else:
+                retry.headers['Authorization'] = 'Bearer %s' % new_token
+
+            retried = response.connection.send(retry, **kwargs)
+            retried.history.append(response)
+            retried.request = retry
+
+            return retried
+
+        return retry_unauthorized
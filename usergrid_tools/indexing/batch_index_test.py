@@ -10,6 +10,9 @@ from logging.handlers import RotatingFileHandler
 
 import sys
 
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats
+
 entity_template = {
     "id": "replaced",
     "dataType": "entitlements",
@@ -178,7 +181,8 @@ def test_cleared(q_url):
         if len(res.get('entities', [])) != 0:
             logger.info('DID NOT CLEAR')
 
-processes = Pool(32)
+# created in main() once the session has its token, since the processes take a copy of it when they are forked
+processes = None
 
 
 def test_url(q_url, sleep_time=0.25):
@@ -229,13 +233,18 @@ def parse_args():
                         type=str,
                         required=False)
 
+    add_http_arguments(parser)
+
     my_args = parser.parse_args(sys.argv[1:])
 
     return vars(my_args)
 
 
 def init():
-    global config
+    global config, session
+
+    configure_http_client_from_args(config)
+    session = get_session()
 
     url_data = {
         'api_url': config.get('base_url'),
@@ -249,9 +258,7 @@ def init():
 
 
 def main():
-    global config
-
-    # processes = Pool(32)
+    global config, processes
 
     config = parse_args()
 
@@ -275,6 +282,8 @@ def main():
             logger.critical('unable to get token: %s' % r.text)
             exit(1)
 
+    processes = Pool(32)
+
     try:
         created_map = test_multiple(999)
 
@@ -291,6 +300,8 @@ def main():
     except KeyboardInterrupt:
         processes.terminate()
 
+    log_connection_stats('target', session)
+
     processes.terminate()
 
 
@@ -10,6 +10,9 @@ from logging.handlers import RotatingFileHandler
 
 import sys
 
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats
+
 entity_template = {
     "id": "replaced",
     "dataType": "entitlements",
@@ -153,13 +156,18 @@ def parse_args():
                         type=str,
                         required=False)
 
+    add_http_arguments(parser)
+
     my_args = parser.parse_args(sys.argv[1:])
 
     return vars(my_args)
 
 
 def init():
-    global config
+    global config, session
+
+    configure_http_client_from_args(config)
+    session = get_session()
 
     url_data = {
         'api_url': config.get('base_url'),
@@ -289,5 +297,7 @@ def main():
 
         # processes.terminate()
 
+    log_connection_stats('target', session)
+
 
 main()
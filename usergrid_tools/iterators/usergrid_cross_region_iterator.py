@@ -10,12 +10,15 @@ import logging
 import sys
 from multiprocessing import Process, JoinableQueue
 import datetime
-import requests
 import traceback
 from logging.handlers import RotatingFileHandler
 import urllib3
 import urllib3.contrib.pyopenssl
 
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats
+from usergrid_tools.general.retry import get_retry_policy
+
 urllib3.disable_warnings()
 urllib3.contrib.pyopenssl.inject_into_urllib3()
 
@@ -143,6 +146,9 @@ class Worker(Process):
                 if empty_count > 30:
                     keep_going = False
 
+        for region_id, session in sorted(session_map.iteritems()):
+            log_connection_stats(region_id, session)
+
         logger.warning('WORKER DONE!')
 
 
@@ -212,17 +218,14 @@ def parse_args():
                         help='The file from which to load the configuration',
                         type=str)
 
+    add_http_arguments(parser)
+
     my_args = parser.parse_args(sys.argv[1:])
 
     return vars(my_args)
 
 
-def get_by_UUID(org, app, collection, entity, counter, attempts=0):
-    response = False
-
-    if attempts >= 10:
-        return False
-
+def get_by_UUID(org, app, collection, entity, counter):
     for region_id in config.get('get_region_ids', []):
         url_data = config.get('regions', {}).get(region_id)
 
@@ -237,34 +240,27 @@ def get_by_UUID(org, app, collection, entity, counter, attempts=0):
 
         session = session_map[region_id]
 
-        while not response:
-
-            try:
-                r = session.get(url)
+        try:
+            r = get_retry_policy().request(session.get, url)
 
-                if r.status_code != 200:
-                    logger.error('GET [%s] (%s): %s' % (r.status_code, r.elapsed, url))
-                    logger.warning('Sleeping for 5 on connection retry...')
+        except:
+            logger.error(traceback.format_exc())
+            logger.error('EXCEPTION on GET [...] (...): %s' % url)
+            return False
 
-                    return get_by_UUID(org, app, collection, entity, counter, attempts=attempts + 1)
+        if r.status_code != 200:
+            logger.error('GET [%s] (%s): %s' % (r.status_code, r.elapsed, url))
+            return False
 
-                else:
-                    logger.info('GET [%s] (%s): %s' % (r.status_code, r.elapsed, url))
-                    response = True
+        logger.info('GET [%s] (%s): %s' % (r.status_code, r.elapsed, url))
 
-                if counter % 10 == 0:
-                    logger.info('COUNTER=[%s] time=[%s] GET [%s]: %s' % (counter,
-                                                                         r.elapsed,
-                                                                         r.status_code,
-                                                                         url))
-            except:
-                logger.error(traceback.format_exc())
-                logger.error('EXCEPTION on GET [...] (...): %s' % url)
-                response = False
-                logger.warning('Sleeping for 5 on connection retry...')
-                time.sleep(5)
+        if counter % 10 == 0:
+            logger.info('COUNTER=[%s] time=[%s] GET [%s]: %s' % (counter,
+                                                                 r.elapsed,
+                                                                 r.status_code,
+                                                                 url))
 
-    return response
+    return True
 
 
 def init(args):
@@ -283,8 +279,10 @@ def init(args):
         except:
             print traceback.format_exc()
 
+    configure_http_client_from_args(args)
+
     for region_id, region_data in config.get('regions', {}).iteritems():
-        session_map[region_id] = requests.Session()
+        session_map[region_id] = get_session()
 
 
 def main():
@@ -318,7 +316,7 @@ def main():
 
     token_request['password'] = args.get('password')
 
-    r = requests.post(url, data=json.dumps(token_request))
+    r = session_map[management_region_id].post(url, data=json.dumps(token_request))
 
     if r.status_code != 200:
         logger.critical('did not get access token! response: %s' % r.json())
@@ -0,0 +1,128 @@
+import json
+import logging
+import time
+
+import requests
+
+from usergrid_tools.general.http_client import get_session
+from usergrid_tools.general.retry import get_retry_policy
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('UsergridPageIterator')
+
+
+class UsergridPage(object):
+    """
+    One page of a Usergrid query response.  The size of the response body is kept with the entities so that callers
+    can account for bytes without serializing the entities again.  The status code tells a page which ended the
+    iteration because the collection or connection was not found (404) from the last page of a complete one (200).
+    """
+
+    def __init__(self, url, entities, cursor, byte_count, status_code=200):
+        self.url = url
+        self.entities = entities
+        self.cursor = cursor
+        self.byte_count = byte_count
+        self.status_code = status_code
+
+    def get_range(self, field):
+        """
+        Returns the (min, max) of a numeric field such as 'created' or 'modified' over the entities of the page, in one
+        pass.  Returns (None, None) if no entity has a numeric value for the field.
+        """
+        min_value = None
+        max_value = None
+
+        for entity in self.entities:
+            value = entity.get(field)
+
+            if value is None:
+                continue
+
+            try:
+                value = long(value)
+
+            except (TypeError, ValueError):
+                continue
+
+            if min_value is None or value < min_value:
+                min_value = value
+
+            if max_value is None or value > max_value:
+                max_value = value
+
+        return min_value, max_value
+
+
+class UsergridPageIterator(object):
+    """
+    Iterates the pages of a Usergrid collection or connection query by following the cursor.  Unlike the SDK's
+    UsergridQueryIterator this yields whole pages, can start from a cursor and uses the session it is given.
+    """
+
+    def __init__(self, url, session=None, page_delay=0, cursor=None, retry_policy=None):
+        """
+        :param url: The query URL, without a cursor
+        :param session: The requests Session to use, a new one from get_session() if not specified
+        :param page_delay: The number of seconds to wait between pages
+        :param cursor: The cursor to start from, for resuming an iteration
+        :param retry_policy: The RetryPolicy for failed pages, the default policy of the process if not specified
+        """
+        self.url = url
+        self.session = session if session is not None else get_session()
+        self.page_delay = page_delay
+        self.cursor = cursor
+        self.retry_policy = retry_policy
+
+    def __iter__(self):
+        while True:
+            page = self.get_page(self.cursor)
+
+            yield page
+
+            self.cursor = page.cursor
+
+            if self.cursor is None:
+                break
+
+            if self.page_delay > 0:
+                time.sleep(self.page_delay)
+
+    def entities(self):
+        for page in self:
+            for entity in page.entities:
+                yield entity
+
+    def get_page_url(self, cursor):
+        if cursor is None:
+            return self.url
+
+        return '%s%scursor=%s' % (self.url, '&' if '?' in self.url else '?', cursor)
+
+    def get_page(self, cursor):
+        """
+        :return: the page at the cursor, or an empty page with no cursor and a status code of 404 if the URL was not
+        found
+        :raises IOError: when the page cannot be retrieved, including after any other 4xx response such as an expired
+        cursor (400) or a rejected token (401 / 403), so that an iteration is never cut short without an error
+        """
+        url = self.get_page_url(cursor)
+        retry_policy = self.retry_policy if self.retry_policy is not None else get_retry_policy()
+
+        try:
+            r = retry_policy.request(self.session.get, url)
+
+            if r.status_code == 200:
+                response = json.loads(r.content)
+
+                return UsergridPage(url, response.get('entities', []), response.get('cursor'), len(r.content))
+
+        except (requests.exceptions.RequestException, ValueError), e:
+            raise IOError('Unable to retrieve page from URL=[%s]: %s' % (url, e))
+
+        if r.status_code == 404:
+            logger.warning('Ending iteration after HTTP [%s] on URL=[%s]: %s' % (r.status_code, url, r.text))
+            return UsergridPage(url, [], None, 0, status_code=r.status_code)
+
+        raise IOError('Unable to retrieve page after HTTP [%s] from URL=[%s]: %s' % (r.status_code, url, r.text))
@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import math
+import struct
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('BloomFilter')
+
+
+def get_bloom_size(capacity, error_rate):
+    """
+    :return: the number of bits and the number of hash functions for a Bloom filter which holds `capacity` keys with a
+    false positive rate of `error_rate`
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+
+    return bits, hashes
+
+
+class SharedBloomFilter(object):
+    """
+    A Bloom filter whose bits are held in shared memory, so that a filter created before the worker processes are
+    forked is read and updated by all of them.  A key which was added is always found; a key which was not added is
+    found with a probability of `error_rate`, as long as no more than `capacity` keys are added.
+
+    Bits are set without a lock.  Two processes setting bits in the same byte at the same time can lose one of the
+    bits, which makes a key look as if it was never added - the same as two processes checking a key in Redis before
+    either has set it.
+    """
+
+    def __init__(self, capacity=10000000, error_rate=0.0001):
+        """
+        :param capacity: The number of keys the filter is sized for
+        :param error_rate: The false positive rate of the filter when it holds `capacity` keys
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count, self.hash_count = get_bloom_size(capacity, error_rate)
+
+        self.bits = RawArray('B', (self.bit_count + 7) // 8)
+
+        # the number of keys added by all processes, which may miss a few concurrent additions
+        self.added = RawValue('l', 0)
+        self.warned = False
+
+        logger.info('Created Bloom filter of [%s] bytes with [%s] hashes for [%s] keys at a false positive rate of [%s]'
+                    % (len(self.bits), self.hash_count, capacity, error_rate))
+
+    def get_indexes(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        # two independent hashes from one digest generate all of the indexes (Kirsch-Mitzenmacher)
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        bit_count = self.bit_count
+
+        return [(h1 + i * h2) % bit_count for i in xrange(self.hash_count)]
+
+    def __contains__(self, key):
+        bits = self.bits
+
+        for index in self.get_indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+
+        return True
+
+    def add(self, key):
+        """
+        :return: True if the key was already in the filter (or is a false positive), False if it was added
+        """
+        bits = self.bits
+        found = True
+
+        for index in self.get_indexes(key):
+            mask = 1 << (index & 7)
+            value = bits[index >> 3]
+
+            if not value & mask:
+                bits[index >> 3] = value | mask
+                found = False
+
+        if not found:
+            self.added.value += 1
+
+            if self.added.value > self.capacity and not self.warned:
+                self.warned = True
+                logger.warning('Bloom filter holds more than the [%s] keys it was sized for, the false positive rate is '
+                               'now above [%s]' % (self.capacity, self.error_rate))
+
+        return found
+
+    def __len__(self):
+        return self.added.value
@@ -0,0 +1,570 @@
+import json
+import os
+import struct
+import zlib
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+# zstd is only required for --codec zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# pyarrow is only required for --format parquet
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CODECS = ['none', 'gzip', 'zstd']
+
+FORMATS = ['json', 'parquet']
+
+FILE_EXTENSIONS = {
+    'none': 'txt',
+    'gzip': 'txt.gz',
+    'zstd': 'txt.zst'
+}
+
+PARQUET_COMPRESSION = {
+    'none': 'NONE',
+    'gzip': 'GZIP',
+    'zstd': 'ZSTD'
+}
+
+# the column of a parquet file which holds, as a JSON object, the fields of a record which are not in the schema
+EXTRA_COLUMN = '_extra'
+
+# the range of a parquet int64 column, larger ints are written to the extra column
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+DEFAULT_COMPRESSION_LEVELS = {
+    'gzip': 6,
+    'zstd': 3
+}
+
+# identifies the trailer at the end of a compressed export file, which holds the location of the index
+TRAILER_MAGIC = 'UGEXIDX1'
+
+# the trailer of a gzip file is an empty gzip member carrying the index location in an extra field (RFC 1952)
+GZIP_EXTRA_ID = 'UG'
+GZIP_MAX_EXTRA_PAYLOAD = 65535 - 4
+
+# the index and trailer of a zstd file are skippable frames, which zstd decoders ignore
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5A
+
+
+def get_export_filename(filename_base, file_number, codec):
+    return '%s-%s.%s' % (filename_base, file_number, FILE_EXTENSIONS[codec])
+
+
+def get_gzip_member(data, level, extra=None):
+    """
+    Builds one complete gzip member, so that each member can be decompressed on its own and the members of a file can
+    be concatenated
+    """
+    flags = 0
+    header_extra = ''
+
+    if extra is not None:
+        flags |= 0x04
+        header_extra = struct.pack('<H', len(extra) + 4) + GZIP_EXTRA_ID + struct.pack('<H', len(extra)) + extra
+
+    # magic, deflate, flags, mtime=0, xfl=0, os=unknown
+    header = '\x1f\x8b\x08' + chr(flags) + '\x00\x00\x00\x00\x00\xff' + header_extra
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+
+    return header + body + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+
+def get_zstd_skippable_frame(payload):
+    return struct.pack('<II', ZSTD_SKIPPABLE_MAGIC, len(payload)) + payload
+
+
+def get_trailer_payload(index_offset, index_length):
+    return TRAILER_MAGIC + struct.pack('<QQ', index_offset, index_length)
+
+
+EMPTY_GZIP_MEMBER_SIZE = len(get_gzip_member('', 1))
+
+TRAILER_SIZES = {
+    'gzip': len(get_gzip_member('', 1, get_trailer_payload(0, 0))),
+    'zstd': len(get_zstd_skippable_frame(get_trailer_payload(0, 0)))
+}
+
+
+class ExportWriter(object):
+    """
+    Writes the records of an export as JSON lines to a series of files, rotating to a new file after a number of
+    records.  Lines are buffered and written in chunks of `member_size` records.
+
+    With a compression codec each chunk is written as an independent gzip member or zstd frame, so the file is still a
+    valid gzip/zstd stream.  After the last chunk the file gets an index, with the offset, length, record count and
+    min/max created of each chunk, followed by a fixed size trailer with the location of the index.  A loader can
+    read the index with read_export_index() and then decompress only the chunks it needs with read_member().
+    """
+
+    def __init__(self, filename_base, codec='none', compression_level=None, records_per_file=10000,
+                 member_size=1000, buffer_size=1024 * 1024):
+        """
+        :param filename_base: The path and prefix of the files, the file number and extension are appended
+        :param codec: One of CODECS
+        :param compression_level: The compression level, the codec default if not specified
+        :param records_per_file: The number of records after which a new file is started
+        :param member_size: The number of records in each compressed member/frame
+        :param buffer_size: The size of the buffer of the underlying file
+        """
+        if codec not in CODECS:
+            raise ValueError('Unknown codec [%s], must be one of %s' % (codec, CODECS))
+
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError('The zstd codec requires zstandard (pip install zstandard)')
+
+        self.filename_base = filename_base
+        self.codec = codec
+        self.compression_level = compression_level if compression_level is not None \
+            else DEFAULT_COMPRESSION_LEVELS.get(codec)
+        self.records_per_file = records_per_file
+        self.member_size = member_size
+        self.buffer_size = buffer_size
+
+        self.compressor = zstandard.ZstdCompressor(level=self.compression_level) if codec == 'zstd' else None
+
+        self.file_number = -1
+        self.f = None
+        self.filenames = []
+
+    def open_next_file(self):
+        self.close()
+
+        self.file_number += 1
+        filename = get_export_filename(self.filename_base, self.file_number, self.codec)
+
+        self.f = open(filename, 'wb', self.buffer_size)
+        self.filenames.append(filename)
+
+        self.file_count = 0
+        self.file_min_created = None
+        self.file_max_created = None
+        self.members = []
+        self.reset_buffer()
+
+    def reset_buffer(self):
+        self.lines = []
+        self.buffer_min_created = None
+        self.buffer_max_created = None
+
+    def write(self, record, created=None):
+        """
+        :param record: The JSON-serializable record
+        :param created: The created timestamp the record is indexed by, taken from the record if not specified
+        """
+        if self.f is None or self.file_count >= self.records_per_file:
+            self.open_next_file()
+
+        if created is None:
+            created = record.get('created')
+
+        self.lines.append(json.dumps(record))
+        self.file_count += 1
+
+        if created is not None:
+            if self.buffer_min_created is None or created < self.buffer_min_created:
+                self.buffer_min_created = created
+
+            if self.buffer_max_created is None or created > self.buffer_max_created:
+                self.buffer_max_created = created
+
+        if len(self.lines) >= self.member_size:
+            self.flush_buffer()
+
+    def compress(self, data):
+        if self.codec == 'gzip':
+            return get_gzip_member(data, self.compression_level)
+
+        if self.codec == 'zstd':
+            return self.compressor.compress(data)
+
+        return data
+
+    def flush_buffer(self):
+        if len(self.lines) == 0:
+            return
+
+        data = self.compress('\n'.join(self.lines) + '\n')
+
+        self.members.append({
+            'offset': self.f.tell(),
+            'length': len(data),
+            'count': len(self.lines),
+            'min_created': self.buffer_min_created,
+            'max_created': self.buffer_max_created
+        })
+
+        self.f.write(data)
+
+        if self.buffer_min_created is not None:
+            if self.file_min_created is None or self.buffer_min_created < self.file_min_created:
+                self.file_min_created = self.buffer_min_created
+
+            if self.file_max_created is None or self.buffer_max_created > self.file_max_created:
+                self.file_max_created = self.buffer_max_created
+
+        self.reset_buffer()
+
+    def write_index(self):
+        index = json.dumps({
+            'codec': self.codec,
+            'count': self.file_count,
+            'min_created': self.file_min_created,
+            'max_created': self.file_max_created,
+            'members': self.members
+        })
+
+        index_offset = self.f.tell()
+
+        if self.codec == 'gzip':
+            # the extra field of a gzip member is limited to 64k, so a large index is split over empty members
+            for start in xrange(0, len(index), GZIP_MAX_EXTRA_PAYLOAD):
+                self.f.write(get_gzip_member('', 1, index[start:start + GZIP_MAX_EXTRA_PAYLOAD]))
+
+            index_length = self.f.tell() - index_offset
+            self.f.write(get_gzip_member('', 1, get_trailer_payload(index_offset, index_length)))
+
+        else:
+            self.f.write(get_zstd_skippable_frame(index))
+            index_length = self.f.tell() - index_offset
+            self.f.write(get_zstd_skippable_frame(get_trailer_payload(index_offset, index_length)))
+
+    def close(self):
+        if self.f is None:
+            return
+
+        self.flush_buffer()
+
+        if self.codec != 'none':
+            self.write_index()
+
+        self.f.close()
+        self.f = None
+
+
+def read_gzip_extra(data):
+    """
+    Returns the payload of the extra field of an empty gzip member written by get_gzip_member()
+    """
+    extra_length = struct.unpack('<H', data[10:12])[0]
+    return data[16:12 + extra_length]
+
+
+def read_export_index(filename):
+    """
+    Reads the index of a compressed export file without decompressing any of the data
+
+    :return: a dict with the codec, count, min/max created and the members of the file
+    """
+    codec = 'gzip' if filename.endswith(FILE_EXTENSIONS['gzip']) else 'zstd'
+    trailer_size = TRAILER_SIZES[codec]
+
+    with open(filename, 'rb') as f:
+        f.seek(-trailer_size, os.SEEK_END)
+        trailer = f.read(trailer_size)
+
+        if codec == 'gzip':
+            payload = read_gzip_extra(trailer)
+        else:
+            payload = trailer[8:]
+
+        if not payload.startswith(TRAILER_MAGIC):
+            raise ValueError('File [%s] does not have an export index' % filename)
+
+        index_offset, index_length = struct.unpack('<QQ', payload[len(TRAILER_MAGIC):])
+
+        f.seek(index_offset)
+        data = f.read(index_length)
+
+    if codec == 'zstd':
+        return json.loads(data[8:])
+
+    chunks = []
+    position = 0
+
+    while position < len(data):
+        extra_length = struct.unpack('<H', data[position + 10:position + 12])[0]
+        member_length = 12 + extra_length + EMPTY_GZIP_MEMBER_SIZE - 10
+        chunks.append(read_gzip_extra(data[position:position + member_length]))
+        position += member_length
+
+    return json.loads(''.join(chunks))
+
+
+def read_member(filename, member):
+    """
+    Decompresses one member of a compressed export file, as listed in its index
+
+    :return: the list of records in the member
+    """
+    with open(filename, 'rb') as f:
+        f.seek(member['offset'])
+        data = f.read(member['length'])
+
+    if filename.endswith(FILE_EXTENSIONS['gzip']):
+        # skip the 10 byte header of a member written without an extra field
+        data = zlib.decompress(data[10:-8], -zlib.MAX_WBITS)
+    else:
+        data = zstandard.ZstdDecompressor().decompress(data)
+
+    return [json.loads(line) for line in data.splitlines() if line]
+
+
+def get_value_type(value):
+    if isinstance(value, bool):
+        return 'bool'
+
+    if isinstance(value, (int, long)):
+        return 'int' if INT64_MIN <= value <= INT64_MAX else None
+
+    if isinstance(value, float):
+        return 'float'
+
+    if isinstance(value, basestring):
+        return 'string'
+
+    if isinstance(value, list) and all(isinstance(item, basestring) for item in value):
+        return 'string_list'
+
+    return None
+
+
+def infer_schema(records):
+    """
+    Infers the column types of a collection from a sample of its records.  A field becomes a column if all of its
+    values in the sample are of one scalar type (or a list of strings), ints and floats together become floats.
+    Nested and mixed fields are left to the extra column.
+
+    :return: a list of (field, type) sorted by field
+    """
+    field_types = {}
+
+    for record in records:
+        for field, value in record.iteritems():
+            if value is None:
+                field_types.setdefault(field, set())
+                continue
+
+            field_types.setdefault(field, set()).add(get_value_type(value))
+
+    columns = []
+
+    for field, types in sorted(field_types.iteritems()):
+        if types == set(['int', 'float']):
+            types = set(['float'])
+
+        if len(types) == 1 and None not in types:
+            columns.append((field, types.pop()))
+
+    return columns
+
+
+class ParquetExportWriter(object):
+    """
+    Writes the records of an export to Parquet files with the same interface as ExportWriter.
+
+    The schema is inferred from the first `sample_size` records, so the first row group is written once the sample is
+    complete.  After that records are buffered and written a row group at a time, so at most one row group is held in
+    memory.  Fields which are not in the schema, nested fields and values which do not match the type of their column
+    are written as a JSON object to the `_extra` column, so no data is lost.  Parquet keeps the min/max of each column
+    per row group in its footer, which gives loaders the same ability to skip data as the index of ExportWriter.
+    """
+
+    def __init__(self, filename_base, codec='none', compression_level=None, records_per_file=10000,
+                 row_group_size=10000, sample_size=1000):
+        """
+        :param filename_base: The path and prefix of the files, the file number and extension are appended
+        :param codec: One of CODECS, used as the compression of the parquet pages
+        :param compression_level: The compression level, the codec default if not specified
+        :param records_per_file: The number of records after which a new file is started
+        :param row_group_size: The number of records in each row group
+        :param sample_size: The number of records the schema is inferred from
+        """
+        if pyarrow is None:
+            raise ImportError('The parquet format requires pyarrow (pip install pyarrow)')
+
+        self.filename_base = filename_base
+        self.compression = PARQUET_COMPRESSION[codec]
+        self.compression_level = compression_level
+        self.records_per_file = records_per_file
+        self.row_group_size = row_group_size
+        self.sample_size = sample_size
+
+        self.columns = None
+        self.schema = None
+        self.records = []
+
+        self.file_number = -1
+        self.file_count = 0
+        self.writer = None
+        self.filenames = []
+
+    def get_arrow_type(self, value_type):
+        return {
+            'bool': pyarrow.bool_(),
+            'int': pyarrow.int64(),
+            'float': pyarrow.float64(),
+            'string': pyarrow.string(),
+            'string_list': pyarrow.list_(pyarrow.string())
+        }[value_type]
+
+    def init_schema(self):
+        self.columns = infer_schema(self.records)
+
+        fields = [pyarrow.field(field, self.get_arrow_type(value_type)) for field, value_type in self.columns]
+        fields.append(pyarrow.field(EXTRA_COLUMN, pyarrow.string()))
+
+        self.schema = pyarrow.schema(fields)
+
+    def write(self, record, created=None):
+        """
+        :param record: The JSON-serializable record
+        :param created: Not used, parquet keeps the range of every column
+        """
+        self.records.append(record)
+
+        if self.schema is None:
+            if len(self.records) >= self.sample_size:
+                self.init_schema()
+
+        elif len(self.records) >= self.row_group_size:
+            self.flush_buffer()
+
+    def open_next_file(self):
+        self.close_file()
+
+        self.file_number += 1
+        filename = '%s-%s.parquet' % (self.filename_base, self.file_number)
+
+        kwargs = {}
+
+        if self.compression_level is not None:
+            kwargs['compression_level'] = self.compression_level
+
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema, compression=self.compression, **kwargs)
+        self.filenames.append(filename)
+        self.file_count = 0
+
+    def flush_buffer(self):
+        if len(self.records) == 0:
+            return
+
+        if self.schema is None:
+            self.init_schema()
+
+        position = 0
+
+        while position < len(self.records):
+            if self.writer is None or self.file_count >= self.records_per_file:
+                self.open_next_file()
+
+            # the sample can be larger than a row group, so it is split across row groups like any other records
+            count = min(len(self.records) - position, self.records_per_file - self.file_count, self.row_group_size)
+            self.writer.write_table(self.get_table(self.records[position:position + count]))
+
+            self.file_count += count
+            position += count
+
+        self.records = []
+
+    def get_table(self, records):
+        values = dict((field, []) for field, value_type in self.columns)
+        column_types = dict(self.columns)
+        extras = []
+
+        for record in records:
+            extra = {}
+
+            for field, value in record.iteritems():
+                if field in column_types and (value is None or self.matches(column_types[field], value)):
+                    continue
+
+                extra[field] = value
+
+            for field, value_type in self.columns:
+                value = record.get(field)
+                values[field].append(None if field in extra else value)
+
+            extras.append(json.dumps(extra) if len(extra) > 0 else None)
+
+        arrays = [pyarrow.array(values[field], type=self.get_arrow_type(value_type))
+                  for field, value_type in self.columns]
+        arrays.append(pyarrow.array(extras, type=pyarrow.string()))
+
+        return pyarrow.Table.from_arrays(arrays, schema=self.schema)
+
+    def matches(self, column_type, value):
+        value_type = get_value_type(value)
+        return value_type == column_type or (column_type == 'float' and value_type == 'int')
+
+    def close_file(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def close(self):
+        self.flush_buffer()
+        self.close_file()
+
+
+def get_file_codec(filename):
+    for codec, extension in FILE_EXTENSIONS.iteritems():
+        if filename.endswith('.%s' % extension):
+            return codec
+
+    return None
+
+
+def read_export_batches(filename, offset=0, batch_size=100):
+    """
+    Reads the records of an export file written by ExportWriter, starting at an offset returned by an earlier batch.
+
+    For an uncompressed file the offset is a byte offset and records are returned in batches of `batch_size`.  For a
+    compressed file the offset is that of a member in the index and each batch is one member, so reading can continue
+    from a member without decompressing the members before it.
+
+    :return: a generator of (records, offset of the next batch)
+    """
+    if get_file_codec(filename) == 'none':
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            records = []
+
+            # readline() rather than iterating the file, so that tell() is not affected by read-ahead
+            while True:
+                line = f.readline()
+
+                if not line:
+                    break
+
+                if line.strip():
+                    records.append(json.loads(line))
+
+                if len(records) >= batch_size:
+                    yield records, f.tell()
+                    records = []
+
+            if len(records) > 0:
+                yield records, f.tell()
+
+        return
+
+    index = read_export_index(filename)
+
+    for member in index['members']:
+        if member['offset'] < offset:
+            continue
+
+        yield read_member(filename, member), member['offset'] + member['length']
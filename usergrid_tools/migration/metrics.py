@@ -0,0 +1,326 @@
+import BaseHTTPServer
+import logging
+import os
+import threading
+import time
+import traceback
+from multiprocessing import Process, current_process
+from Queue import Empty, Full
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('Metrics')
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def get_metric_key(name, labels):
+    return name, tuple(sorted(labels.iteritems())) if labels else ()
+
+
+def format_labels(labels, extra=None):
+    labels = list(labels)
+
+    if extra is not None:
+        labels.append(extra)
+
+    if len(labels) == 0:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class MetricsRecorder(object):
+    """
+    Collects counters, gauges and histograms in the process which records them and sends what changed to the
+    MetricsListener once per flush interval, so that recording a metric does not cost a message on the queue.
+
+    A recorder without a queue does nothing, so the metrics can be recorded unconditionally.  The flush thread is
+    started on first use in each process, since threads do not survive the fork of the worker processes.
+    """
+
+    def __init__(self, metrics_queue=None, flush_interval=1.0):
+        """
+        :param metrics_queue: The queue of the MetricsListener
+        :param flush_interval: The number of seconds between sends to the MetricsListener
+        """
+        self.metrics_queue = metrics_queue
+        self.flush_interval = flush_interval
+        self.pid = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.collectors = []
+        self.last_progress = time.time()
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # anything recorded before the fork belongs to the parent
+            self.reset()
+            self.pid = os.getpid()
+
+            flusher = threading.Thread(target=self.flush_loop, name='MetricsFlusher')
+            flusher.daemon = True
+            flusher.start()
+
+    def inc(self, name, labels=None, value=1):
+        if self.metrics_queue is None:
+            return
+
+        self.ensure_started()
+        key = get_metric_key(name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        if self.metrics_queue is None:
+            return
+
+        self.ensure_started()
+
+        with self.lock:
+            self.gauges[get_metric_key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        if self.metrics_queue is None:
+            return
+
+        self.ensure_started()
+        key = get_metric_key(name, labels)
+
+        with self.lock:
+            # one count per bucket, then the sum and the count
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def register_collector(self, collector):
+        """
+        Registers a function which is called before each flush, to set gauges from state such as cache statistics
+        """
+        if self.metrics_queue is None:
+            return
+
+        self.ensure_started()
+        self.collectors.append(collector)
+
+    def progress(self):
+        """
+        Marks that the worker did a unit of work, used to tell a stuck worker from a live one
+        """
+        if self.metrics_queue is None:
+            return
+
+        self.ensure_started()
+        self.last_progress = time.time()
+
+    def flush(self):
+        for collector in self.collectors:
+            collector(self)
+
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+            gauges = self.gauges.copy()
+
+        worker = '%s-%s' % (type(current_process()).__name__, os.getpid())
+        message = (worker, os.getpid(), time.time(), self.last_progress, counters, histograms, gauges)
+
+        try:
+            self.metrics_queue.put_nowait(message)
+
+        except Full:
+            # put the deltas back to be sent with the next flush
+            with self.lock:
+                for key, value in counters.iteritems():
+                    self.counters[key] = self.counters.get(key, 0) + value
+
+                for key, values in histograms.iteritems():
+                    if key in self.histograms:
+                        self.histograms[key] = [a + b for a, b in zip(self.histograms[key], values)]
+                    else:
+                        self.histograms[key] = values
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+
+            try:
+                self.flush()
+            except:
+                logger.error(traceback.format_exc())
+
+
+class MetricsListener(Process):
+    """
+    Receives the metrics of all worker processes and serves the totals over HTTP in the Prometheus text format
+    """
+
+    def __init__(self, metrics_queue, port, queues=None, liveness_timeout=10):
+        """
+        :param metrics_queue: The queue the MetricsRecorders send to
+        :param port: The local port to serve /metrics on
+        :param queues: A dict of name -> multiprocessing Queue whose depth is reported
+        :param liveness_timeout: The number of seconds without a flush after which a worker is reported as down
+        """
+        super(MetricsListener, self).__init__()
+        self.metrics_queue = metrics_queue
+        self.port = port
+        self.queues = queues if queues is not None else {}
+        self.liveness_timeout = liveness_timeout
+
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def run(self):
+        server = BaseHTTPServer.HTTPServer(('', self.port), self.get_handler_class())
+
+        server_thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+        server_thread.daemon = True
+        server_thread.start()
+
+        logger.info('Serving metrics on port [%s]' % self.port)
+
+        while True:
+            try:
+                self.apply(self.metrics_queue.get(timeout=1))
+
+            except Empty:
+                pass
+
+            except KeyboardInterrupt:
+                break
+
+            except:
+                logger.error(traceback.format_exc())
+
+        server.shutdown()
+
+    def apply(self, message):
+        worker, pid, sent, last_progress, counters, histograms, gauges = message
+
+        with self.lock:
+            for key, value in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for key, values in histograms.iteritems():
+                if key in self.histograms:
+                    self.histograms[key] = [a + b for a, b in zip(self.histograms[key], values)]
+                else:
+                    self.histograms[key] = values
+
+            for (name, labels), value in gauges.iteritems():
+                self.gauges[(name, labels + (('worker', worker),))] = value
+
+            self.workers[worker] = {
+                'pid': pid,
+                'last_seen': sent,
+                'last_progress': last_progress
+            }
+
+    def render(self):
+        now = time.time()
+        lines = []
+
+        with self.lock:
+            for name in sorted(set(name for name, labels in self.counters)):
+                lines.append('# TYPE %s counter' % name)
+
+                for (key_name, labels), value in sorted(self.counters.iteritems()):
+                    if key_name == name:
+                        lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+            for name in sorted(set(name for name, labels in self.histograms)):
+                lines.append('# TYPE %s histogram' % name)
+
+                for (key_name, labels), values in sorted(self.histograms.iteritems()):
+                    if key_name != name:
+                        continue
+
+                    cumulative = 0
+
+                    for bound, count in zip(LATENCY_BUCKETS, values):
+                        cumulative += count
+                        lines.append('%s_bucket%s %s' % (name, format_labels(labels, ('le', bound)), cumulative))
+
+                    lines.append('%s_bucket%s %s' % (name, format_labels(labels, ('le', '+Inf')), values[-1]))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), values[-2]))
+                    lines.append('%s_count%s %s' % (name, format_labels(labels), values[-1]))
+
+            for name in sorted(set(name for name, labels in self.gauges)):
+                lines.append('# TYPE %s gauge' % name)
+
+                for (key_name, labels), value in sorted(self.gauges.iteritems()):
+                    if key_name == name:
+                        lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+            lines.append('# TYPE usergrid_worker_up gauge')
+
+            for worker, data in sorted(self.workers.iteritems()):
+                up = 1 if now - data['last_seen'] <= self.liveness_timeout else 0
+                lines.append('usergrid_worker_up{worker="%s"} %s' % (worker, up))
+
+            lines.append('# TYPE usergrid_worker_seconds_since_progress gauge')
+
+            for worker, data in sorted(self.workers.iteritems()):
+                lines.append('usergrid_worker_seconds_since_progress{worker="%s"} %.3f' % (
+                    worker, now - data['last_progress']))
+
+        lines.append('# TYPE usergrid_queue_depth gauge')
+
+        for name, queue in sorted(self.queues.iteritems()):
+            try:
+                lines.append('usergrid_queue_depth{queue="%s"} %s' % (name, queue.qsize()))
+
+            except NotImplementedError:
+                # qsize() is not available on all platforms, e.g. Mac
+                pass
+
+        return '\n'.join(lines) + '\n'
+
+    def get_handler_class(self):
+        listener = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = listener.render()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return MetricsHandler
@@ -0,0 +1,199 @@
+import logging
+import time
+from multiprocessing import Value
+
+from usergrid_tools.general.http_client import HttpClientAdapter
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('RateController')
+
+
+class RateController(object):
+    """
+    An AIMD (additive increase, multiplicative decrease) controller for the requests made by all of the worker
+    processes.  It holds a global request rate and a global limit on requests in flight in shared memory, so it must
+    be created before the worker processes are started.
+
+    Each process observes the latency and status of its own responses.  When a window of observations has a p99
+    latency above the target, or too many 5xx/429 responses, the rate and concurrency are cut by a factor.  Otherwise
+    they are raised by a step, up to the configured maximums.
+    """
+
+    def __init__(self,
+                 target_latency=1.0,
+                 min_rate=5.0,
+                 max_rate=1000.0,
+                 min_concurrency=2,
+                 max_concurrency=200,
+                 error_threshold=0.02,
+                 window_size=200,
+                 window_time=5.0,
+                 decrease_factor=0.7,
+                 cooldown=2.0):
+        """
+        :param target_latency: The p99 latency, in seconds, to hold the requests at
+        :param min_rate: The lowest global request rate, in requests per second
+        :param max_rate: The highest global request rate, in requests per second
+        :param min_concurrency: The lowest number of requests allowed in flight across all processes
+        :param max_concurrency: The highest number of requests allowed in flight across all processes
+        :param error_threshold: The fraction of 5xx/429 responses in a window which causes a decrease
+        :param window_size: The number of responses a process observes before it adjusts the rate
+        :param window_time: The max number of seconds a process observes before it adjusts the rate
+        :param decrease_factor: The factor to multiply the rate and concurrency by on a decrease
+        :param cooldown: The number of seconds after a decrease during which no other decrease is made, so that
+        processes which observed the same slowdown do not all cut the rate
+        """
+        self.target_latency = target_latency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.error_threshold = error_threshold
+        self.window_size = window_size
+        self.window_time = window_time
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        # shared across processes
+        self.rate = Value('d', max(min_rate, max_rate / 2.0))
+        self.concurrency = Value('i', max_concurrency)
+        self.in_flight = Value('i', 0)
+        self.next_slot = Value('d', 0.0)
+        self.last_decrease = Value('d', 0.0)
+        self.last_p99 = Value('d', 0.0)
+        self.last_error_rate = Value('d', 0.0)
+        self.increases = Value('i', 0)
+        self.decreases = Value('i', 0)
+
+        # local to each process
+        self.latencies = []
+        self.errors = 0
+        self.window_started = time.time()
+
+    def acquire(self):
+        """
+        Waits until a request is allowed by both the global rate and the global concurrency limit
+        """
+        while True:
+            with self.in_flight.get_lock():
+                if self.in_flight.value < self.concurrency.value:
+                    self.in_flight.value += 1
+                    break
+
+            time.sleep(0.01)
+
+        # reserve the next slot of the global rate and wait for it outside of the lock
+        with self.next_slot.get_lock():
+            now = time.time()
+            slot = max(now, self.next_slot.value)
+            self.next_slot.value = slot + 1.0 / self.rate.value
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self):
+        with self.in_flight.get_lock():
+            self.in_flight.value -= 1
+
+    def observe(self, latency, status_code):
+        """
+        Records the outcome of a request.  A status_code of None is a request which failed without a response.
+        """
+        self.latencies.append(latency)
+
+        if status_code is None or status_code >= 500 or status_code == 429:
+            self.errors += 1
+
+        if len(self.latencies) >= self.window_size or time.time() - self.window_started >= self.window_time:
+            self.adjust()
+
+    def adjust(self):
+        latencies = sorted(self.latencies)
+        errors = self.errors
+
+        self.latencies = []
+        self.errors = 0
+        self.window_started = time.time()
+
+        if len(latencies) == 0:
+            return
+
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        error_rate = float(errors) / len(latencies)
+
+        self.last_p99.value = p99
+        self.last_error_rate.value = error_rate
+
+        if p99 > self.target_latency or error_rate > self.error_threshold:
+            with self.last_decrease.get_lock():
+                now = time.time()
+
+                if now - self.last_decrease.value < self.cooldown:
+                    return
+
+                self.last_decrease.value = now
+
+            with self.rate.get_lock():
+                self.rate.value = max(self.min_rate, self.rate.value * self.decrease_factor)
+
+            with self.concurrency.get_lock():
+                self.concurrency.value = max(self.min_concurrency,
+                                             int(self.concurrency.value * self.decrease_factor))
+
+            with self.decreases.get_lock():
+                self.decreases.value += 1
+
+            logger.warning('Decreased rate to [%.1f]/s and concurrency to [%s]: p99=[%.3f]s errors=[%.1f%%]' % (
+                self.rate.value, self.concurrency.value, p99, error_rate * 100))
+
+        else:
+            # additive increase of 1% of the max rate per window
+            with self.rate.get_lock():
+                self.rate.value = min(self.max_rate, self.rate.value + max(1.0, self.max_rate / 100.0))
+
+            with self.concurrency.get_lock():
+                self.concurrency.value = min(self.max_concurrency, self.concurrency.value + 1)
+
+            with self.increases.get_lock():
+                self.increases.value += 1
+
+    def get_state(self):
+        return {
+            'rate': round(self.rate.value, 2),
+            'concurrency': self.concurrency.value,
+            'in_flight': self.in_flight.value,
+            'target_latency': self.target_latency,
+            'last_p99': round(self.last_p99.value, 4),
+            'last_error_rate': round(self.last_error_rate.value, 4),
+            'increases': self.increases.value,
+            'decreases': self.decreases.value
+        }
+
+
+class RateControlledAdapter(HttpClientAdapter):
+    """
+    An HttpClientAdapter which paces every request through a RateController and reports the latency and status of each
+    response back to it.  If the controller is None requests are sent unchanged.
+    """
+
+    def __init__(self, rate_controller, *args, **kwargs):
+        self.rate_controller = rate_controller
+        super(RateControlledAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if self.rate_controller is None:
+            return super(RateControlledAdapter, self).send(request, **kwargs)
+
+        self.rate_controller.acquire()
+        start_time = time.time()
+        status_code = None
+
+        try:
+            response = super(RateControlledAdapter, self).send(request, **kwargs)
+            status_code = response.status_code
+            return response
+
+        finally:
+            self.rate_controller.release()
+            self.rate_controller.observe(time.time() - start_time, status_code)
@@ -0,0 +1,101 @@
+import json
+import logging
+
+from usergrid_tools.general.retry import get_retry_policy
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('Segments')
+
+
+def get_first_entity(session, url):
+    r = get_retry_policy().request(session.get, url)
+
+    if r.status_code != 200:
+        logger.error('Unable to get first entity, HTTP [%s] on URL=[%s]: %s' % (r.status_code, url, r.text))
+        return None
+
+    entities = json.loads(r.content).get('entities', [])
+
+    return entities[0] if len(entities) > 0 else None
+
+
+def get_collection_segments(session, url_for_ql, segment_count):
+    """
+    Splits a collection into segments which cover disjoint windows of the 'created' timestamp, so each segment can be
+    scanned by a different worker.  The last segment has no upper bound so that entities created during the scan
+    are still included.
+
+    :param session: The requests Session to use
+    :param url_for_ql: A function which returns a query URL (with limit=1) for a QL string
+    :param segment_count: The number of segments to create
+    :return: a list of segments, or [None] if the collection should be scanned as a whole
+    """
+    if segment_count <= 1:
+        return [None]
+
+    first_entity = get_first_entity(session, url_for_ql('select * order by created asc'))
+    last_entity = get_first_entity(session, url_for_ql('select * order by created desc'))
+
+    if first_entity is None or last_entity is None:
+        return [None]
+
+    min_created = long(first_entity.get('created'))
+    max_created = long(last_entity.get('created'))
+
+    width = max(1, (max_created + 1 - min_created + segment_count - 1) / segment_count)
+
+    segments = []
+    start = min_created
+
+    while start <= max_created:
+        segments.append({
+            'index': len(segments),
+            'start': start,
+            'end': start + width
+        })
+
+        start += width
+
+    segments[-1]['end'] = None
+
+    for segment in segments:
+        segment['count'] = len(segments)
+
+    return segments
+
+
+def get_segment_ql(ql, segment):
+    """
+    Adds the 'created' window of a segment to a QL string, keeping any predicate and ordering in it
+    """
+    if segment is None:
+        return ql
+
+    window = 'created >= %s' % segment['start']
+
+    if segment['end'] is not None:
+        window += ' and created < %s' % segment['end']
+
+    lower_ql = ql.lower()
+    order_index = lower_ql.find('order by')
+
+    order_by = ql[order_index:] if order_index >= 0 else 'order by created asc'
+    select = ql[:order_index] if order_index >= 0 else ql
+
+    where_index = select.lower().find(' where ')
+
+    if where_index >= 0:
+        predicate = select[where_index + len(' where '):].strip()
+
+        if len(predicate) > 0:
+            return 'select * where (%s) and %s %s' % (predicate, window, order_by)
+
+    return 'select * where %s %s' % (window, order_by)
+
+
+def get_checkpoint_name(collection_name, segment):
+    if segment is None:
+        return collection_name
+
+    return '%s:%s' % (collection_name, segment['index'])
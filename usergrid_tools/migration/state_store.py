@@ -0,0 +1,224 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('StateStore')
+
+
+class CheckpointStore(object):
+    """
+    Persists the last cursor which was completely published for each app/collection in a local SQLite file so that an
+    interrupted run can continue where it left off.  Each worker process opens its own connection; SQLite handles the
+    locking between the processes.
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: The path of the SQLite file, created if it does not exist
+        :param timeout: The number of seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+
+    def get_connection(self):
+        # connections are opened lazily so that one is never shared across a fork
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS collection_checkpoint ('
+                                    'app TEXT NOT NULL, '
+                                    'collection TEXT NOT NULL, '
+                                    'cursor TEXT, '
+                                    'count INTEGER NOT NULL, '
+                                    'complete INTEGER NOT NULL, '
+                                    'updated REAL NOT NULL, '
+                                    'PRIMARY KEY (app, collection))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS collection_segments ('
+                                    'app TEXT NOT NULL, '
+                                    'collection TEXT NOT NULL, '
+                                    'segments TEXT NOT NULL, '
+                                    'PRIMARY KEY (app, collection))')
+            self.connection.commit()
+
+        return self.connection
+
+    def get(self, app, collection):
+        """
+        :return: a dict with the cursor, count and complete flag of the checkpoint, or None if there is none
+        """
+        row = self.get_connection().execute(
+                'SELECT cursor, count, complete FROM collection_checkpoint WHERE app = ? AND collection = ?',
+                (app, collection)).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'cursor': row[0],
+            'count': row[1],
+            'complete': row[2] == 1
+        }
+
+    def save(self, app, collection, cursor, count, complete=False):
+        connection = self.get_connection()
+        connection.execute('INSERT OR REPLACE INTO collection_checkpoint '
+                           '(app, collection, cursor, count, complete, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                           (app, collection, cursor, count, 1 if complete else 0, time.time()))
+        connection.commit()
+
+    def get_segments(self, app, collection):
+        """
+        :return: the list of segments the collection was split into by the run, or None if they were not saved
+        """
+        row = self.get_connection().execute(
+                'SELECT segments FROM collection_segments WHERE app = ? AND collection = ?',
+                (app, collection)).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def save_segments(self, app, collection, segments):
+        # a cursor is only valid for the query it came from, so a resumed run has to scan the same windows
+        connection = self.get_connection()
+        connection.execute('INSERT OR REPLACE INTO collection_segments (app, collection, segments) VALUES (?, ?, ?)',
+                           (app, collection, json.dumps(segments)))
+        connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class FileCheckpointStore(object):
+    """
+    Persists how far each export file has been imported, as the offset to continue reading the file from, so that an
+    interrupted import can skip the records which were already written.  Like CheckpointStore, each process opens its
+    own connection to the SQLite file.
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: The path of the SQLite file, created if it does not exist
+        :param timeout: The number of seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+
+    def get_connection(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS file_checkpoint ('
+                                    'path TEXT NOT NULL PRIMARY KEY, '
+                                    'offset INTEGER NOT NULL, '
+                                    'count INTEGER NOT NULL, '
+                                    'complete INTEGER NOT NULL, '
+                                    'updated REAL NOT NULL)')
+            self.connection.commit()
+
+        return self.connection
+
+    def get(self, path):
+        """
+        :return: a dict with the offset, count and complete flag of the checkpoint, or None if there is none
+        """
+        row = self.get_connection().execute(
+                'SELECT offset, count, complete FROM file_checkpoint WHERE path = ?', (path,)).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'offset': row[0],
+            'count': row[1],
+            'complete': row[2] == 1
+        }
+
+    def save(self, path, offset, count, complete=False):
+        connection = self.get_connection()
+        connection.execute('INSERT OR REPLACE INTO file_checkpoint (path, offset, count, complete, updated) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           (path, offset, count, 1 if complete else 0, time.time()))
+        connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class DigestStore(object):
+    """
+    Persists a digest of the last value written to the target for each key, so that a re-run can skip the writes of
+    values which have not changed since.  Unlike the checkpoints this is not kept per run: every run of the same org
+    reads and updates the same file.  Each process opens its own connection to the SQLite file, which the threads of
+    the process take turns to use.
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: The path of the SQLite file, created if it does not exist
+        :param timeout: The number of seconds to wait for a lock held by another process
+        """
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS digest ('
+                                    'scope TEXT NOT NULL, '
+                                    'key TEXT NOT NULL, '
+                                    'digest TEXT NOT NULL, '
+                                    'updated REAL NOT NULL, '
+                                    'PRIMARY KEY (scope, key))')
+            self.connection.commit()
+
+        return self.connection
+
+    def get_many(self, scope, keys):
+        """
+        :return: a dict of key -> digest for the keys in the scope which have a digest
+        """
+        digests = {}
+        keys = list(keys)
+
+        with self.lock:
+            connection = self.get_connection()
+
+            # stay under the limit of 999 parameters per statement of older SQLite versions
+            for start in xrange(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+
+                rows = connection.execute('SELECT key, digest FROM digest WHERE scope = ? AND key IN (%s)' % (
+                    ', '.join(['?'] * len(chunk))), [scope] + chunk)
+
+                digests.update(rows)
+
+        return digests
+
+    def save_many(self, scope, digests):
+        """
+        :param digests: a dict of key -> digest to save in the scope, in one transaction
+        """
+        if len(digests) == 0:
+            return
+
+        now = time.time()
+
+        with self.lock:
+            connection = self.get_connection()
+            connection.executemany('INSERT OR REPLACE INTO digest (scope, key, digest, updated) VALUES (?, ?, ?, ?)',
+                                   ((scope, key, digest, now) for key, digest in digests.iteritems()))
+            connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
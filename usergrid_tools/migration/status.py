@@ -0,0 +1,124 @@
+import json
+import os
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+
+def get_empty_summary():
+    return {
+        'max_created': -1,
+        'max_modified': -1,
+        'min_created': 1584946416000,
+        'min_modified': 1584946416000,
+        'count': 0,
+        'bytes': 0
+    }
+
+
+def apply_status_delta(summary, status, count_delta, bytes_delta):
+    """
+    Adds the change in count/bytes of one collection status to a summary and widens its min/max.  The min/max of a
+    collection only ever widen while it is iterated, so comparing with the latest status is enough.
+    """
+    summary['count'] += count_delta
+    summary['bytes'] += bytes_delta
+
+    for field in ['created', 'modified']:
+        if status.get('max_%s' % field, -1) > summary['max_%s' % field]:
+            summary['max_%s' % field] = status.get('max_%s' % field)
+
+            if 'max_%s_str' % field in status:
+                summary['max_%s_str' % field] = status['max_%s_str' % field]
+
+        if status.get('min_%s' % field, 1584946416000) < summary['min_%s' % field]:
+            summary['min_%s' % field] = status.get('min_%s' % field)
+
+            if 'min_%s_str' % field in status:
+                summary['min_%s_str' % field] = status['min_%s_str' % field]
+
+
+class StatusAggregator(object):
+    """
+    Maintains the org / app / collection status from the status maps sent by the collection workers.  Each status map
+    holds the running totals of one collection (or one segment of a collection), so the change since the previous
+    status map of the same collection is applied to the app and org summaries instead of summing every collection
+    again for each message.
+    """
+
+    def __init__(self, org):
+        self.org_results = {
+            'name': org,
+            'apps': {},
+            'summary': get_empty_summary()
+        }
+
+        # (app, collection, segment) -> the last status map received, to compute the change
+        self.previous = {}
+        self.dirty = False
+
+    def get_app(self, app):
+        app_data = self.org_results['apps'].get(app)
+
+        if app_data is None:
+            app_data = self.org_results['apps'][app] = {
+                'collections': {},
+                'summary': get_empty_summary()
+            }
+
+        return app_data
+
+    def apply(self, app, collection_name, status):
+        app_data = self.get_app(app)
+        segment = status.get('segment')
+
+        key = (app, collection_name, segment)
+        previous = self.previous.get(key, {})
+        self.previous[key] = status
+
+        count_delta = status.get('count', 0) - previous.get('count', 0)
+        bytes_delta = status.get('bytes', 0) - previous.get('bytes', 0)
+
+        if segment is None:
+            app_data['collections'][collection_name] = status
+
+        else:
+            collection_data = app_data['collections'].get(collection_name)
+
+            if collection_data is None:
+                collection_data = app_data['collections'][collection_name] = get_empty_summary()
+                collection_data['segments'] = {}
+                collection_data['segments_finished'] = 0
+
+            collection_data['segments'][str(segment)] = status
+            apply_status_delta(collection_data, status, count_delta, bytes_delta)
+
+            if 'iteration_started' in status:
+                collection_data['iteration_started'] = min(
+                        collection_data.get('iteration_started', status['iteration_started']),
+                        status['iteration_started'])
+
+            if 'iteration_finished' in status and 'iteration_finished' not in previous:
+                collection_data['segments_finished'] += 1
+
+                if collection_data['segments_finished'] == status.get('segment_count'):
+                    collection_data['iteration_finished'] = max(
+                            segment_status.get('iteration_finished')
+                            for segment_status in collection_data['segments'].itervalues())
+
+        apply_status_delta(app_data['summary'], status, count_delta, bytes_delta)
+        apply_status_delta(self.org_results['summary'], status, count_delta, bytes_delta)
+
+        self.dirty = True
+
+
+def write_status_file(file_name, org_results):
+    """
+    Writes the status to a temporary file and renames it over the status file, so that a reader never sees a
+    partially written file
+    """
+    temp_file_name = '%s.tmp' % file_name
+
+    with open(temp_file_name, 'w') as f:
+        json.dump(org_results, f, indent=2)
+
+    os.rename(temp_file_name, file_name)
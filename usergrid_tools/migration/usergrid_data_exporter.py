@@ -6,6 +6,7 @@ import json
 import logging
 import sys
 from multiprocessing import Queue, Process
+from multiprocessing.pool import ThreadPool
 import time_uuid
 
 import datetime
@@ -17,9 +18,17 @@ from sys import platform as _platform
 
 import signal
 
-from usergrid import UsergridQueryIterator
 import urllib3
 
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats, HTTP2_AVAILABLE
+from usergrid_tools.general.token_manager import BearerAuth, TokenManager
+from usergrid_tools.general.retry import configure_retry_policy, get_retry_policy
+from usergrid_tools.iterators.usergrid_page_iterator import UsergridPageIterator
+from usergrid_tools.migration.export_writer import CODECS, FORMATS, ExportWriter, ParquetExportWriter
+from usergrid_tools.migration.segments import get_collection_segments, get_segment_ql
+from usergrid_tools.migration.status import StatusAggregator
+
 __author__ = 'Jeff West @ ApigeeCorporation'
 
 ECID = str(uuid.uuid1())
@@ -35,7 +44,6 @@ status_logger = logging.getLogger('StatusLogger')
 urllib3.disable_warnings()
 
 DEFAULT_CREATE_APPS = False
-DEFAULT_RETRY_SLEEP = 10
 DEFAULT_PROCESSING_SLEEP = 1
 
 queue = Queue()
@@ -50,6 +58,9 @@ except:
 session_source = requests.Session()
 session_target = requests.Session()
 
+# gets the access tokens sent in place of the client credentials, shared by the worker processes
+token_manager = None
+
 
 def total_seconds(td):
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10 ** 6) / 10 ** 6
@@ -108,20 +119,20 @@ entity_name_map = {
 config = {}
 
 # URL Templates for Usergrid
-org_management_app_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_management_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_url_template = "{api_url}/{org}?client_id={client_id}&client_secret={client_secret}"
-app_url_template = "{api_url}/{org}/{app}?client_id={client_id}&client_secret={client_secret}"
-collection_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}"
-collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&client_id={client_id}&client_secret={client_secret}&limit={limit}"
-collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}&limit={limit}"
-connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}?client_id={client_id}&client_secret={client_secret}"
-connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}?client_id={client_id}&client_secret={client_secret}"
-get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}&connections=none"
-get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
-put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
+org_management_app_url_template = "{api_url}/management/organizations/{org}/applications"
+org_management_url_template = "{api_url}/management/organizations/{org}/applications"
+org_url_template = "{api_url}/{org}"
+app_url_template = "{api_url}/{org}/{app}"
+collection_url_template = "{api_url}/{org}/{app}/{collection}"
+collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&limit={limit}"
+collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?limit={limit}"
+connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}"
+connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}"
+connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}"
+connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}"
+get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?connections=none"
+get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
+put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
 
 user_credentials_url_template = "{api_url}/{org}/{app}/users/{uuid}/credentials"
 
@@ -137,112 +148,56 @@ class StatusListener(Process):
     def run(self):
         keep_going = True
 
-        org_results = {
-            'name': config.get('org'),
-            'apps': {},
-        }
+        aggregator = StatusAggregator(config.get('org'))
+        org_results = aggregator.org_results
 
         empty_count = 0
+        last_received = time.time()
+        last_flush = time.time()
 
         while keep_going:
 
             try:
-                app, collection, status_map = self.status_queue.get(timeout=60)
+                app, collection, status_map = self.status_queue.get(timeout=1)
                 status_logger.info('Received status update for app/collection: [%s / %s]' % (app, collection))
                 empty_count = 0
-                org_results['summary'] = {
-                    'max_created': -1,
-                    'max_modified': -1,
-                    'min_created': 1584946416000,
-                    'min_modified': 1584946416000,
-                    'count': 0,
-                    'bytes': 0
-                }
-
-                if app not in org_results['apps']:
-                    org_results['apps'][app] = {
-                        'collections': {}
-                    }
-
-                org_results['apps'][app]['collections'].update(status_map)
-
-                try:
-                    for app, app_data in org_results['apps'].iteritems():
-                        app_data['summary'] = {
-                            'max_created': -1,
-                            'max_modified': -1,
-                            'min_created': 1584946416000,
-                            'min_modified': 1584946416000,
-                            'count': 0,
-                            'bytes': 0
-                        }
-
-                        if 'collections' in app_data:
-                            for collection, collection_data in app_data['collections'].iteritems():
-
-                                app_data['summary']['count'] += collection_data['count']
-                                app_data['summary']['bytes'] += collection_data['bytes']
-
-                                org_results['summary']['count'] += collection_data['count']
-                                org_results['summary']['bytes'] += collection_data['bytes']
-
-                                # APP
-                                if collection_data.get('max_modified') > app_data['summary']['max_modified']:
-                                    app_data['summary']['max_modified'] = collection_data.get('max_modified')
-
-                                if collection_data.get('min_modified') < app_data['summary']['min_modified']:
-                                    app_data['summary']['min_modified'] = collection_data.get('min_modified')
-
-                                if collection_data.get('max_created') > app_data['summary']['max_created']:
-                                    app_data['summary']['max_created'] = collection_data.get('max_created')
-
-                                if collection_data.get('min_created') < app_data['summary']['min_created']:
-                                    app_data['summary']['min_created'] = collection_data.get('min_created')
-
-                                # ORG
-                                if collection_data.get('max_modified') > org_results['summary']['max_modified']:
-                                    org_results['summary']['max_modified'] = collection_data.get('max_modified')
-
-                                if collection_data.get('min_modified') < org_results['summary']['min_modified']:
-                                    org_results['summary']['min_modified'] = collection_data.get('min_modified')
+                last_received = time.time()
 
-                                if collection_data.get('max_created') > org_results['summary']['max_created']:
-                                    org_results['summary']['max_created'] = collection_data.get('max_created')
-
-                                if collection_data.get('min_created') < org_results['summary']['min_created']:
-                                    org_results['summary']['min_created'] = collection_data.get('min_created')
-
-                        if QSIZE_OK:
-                            status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
-
-                        status_logger.warn('UPDATED status of org processed: %s' % json.dumps(org_results))
-
-                except KeyboardInterrupt, e:
-                    raise e
-
-                except:
-                    print traceback.format_exc()
+                for collection_name, collection_status in status_map.iteritems():
+                    aggregator.apply(app, collection_name, collection_status)
 
             except KeyboardInterrupt, e:
                 status_logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
                 raise e
 
             except Empty:
-                if QSIZE_OK:
-                    status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
+                idle_time = time.time() - last_received
 
-                status_logger.warn('CURRENT status of org processed: %s' % json.dumps(org_results))
+                if idle_time >= 60 * (empty_count + 1):
+                    if QSIZE_OK:
+                        status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
 
-                status_logger.warning('EMPTY! Count=%s' % empty_count)
+                    status_logger.warn('CURRENT status of org processed: %s' % json.dumps(org_results))
 
-                empty_count += 1
+                    status_logger.warning('EMPTY! Count=%s' % empty_count)
 
-                if empty_count >= 120:
-                    keep_going = False
+                    empty_count += 1
+
+                    if empty_count >= 120:
+                        keep_going = False
 
             except:
                 print traceback.format_exc()
 
+            if aggregator.dirty and time.time() - last_flush >= config.get('status_flush_interval'):
+                last_flush = time.time()
+                aggregator.dirty = False
+
+                if QSIZE_OK:
+                    status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
+
+                status_logger.warn('UPDATED status of org processed: %s' % json.dumps(org_results))
+
         logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
 
 
@@ -256,6 +211,8 @@ class EntityExportWorker(Process):
     def run(self):
 
         collection_worker_logger.info('starting run()...')
+        init_sessions()
+
         keep_going = True
 
         empty_count = 0
@@ -268,10 +225,10 @@ class EntityExportWorker(Process):
             while keep_going:
 
                 try:
-                    app, collection_name = self.work_queue.get(timeout=30)
+                    app, collection_name, segment = self.work_queue.get(timeout=30)
                     empty_count = 0
 
-                    status_map = self.process_collection(app, collection_name)
+                    status_map = self.process_collection(app, collection_name, segment)
 
                     status_map[collection_name]['iteration_finished'] = str(datetime.datetime.now())
 
@@ -306,9 +263,10 @@ class EntityExportWorker(Process):
                 entity_file.close()
 
             self.response_queue.put((app, collection_name, status_map))
+            log_connection_stats('source', session_source, collection_worker_logger)
             collection_worker_logger.info('FINISHED!')
 
-    def process_collection(self, app, collection_name):
+    def process_collection(self, app, collection_name, segment=None):
 
         status_map = {
             collection_name: {
@@ -322,6 +280,10 @@ class EntityExportWorker(Process):
             }
         }
 
+        if segment is not None:
+            status_map[collection_name]['segment'] = segment['index']
+            status_map[collection_name]['segment_count'] = segment['count']
+
         # added a flag for using graph vs query/index
         if config.get('graph', False):
             source_collection_url = collection_graph_url_template.format(org=config.get('org'),
@@ -334,161 +296,96 @@ class EntityExportWorker(Process):
                                                                          app=app,
                                                                          collection=collection_name,
                                                                          limit=config.get('limit'),
-                                                                         ql="select * %s" % config.get(
-                                                                                 'ql'),
+                                                                         ql=get_segment_ql(
+                                                                                 "select * %s" % config.get('ql'),
+                                                                                 segment),
                                                                          **config.get('source_endpoint'))
         counter = 0
+        next_status_counter = 1
 
-        # use the UsergridQuery from the Python SDK to iterate the collection
-        q = UsergridQueryIterator(source_collection_url,
-                                  page_delay=config.get('page_sleep_time'),
-                                  sleep_time=config.get('error_retry_sleep'))
+        # iterate the collection a page at a time so stats are kept from the page rather than per entity
+        q = UsergridPageIterator(source_collection_url,
+                                 session=session_source,
+                                 page_delay=config.get('page_sleep_time'))
 
         directory = os.path.join(config['export_path'], ECID, config['org'], app)
 
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        entity_filename = '_'.join([collection_name, 'entity-data'])
-        entity_filename_base = os.path.join(directory, entity_filename)
-        entity_file_number = 0
-        entity_file_counter = 0
-        entity_filename = '%s-%s.txt' % (entity_filename_base, entity_file_number)
-        entity_file = open(entity_filename, 'w')
+        # each segment of a collection writes its own files so that segments can be exported in parallel
+        file_prefix = collection_name if segment is None else '%s_%s' % (collection_name, segment['index'])
+
+        entity_file = get_export_writer(os.path.join(directory, '_'.join([file_prefix, 'entity-data'])))
+        edge_file = get_export_writer(os.path.join(directory, '_'.join([file_prefix, 'edge-data'])))
 
-        edge_filename = '_'.join([collection_name, 'edge-data'])
-        edge_filename_base = os.path.join(directory, edge_filename)
-        edge_file_number = 0
-        edge_file_counter = 0
-        edge_filename = '%s-%s.txt' % (edge_filename_base, edge_file_number)
-        edge_file = open(edge_filename, 'w')
+        edge_pool = ThreadPool(config.get('edge_concurrency'))
 
         try:
 
-            for entity in q:
-                try:
-                    entity_file_counter += 1
-                    counter += 1
-
-                    if entity_file_counter > config['entities_per_file']:
-                        entity_file.close()
-                        entity_file_number += 1
-                        entity_file_counter = 0
-                        entity_filename = '%s-%s.txt' % (entity_filename_base, entity_file_number)
-                        entity_file = open(entity_filename, 'w')
-
-                    entity_file.write('%s\n' % json.dumps(entity))
-
-                    edge_names = get_edge_names(entity)
-
-                    for edge_name in edge_names:
-                        if not include_edge(collection_name, edge_name):
-                            continue
-
-                        connection_query_url = connection_query_url_template.format(
-                                org=config.get('org'),
-                                app=app,
-                                verb=edge_name,
-                                collection=collection_name,
-                                uuid=entity.get('uuid'),
-                                limit=config.get('limit'),
-                                **config.get('source_endpoint'))
-
-                        connection_query = UsergridQueryIterator(connection_query_url,
-                                                                 sleep_time=config.get('error_retry_sleep'))
-
-                        target_uuids = []
-
-                        try:
-                            for target_entity in connection_query:
-                                target_uuids.append(target_entity.get('uuid'))
-                        except:
-                            logger.exception('Error processing edge [%s] of entity [ %s / %s / %s]' % (
-                                edge_name, app, collection_name, entity.get('uuid')))
-
-                        if len(target_uuids) > 0:
-                            edge_file_counter += 1
-
-                            edges = {
-                                'entity': {
-                                    'type': entity.get('type'),
-                                    'uuid': entity.get('uuid')
-                                },
-                                'edge_name': edge_name,
-                                'target_uuids': target_uuids
-                            }
-
-                            if entity_file_counter > config['entities_per_file']:
-                                edge_file.close()
-                                edge_file_number += 1
-                                edge_file_counter = 0
-                                edge_filename = '%s-%s.txt' % (edge_filename_base, edge_file_number)
-                                edge_file = open(edge_filename, 'w')
-
-                            edge_file.write('%s\n' % json.dumps(edges))
-
-                    if 'created' in entity:
-
-                        try:
-                            entity_created = long(entity.get('created'))
-
-                            if entity_created > status_map[collection_name]['max_created']:
-                                status_map[collection_name]['max_created'] = entity_created
-                                status_map[collection_name]['max_created_str'] = str(
-                                        datetime.datetime.fromtimestamp(entity_created / 1000))
-
-                            if entity_created < status_map[collection_name]['min_created']:
-                                status_map[collection_name]['min_created'] = entity_created
-                                status_map[collection_name]['min_created_str'] = str(
-                                        datetime.datetime.fromtimestamp(entity_created / 1000))
-
-                        except ValueError:
-                            pass
-
-                    if 'modified' in entity:
-
-                        try:
-                            entity_modified = long(entity.get('modified'))
-
-                            if entity_modified > status_map[collection_name]['max_modified']:
-                                status_map[collection_name]['max_modified'] = entity_modified
-                                status_map[collection_name]['max_modified_str'] = str(
-                                        datetime.datetime.fromtimestamp(entity_modified / 1000))
-
-                            if entity_modified < status_map[collection_name]['min_modified']:
-                                status_map[collection_name]['min_modified'] = entity_modified
-                                status_map[collection_name]['min_modified_str'] = str(
-                                        datetime.datetime.fromtimestamp(entity_modified / 1000))
-
-                        except ValueError:
-                            pass
-
-                    status_map[collection_name]['bytes'] += count_bytes(entity)
-                    status_map[collection_name]['count'] += 1
-
-                    if counter % 1000 == 1:
-                        try:
-                            collection_worker_logger.warning(
-                                    'Sending incremental stats for app/collection [%s / %s]: %s' % (
-                                        app, collection_name, status_map))
-
-                            self.response_queue.put((app, collection_name, status_map))
-
-                            if QSIZE_OK:
-                                collection_worker_logger.info(
-                                        'Counter=%s, collection queue depth=%s' % (
-                                            counter, self.work_queue.qsize()))
-                        except:
-                            pass
-
-                        collection_worker_logger.warn(
-                                'Current status of collections processed: %s' % json.dumps(status_map))
-                except KeyboardInterrupt:
-                    raise
-
-                except:
-                    logger.exception(
-                            'Error processing entity %s / %s / %s' % (app, collection_name, entity.get('uuid')))
+            for page in q:
+
+                edge_lookups = []
+
+                for entity in page.entities:
+                    try:
+                        counter += 1
+
+                        entity_file.write(entity)
+
+                        for edge_name in get_edge_names(entity):
+                            if include_edge(collection_name, edge_name):
+                                edge_lookups.append((entity, edge_name))
+
+                    except KeyboardInterrupt:
+                        raise
+
+                    except:
+                        logger.exception(
+                                'Error processing entity %s / %s / %s' % (app, collection_name, entity.get('uuid')))
+
+                # the edges of the whole page are fetched concurrently, map() returns them in the order of the lookups
+                edge_results = edge_pool.map(
+                        lambda (entity, edge_name): get_edge_target_uuids(app, collection_name, entity, edge_name),
+                        edge_lookups)
+
+                for (entity, edge_name), target_uuids in zip(edge_lookups, edge_results):
+                    if len(target_uuids) > 0:
+                        # the collection is written since the type of the entity is its singular name
+                        edges = {
+                            'entity': {
+                                'type': entity.get('type'),
+                                'uuid': entity.get('uuid')
+                            },
+                            'collection': collection_name,
+                            'edge_name': edge_name,
+                            'target_uuids': target_uuids
+                        }
+
+                        # edges are indexed by the created time of the source entity
+                        edge_file.write(edges, created=entity.get('created'))
+
+                update_status_map(status_map[collection_name], page)
+
+                if counter >= next_status_counter:
+                    next_status_counter += 1000
+
+                    try:
+                        collection_worker_logger.warning(
+                                'Sending incremental stats for app/collection [%s / %s]: %s' % (
+                                    app, collection_name, status_map))
+
+                        self.response_queue.put((app, collection_name, status_map))
+
+                        if QSIZE_OK:
+                            collection_worker_logger.info(
+                                    'Counter=%s, collection queue depth=%s' % (
+                                        counter, self.work_queue.qsize()))
+                    except:
+                        pass
+
+                    collection_worker_logger.warn(
+                            'Current status of collections processed: %s' % json.dumps(status_map))
 
         except KeyboardInterrupt:
             raise
@@ -497,15 +394,53 @@ class EntityExportWorker(Process):
             logger.exception('Error processing collection %s / %s ' % (app, collection_name))
 
         finally:
-            if edge_file is not None:
-                edge_file.close()
+            edge_pool.close()
+            edge_pool.join()
 
-            if entity_file is not None:
-                entity_file.close()
+            edge_file.close()
+            entity_file.close()
 
         return status_map
 
 
+def get_edge_target_uuids(app, collection_name, entity, edge_name):
+    connection_query_url = connection_query_url_template.format(
+            org=config.get('org'),
+            app=app,
+            verb=edge_name,
+            collection=collection_name,
+            uuid=entity.get('uuid'),
+            limit=config.get('limit'),
+            **config.get('source_endpoint'))
+
+    connection_query = UsergridPageIterator(connection_query_url, session=session_source).entities()
+
+    target_uuids = []
+
+    try:
+        for target_entity in connection_query:
+            target_uuids.append(target_entity.get('uuid'))
+    except:
+        logger.exception('Error processing edge [%s] of entity [ %s / %s / %s]' % (
+            edge_name, app, collection_name, entity.get('uuid')))
+
+    return target_uuids
+
+
+def get_export_writer(filename_base):
+    if config.get('format') == 'parquet':
+        return ParquetExportWriter(filename_base,
+                                   codec=config.get('codec'),
+                                   compression_level=config.get('compression_level'),
+                                   records_per_file=config.get('entities_per_file'),
+                                   row_group_size=config.get('row_group_size'))
+
+    return ExportWriter(filename_base,
+                        codec=config.get('codec'),
+                        compression_level=config.get('compression_level'),
+                        records_per_file=config.get('entities_per_file'))
+
+
 def use_name_for_collection(collection_name):
     return collection_name in config.get('use_name_for_collection', [])
 
@@ -648,11 +583,63 @@ def parse_args():
                         type=int,
                         default=10000)
 
+    parser.add_argument('--edge_concurrency',
+                        help='The number of edge (connection) queries each collection worker runs concurrently for '
+                             'the entities of a page',
+                        type=int,
+                        default=8)
+
+    parser.add_argument('--format',
+                        help='The format of the export files: JSON lines, or Parquet with a schema inferred per '
+                             'collection (requires pyarrow)',
+                        choices=FORMATS,
+                        default='json')
+
+    parser.add_argument('--row_group_size',
+                        help='The number of entities in each row group of a Parquet file',
+                        type=int,
+                        default=10000)
+
+    parser.add_argument('--codec',
+                        help='The compression of the export files.  Compressed files are written in independent chunks '
+                             'with an index of the entity count, byte range and created range of each chunk at the end',
+                        choices=CODECS,
+                        default='none')
+
+    parser.add_argument('--compression_level',
+                        help='The compression level for --codec, defaults to 6 for gzip and 3 for zstd',
+                        type=int)
+
     parser.add_argument('--error_retry_sleep',
                         help='The number of seconds to wait between retrieving after an error',
                         type=float,
                         default=30)
 
+    parser.add_argument('--max_retry_attempts',
+                        help='The max number of attempts for a request which fails with a retryable error, such as a '
+                             'connection error, 429 or 5xx',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--retry_base_delay',
+                        help='The cap in seconds on the random wait before the first retry, doubled for each retry '
+                             'up to --error_retry_sleep',
+                        type=float,
+                        default=0.5)
+
+    parser.add_argument('--retry_budget',
+                        help='The number of retries each worker process may make per request, so that workers stop '
+                             'retrying when most requests are failing',
+                        type=float,
+                        default=0.2)
+
+    add_http_arguments(parser)
+
+    parser.add_argument('--status_flush_interval',
+                        help='The number of seconds between updates of the status of the org',
+                        type=float,
+                        default=5)
+
     parser.add_argument('--page_sleep_time',
                         help='The number of seconds to wait between retrieving pages from the UsergridQueryIterator',
                         type=float,
@@ -680,6 +667,13 @@ def parse_args():
                         default='select * order by created asc')
     # default='select * order by created asc')
 
+    parser.add_argument('--collection_segments',
+                        help='The number of segments to split each collection into by created timestamp, so that '
+                             'multiple collection workers can export a single large collection in parallel.  Not '
+                             'used with --graph',
+                        type=int,
+                        default=1)
+
     parser.add_argument('--nohup',
                         help='specifies not to use stdout for logging',
                         action='store_true')
@@ -695,7 +689,7 @@ def parse_args():
 
 
 def init():
-    global config
+    global config, token_manager
 
     config['collection_mapping'] = {}
     config['app_mapping'] = {}
@@ -707,9 +701,63 @@ def init():
     if config['exclude_collection'] is None:
         config['exclude_collection'] = []
 
+    # the parquet format compresses with the zstd built into pyarrow
+    if config.get('codec') == 'zstd' and config.get('format') == 'json':
+
+        try:
+            import zstandard
+
+        except ImportError:
+            message = 'ABORT: In order to use the zstd codec, zstandard is required (pip install zstandard)'
+            print message
+            logger.critical(message)
+            exit()
+
+    if config.get('http2') and not HTTP2_AVAILABLE:
+        message = 'ABORT: In order to use HTTP/2, hyper is required (pip install hyper)'
+        print message
+        logger.critical(message)
+        exit()
+
+    if config.get('format') == 'parquet':
+
+        try:
+            import pyarrow.parquet
+
+        except ImportError:
+            message = 'ABORT: In order to use the parquet format, pyarrow is required (pip install pyarrow)'
+            print message
+            logger.critical(message)
+            exit()
+
+    configure_retry_policy(max_attempts=config.get('max_retry_attempts'),
+                           base_delay=config.get('retry_base_delay'),
+                           max_delay=config.get('error_retry_sleep'),
+                           budget_ratio=config.get('retry_budget'))
+
+    configure_http_client_from_args(config)
+
     config['source_endpoint'] = config['source_config'].get('endpoint').copy()
     config['source_endpoint'].update(config['source_config']['credentials'][config['org']])
 
+    # registered before the worker processes are started so that they share the token
+    token_manager = TokenManager()
+    token_manager.register('source', config['source_endpoint'])
+
+    init_sessions()
+
+
+def init_sessions():
+    global session_source
+
+    # called again by each worker process after the fork, so that no process shares the pooled keep-alive connections
+    # of another, including those of the session the token is requested with
+    token_manager.reset_session()
+
+    # the edge queries of a page run concurrently on the same session
+    session_source = get_session(pool_size=max(config.get('http_pool_size'), config.get('edge_concurrency')))
+    session_source.auth = BearerAuth(token_manager, 'source')
+
 
 def wait_for(threads, label, sleep_time=60):
     wait = True
@@ -734,15 +782,21 @@ def wait_for(threads, label, sleep_time=60):
     logger.warn('All workers [%s] done!' % label)
 
 
-def count_bytes(entity):
-    entity_copy = entity.copy()
+def update_status_map(collection_status, page):
+    # the bytes are those of the response body the page was parsed from, so the entities are not serialized again
+    collection_status['bytes'] += page.byte_count
+    collection_status['count'] += len(page.entities)
 
-    if 'metadata' in entity_copy:
-        del entity_copy['metadata']
+    for field in ['created', 'modified']:
+        min_value, max_value = page.get_range(field)
 
-    entity_str = json.dumps(entity_copy)
+        if max_value is not None and max_value > collection_status['max_%s' % field]:
+            collection_status['max_%s' % field] = max_value
+            collection_status['max_%s_str' % field] = str(datetime.datetime.fromtimestamp(max_value / 1000))
 
-    return len(entity_str)
+        if min_value is not None and min_value < collection_status['min_%s' % field]:
+            collection_status['min_%s' % field] = min_value
+            collection_status['min_%s_str' % field] = str(datetime.datetime.fromtimestamp(min_value / 1000))
 
 
 def check_response_status(r, url, exit_on_error=True):
@@ -754,6 +808,27 @@ def check_response_status(r, url, exit_on_error=True):
             exit()
 
 
+def get_segments(app, collection_name):
+    # segments are windows of a query, so a collection iterated using the graph is always exported as a whole
+    if config.get('graph', False) or config.get('collection_segments') <= 1:
+        return [None]
+
+    def url_for_ql(ql):
+        return collection_query_url_template.format(org=config.get('org'),
+                                                    app=app,
+                                                    collection=collection_name,
+                                                    limit=1,
+                                                    ql=ql,
+                                                    **config.get('source_endpoint'))
+
+    segments = get_collection_segments(session_source, url_for_ql, config.get('collection_segments'))
+
+    if segments[0] is not None:
+        logger.info('Split app/collection [%s / %s] into segments: %s' % (app, collection_name, segments))
+
+    return segments
+
+
 def main():
     global config
 
@@ -777,7 +852,7 @@ def main():
         try:
             # list the apps for the SOURCE org
             logger.info('GET %s' % source_org_mgmt_url)
-            r = session_source.get(source_org_mgmt_url)
+            r = get_retry_policy().request(session_source.get, source_org_mgmt_url)
 
             if r.status_code != 200:
                 logger.critical(
@@ -849,20 +924,11 @@ def main():
                                                      **config.get('source_endpoint'))
             logger.info('GET %s' % source_app_url)
 
-            r_collections = session_source.get(source_app_url)
+            r_collections = get_retry_policy().request(session_source.get, source_app_url)
 
-            collection_attempts = 0
-
-            # sometimes this call was not working so I put it in a loop to force it...
-            while r_collections.status_code != 200 and collection_attempts < 5:
-                collection_attempts += 1
-                logger.warning('FAILED: GET (%s) [%s] URL: %s' % (r_collections.elapsed, r_collections.status_code,
-                                                                  source_app_url))
-                time.sleep(DEFAULT_RETRY_SLEEP)
-                r_collections = session_source.get(source_app_url)
-
-            if collection_attempts >= 5:
-                logger.critical('Unable to get collections at URL %s, skipping app' % source_app_url)
+            if r_collections.status_code != 200:
+                logger.critical('Unable to get collections at URL %s, skipping app: [%s] %s' % (
+                    source_app_url, r_collections.status_code, r_collections.text))
                 continue
 
             app_response = r_collections.json()
@@ -892,9 +958,13 @@ def main():
 
                         continue
 
-                    logger.info('Publishing app / collection: %s / %s' % (app, collection_name))
+                    segments = get_segments(app, collection_name)
+
+                    logger.info('Publishing app / collection: %s / %s in [%s] segment(s)' % (
+                        app, collection_name, len(segments)))
 
-                    collection_queue.put((app, collection_name))
+                    for segment in segments:
+                        collection_queue.put((app, collection_name, segment))
 
             status_map[app]['iteration_finished'] = str(datetime.datetime.now())
 
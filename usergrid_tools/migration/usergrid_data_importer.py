@@ -0,0 +1,586 @@
+import os
+import re
+import uuid
+from Queue import Empty
+import argparse
+import json
+import logging
+import sys
+from multiprocessing import Queue, Process
+from multiprocessing.pool import ThreadPool
+
+from cloghandler import ConcurrentRotatingFileHandler
+import requests
+import traceback
+import time
+import signal
+import urllib3
+
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats, HTTP2_AVAILABLE
+from usergrid_tools.general.token_manager import BearerAuth, TokenManager
+from usergrid_tools.general.retry import configure_retry_policy, get_retry_policy
+from usergrid_tools.migration.export_writer import read_export_batches
+from usergrid_tools.migration.state_store import FileCheckpointStore
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+ECID = str(uuid.uuid4())
+
+logger = logging.getLogger('DataImporter')
+worker_logger = logging.getLogger('FileWorker')
+
+urllib3.disable_warnings()
+
+session_target = requests.Session()
+
+# gets the access tokens sent in place of the client credentials, shared by the worker processes
+token_manager = None
+
+checkpoint_store = None
+
+config = {}
+
+# the files written by usergrid_data_exporter: <collection>[_<segment>]_<entity|edge>-data-<n>.<txt|txt.gz|txt.zst>
+export_file_pattern = re.compile(r'^(?P<prefix>.+)_(?P<kind>entity|edge)-data-(?P<number>\d+)\.(txt|txt\.gz|txt\.zst)$')
+
+put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
+connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}"
+
+ignore_collections = ['activities', 'queues', 'events', 'notifications']
+
+
+def init_logging(stdout_enabled=True):
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.getLevelName(config.get('log_level', 'INFO')))
+
+    logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.ERROR)
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.WARN)
+
+    log_formatter = logging.Formatter(
+            fmt='%(asctime)s | ' + ECID + ' | %(name)s | %(processName)s | %(levelname)s | %(message)s',
+            datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if stdout_enabled:
+        stdout_logger = logging.StreamHandler(sys.stdout)
+        stdout_logger.setFormatter(log_formatter)
+        stdout_logger.setLevel(logging.getLevelName(config.get('log_level', 'INFO')))
+        root_logger.addHandler(stdout_logger)
+
+    log_file_name = os.path.join(config.get('log_dir'), '%s-import-%s-importer.log' % (config.get('org'), ECID))
+
+    rotating_file = ConcurrentRotatingFileHandler(filename=log_file_name,
+                                                  mode='a',
+                                                  maxBytes=404857600,
+                                                  backupCount=0)
+    rotating_file.setFormatter(log_formatter)
+    rotating_file.setLevel(logging.INFO)
+
+    root_logger.addHandler(rotating_file)
+
+    error_log_file_name = os.path.join(config.get('log_dir'),
+                                       '%s-import-%s-importer-errors.log' % (config.get('org'), ECID))
+
+    error_rotating_file = ConcurrentRotatingFileHandler(filename=error_log_file_name,
+                                                        mode='a',
+                                                        maxBytes=404857600,
+                                                        backupCount=0)
+    error_rotating_file.setFormatter(log_formatter)
+    error_rotating_file.setLevel(logging.ERROR)
+
+    root_logger.addHandler(error_rotating_file)
+
+
+class FileWorker(Process):
+    """
+    Imports export files taken from the work queue.  The records of each file are read in batches and written to the
+    target by a pool of threads, and the offset of the file is checkpointed after each batch.
+    """
+
+    def __init__(self, work_queue, response_queue):
+        super(FileWorker, self).__init__()
+        self.work_queue = work_queue
+        self.response_queue = response_queue
+
+    def run(self):
+        init_session()
+
+        pool = ThreadPool(config.get('write_concurrency'))
+        keep_going = True
+
+        try:
+            while keep_going:
+                work = self.work_queue.get()
+
+                # each worker is sent one None after the files
+                if work is None:
+                    keep_going = False
+                    continue
+
+                app, kind, path = work
+
+                try:
+                    success, failure = self.process_file(pool, app, kind, path)
+                    self.response_queue.put((app, kind, path, success, failure))
+
+                except KeyboardInterrupt:
+                    raise
+
+                except:
+                    logger.exception('Error importing file [%s]' % path)
+                    self.response_queue.put((app, kind, path, 0, 0))
+
+        finally:
+            pool.close()
+            pool.join()
+
+            log_connection_stats('target', session_target, worker_logger)
+            checkpoint_store.close()
+
+    def process_file(self, pool, app, kind, path):
+        checkpoint = checkpoint_store.get(path)
+        offset = 0
+        count = 0
+
+        if checkpoint is not None:
+            if checkpoint['complete']:
+                worker_logger.info('Skipping completed file [%s]' % path)
+                return 0, 0
+
+            offset = checkpoint['offset']
+            count = checkpoint['count']
+
+            worker_logger.info('Resuming file [%s] at offset [%s] after [%s] records' % (path, offset, count))
+
+        success = 0
+        failure = 0
+
+        for records, next_offset in read_export_batches(path, offset=offset, batch_size=config.get('batch_size')):
+            if kind == 'entity':
+                results = pool.map(lambda entity: import_entity(app, entity), records)
+
+            else:
+                # one request per edge, so the edges of an entity with many targets are spread over the pool
+                edges = [(record, target_uuid) for record in records for target_uuid in record.get('target_uuids', [])]
+                results = pool.map(lambda (record, target_uuid): import_edge(app, record, target_uuid), edges)
+
+            success += len([result for result in results if result])
+            failure += len([result for result in results if not result])
+            count += len(records)
+            offset = next_offset
+
+            checkpoint_store.save(path, offset, count)
+
+        checkpoint_store.save(path, offset, count, complete=True)
+
+        worker_logger.info('Finished file [%s]: success=[%s] failure=[%s]' % (path, success, failure))
+
+        return success, failure
+
+
+def init_session():
+    global session_target
+
+    # each worker process opens its own connections, including those of the session the token is requested with
+    token_manager.reset_session()
+
+    # the connection pool is sized to the number of writer threads so that connections are reused rather than
+    # discarded when the pool is full
+    session_target = get_session(pool_size=max(config.get('http_pool_size'), config.get('write_concurrency')))
+    session_target.auth = BearerAuth(token_manager, 'target')
+
+
+def get_target_mapping(app, collection_name):
+    target_org = config.get('org_mapping', {}).get(config.get('org'), config.get('org'))
+    target_app = config.get('app_mapping', {}).get(app, app)
+    target_collection = config.get('collection_mapping', {}).get(collection_name, collection_name)
+    return target_app, target_collection, target_org
+
+
+def get_collection_name(entity):
+    # the collection is taken from the path of the entity since the file name does not say if it has a segment suffix
+    path = entity.get('metadata', {}).get('path')
+
+    if path is not None and len(path.strip('/').split('/')) >= 2:
+        return path.strip('/').split('/')[-2]
+
+    if entity.get('type') == 'user':
+        return 'users'
+
+    return entity.get('type')
+
+
+def include_collection(collection_name):
+    if collection_name in ignore_collections:
+        return False
+
+    if len(config.get('collection')) > 0 and collection_name not in config.get('collection'):
+        return False
+
+    return collection_name not in config.get('exclude_collection')
+
+
+def import_entity(app, entity):
+    collection_name = get_collection_name(entity)
+
+    if not include_collection(collection_name):
+        return True
+
+    target_app, target_collection, target_org = get_target_mapping(app, collection_name)
+
+    entity_copy = entity.copy()
+
+    if 'metadata' in entity_copy:
+        entity_copy.pop('metadata')
+
+    url = put_entity_url_template.format(org=target_org,
+                                         app=target_app,
+                                         collection=target_collection,
+                                         uuid=entity.get('uuid'),
+                                         **config.get('target_endpoint'))
+
+    try:
+        r = get_retry_policy().request(session_target.put, url, data=json.dumps(entity_copy))
+
+    except Exception:
+        logger.exception('Error importing entity [%s / %s / %s]' % (app, collection_name, entity.get('uuid')))
+        return False
+
+    if r.status_code != 200:
+        logger.error('Failure [%s] to PUT entity [%s / %s / %s] at URL=[%s]: %s' % (
+            r.status_code, app, collection_name, entity.get('uuid'), url, r.text))
+        return False
+
+    return True
+
+
+def import_edge(app, record, target_uuid):
+    source_entity = record.get('entity', {})
+
+    # exports made before the collection was written with the edges only have the type of the entity
+    collection_name = record.get('collection') or get_collection_name(source_entity)
+
+    if not include_collection(collection_name):
+        return True
+
+    target_app, target_collection, target_org = get_target_mapping(app, collection_name)
+
+    url = connection_create_by_uuid_url_template.format(org=target_org,
+                                                        app=target_app,
+                                                        collection=target_collection,
+                                                        uuid=source_entity.get('uuid'),
+                                                        verb=record.get('edge_name'),
+                                                        target_uuid=target_uuid,
+                                                        **config.get('target_endpoint'))
+
+    try:
+        r = get_retry_policy().request(session_target.post, url)
+
+    except Exception:
+        logger.exception('Error importing edge [%s / %s / %s] --[%s]--> [%s]' % (
+            app, collection_name, source_entity.get('uuid'), record.get('edge_name'), target_uuid))
+        return False
+
+    if r.status_code != 200:
+        logger.error('Failure [%s] to create edge at URL=[%s]: %s' % (r.status_code, url, r.text))
+        return False
+
+    return True
+
+
+def find_export_files(kind):
+    """
+    :return: a list of (app, kind, path) of the files of the given kind in the export of the org
+    """
+    org_path = os.path.join(config.get('import_path'), config.get('org'))
+    apps_to_process = config.get('app')
+    files = []
+
+    for app in sorted(os.listdir(org_path)):
+        app_path = os.path.join(org_path, app)
+
+        if not os.path.isdir(app_path):
+            continue
+
+        if apps_to_process and app not in apps_to_process:
+            logger.warning('Skipping app [%s] not included in process list [%s]' % (app, apps_to_process))
+            continue
+
+        for file_name in sorted(os.listdir(app_path)):
+            match = export_file_pattern.match(file_name)
+
+            if match is not None and match.group('kind') == kind:
+                files.append((app, kind, os.path.join(app_path, file_name)))
+
+    return files
+
+
+def import_files(files):
+    """
+    Imports the files with --file_workers processes and waits for them to finish
+
+    :return: the total (success, failure) count of the files
+    """
+    work_queue = Queue()
+    response_queue = Queue()
+
+    workers = [FileWorker(work_queue, response_queue) for x in xrange(min(config.get('file_workers'), len(files)))]
+
+    for work in files + [None] * len(workers):
+        work_queue.put(work)
+
+    [w.start() for w in workers]
+
+    success = 0
+    failure = 0
+    finished = 0
+
+    try:
+        while finished < len(files):
+            try:
+                app, kind, path, file_success, file_failure = response_queue.get(timeout=30)
+
+            except Empty:
+                if not any(w.is_alive() for w in workers):
+                    logger.critical('All workers exited with [%s] of [%s] files finished' % (finished, len(files)))
+                    break
+
+                continue
+
+            finished += 1
+            success += file_success
+            failure += file_failure
+
+            logger.info('Finished [%s] of [%s] files, success=[%s] failure=[%s]' % (
+                finished, len(files), success, failure))
+
+        [w.join() for w in workers]
+
+    except KeyboardInterrupt:
+        logger.warning('Keyboard Interrupt, aborting...')
+
+        [os.kill(super(FileWorker, p).pid, signal.SIGINT) for p in workers]
+        [w.terminate() for w in workers]
+
+        raise
+
+    return success, failure
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Usergrid Org/App Data Importer')
+
+    parser.add_argument('--log_dir',
+                        help='path to the place where logs will be written',
+                        default='./',
+                        type=str,
+                        required=False)
+
+    parser.add_argument('--log_level',
+                        help='log level - DEBUG, INFO, WARN, ERROR, CRITICAL',
+                        default='INFO',
+                        type=str,
+                        required=False)
+
+    parser.add_argument('-o', '--org',
+                        help='Name of the org in the export to import',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-a', '--app',
+                        help='Name of one or more apps to include, specify none to include all apps',
+                        required=False,
+                        action='append')
+
+    parser.add_argument('-c', '--collection',
+                        help='Name of one or more collections to include, specify none to include all collections',
+                        default=[],
+                        action='append')
+
+    parser.add_argument('--exclude_collection',
+                        help='Name of one or more collections to EXCLUDE, specify none to include all collections',
+                        default=[],
+                        action='append')
+
+    parser.add_argument('-i', '--import_path',
+                        help='The path of one export, the directory named with the ECID of the export run which '
+                             'contains the org directory',
+                        type=str,
+                        required=True)
+
+    parser.add_argument('-d', '--target_config',
+                        help='The path to the target endpoint/org configuration file',
+                        type=str,
+                        default='destination.json')
+
+    parser.add_argument('-m', '--migrate',
+                        help='Specifies what to import: data, graph (data then edges) or edges',
+                        type=str,
+                        choices=['data', 'graph', 'edges'],
+                        default='graph')
+
+    parser.add_argument('--file_workers',
+                        help='The number of worker processes, each imports one file at a time',
+                        type=int,
+                        default=4)
+
+    parser.add_argument('--write_concurrency',
+                        help='The number of concurrent requests to the target per file worker',
+                        type=int,
+                        default=16)
+
+    parser.add_argument('--batch_size',
+                        help='The number of records of an uncompressed file to write between checkpoints.  '
+                             'Compressed files are checkpointed after each chunk',
+                        type=int,
+                        default=100)
+
+    parser.add_argument('--resume',
+                        help='The ECID of an interrupted import to continue from its file checkpoints',
+                        type=str)
+
+    parser.add_argument('--error_retry_sleep',
+                        help='The max number of seconds to wait before retrying a request after an error',
+                        type=float,
+                        default=30)
+
+    parser.add_argument('--max_retry_attempts',
+                        help='The max number of attempts for a request which fails with a retryable error, such as a '
+                             'connection error, 429 or 5xx',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--retry_base_delay',
+                        help='The cap in seconds on the random wait before the first retry, doubled for each retry '
+                             'up to --error_retry_sleep',
+                        type=float,
+                        default=0.5)
+
+    parser.add_argument('--retry_budget',
+                        help='The number of retries each worker process may make per request, so that workers stop '
+                             'retrying when most requests are failing',
+                        type=float,
+                        default=0.2)
+
+    add_http_arguments(parser)
+
+    parser.add_argument('--map_app',
+                        help="Multiple allowed: A colon-separated string such as 'apples:oranges' which indicates to"
+                             " put data from the app named 'apples' in the export into app named 'oranges' "
+                             "in the target endpoint",
+                        default=[],
+                        action='append')
+
+    parser.add_argument('--map_collection',
+                        help="One or more colon-separated string such as 'cats:dogs' which indicates to put data from "
+                             "collections named 'cats' in the export into a collection named 'dogs' in the "
+                             "target endpoint, applicable globally to all apps",
+                        default=[],
+                        action='append')
+
+    parser.add_argument('--map_org',
+                        help="One or more colon-separated strings such as 'red:blue' which indicates to put data from "
+                             "org named 'red' in the export into an org named 'blue' in the target endpoint",
+                        default=[],
+                        action='append')
+
+    parser.add_argument('--nohup',
+                        help='specifies not to use stdout for logging',
+                        action='store_true')
+
+    my_args = parser.parse_args(sys.argv[1:])
+
+    return vars(my_args)
+
+
+def init():
+    global config, checkpoint_store, token_manager, ECID
+
+    if config.get('http2') and not HTTP2_AVAILABLE:
+        message = 'ABORT: In order to use HTTP/2, hyper is required (pip install hyper)'
+        print message
+        logger.critical(message)
+        exit()
+
+    config['collection_mapping'] = {}
+    config['app_mapping'] = {}
+    config['org_mapping'] = {}
+
+    for mapping_type in ['collection', 'app', 'org']:
+        for mapping in config.get('map_%s' % mapping_type, []):
+            parts = mapping.split(':')
+
+            if len(parts) == 2:
+                config['%s_mapping' % mapping_type][parts[0]] = parts[1]
+            else:
+                logger.warning('Skipping %s mapping: [%s]' % (mapping_type, mapping))
+
+    with open(config.get('target_config'), 'r') as f:
+        config['target_config'] = json.load(f)
+
+    target_org = config['org_mapping'].get(config['org'], config['org'])
+
+    config['target_endpoint'] = config['target_config'].get('endpoint').copy()
+    config['target_endpoint'].update(config['target_config']['credentials'][target_org])
+
+    configure_retry_policy(max_attempts=config.get('max_retry_attempts'),
+                           base_delay=config.get('retry_base_delay'),
+                           max_delay=config.get('error_retry_sleep'),
+                           budget_ratio=config.get('retry_budget'))
+
+    configure_http_client_from_args(config)
+
+    # registered before the worker processes are started so that they share the token
+    token_manager = TokenManager()
+    token_manager.register('target', config['target_endpoint'])
+
+    if config.get('resume') is not None:
+        ECID = config.get('resume')
+
+    checkpoint_store = FileCheckpointStore(
+            os.path.join(config.get('log_dir'), '%s-import-%s-checkpoint.db' % (config.get('org'), ECID)))
+
+
+def main():
+    global config
+
+    config = parse_args()
+    init()
+    init_logging(stdout_enabled=not config.get('nohup'))
+
+    org_path = os.path.join(config.get('import_path'), config.get('org'))
+
+    if not os.path.isdir(org_path):
+        message = 'ABORT: No export of org [%s] found at [%s]' % (config.get('org'), org_path)
+        print message
+        logger.critical(message)
+        exit()
+
+    # edges can only be created once both of their entities exist, so all entities are imported first
+    kinds = {
+        'data': ['entity'],
+        'graph': ['entity', 'edge'],
+        'edges': ['edge']
+    }[config.get('migrate')]
+
+    for kind in kinds:
+        files = find_export_files(kind)
+
+        logger.info('Importing [%s] [%s] files from [%s]' % (len(files), kind, org_path))
+
+        if len(files) == 0:
+            continue
+
+        start_time = time.time()
+        success, failure = import_files(files)
+
+        logger.warn('Imported [%s] files: success=[%s] failure=[%s] in [%.1f]s' % (
+            kind, success, failure, time.time() - start_time))
+
+    checkpoint_store.close()
+
+    logger.info('Import DONE!')
+
+
+if __name__ == "__main__":
+    main()
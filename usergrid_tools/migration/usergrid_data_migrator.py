@@ -1,11 +1,12 @@
 import os
 import uuid
-from Queue import Empty
+from Queue import Empty, Full
 import argparse
 import json
 import logging
 import sys
 from multiprocessing import Queue, Process
+from multiprocessing.pool import ThreadPool
 from sets import Set
 
 import time_uuid
@@ -19,10 +20,28 @@ import time
 from sys import platform as _platform
 
 import signal
+import threading
+from collections import deque
+import urlparse
 
 from requests.auth import HTTPBasicAuth
-from usergrid import UsergridQueryIterator
 import urllib3
+import hashlib
+
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats, HTTP2_AVAILABLE
+from usergrid_tools.general.token_manager import BearerAuth, TokenManager
+from usergrid_tools.general.retry import configure_retry_policy, get_retry_policy, is_retryable_exception, \
+    is_retryable_status
+from usergrid_tools.iterators.usergrid_page_iterator import UsergridPageIterator
+from usergrid_tools.migration.segments import get_checkpoint_name, get_collection_segments, get_segment_ql
+from usergrid_tools.migration.metrics import MetricsListener, MetricsRecorder
+from usergrid_tools.migration.rate_controller import RateControlledAdapter, RateController
+from usergrid_tools.migration.state_store import CheckpointStore, DigestStore
+from usergrid_tools.migration.uuid_set import UuidSet
+from usergrid_tools.migration.status import StatusAggregator, write_status_file
+from usergrid_tools.migration.bloom_filter import SharedBloomFilter
+from usergrid_tools.migration.visit_cache import BloomVisitCache, VisitCache
 
 __author__ = 'Jeff West @ ApigeeCorporation'
 
@@ -39,7 +58,6 @@ status_logger = logging.getLogger('StatusLogger')
 urllib3.disable_warnings()
 
 DEFAULT_CREATE_APPS = False
-DEFAULT_RETRY_SLEEP = 10
 DEFAULT_PROCESSING_SLEEP = 1
 
 queue = Queue()
@@ -54,8 +72,31 @@ except:
 session_source = requests.Session()
 session_target = requests.Session()
 
+# gets the access tokens sent in place of the client credentials, shared by the worker processes
+token_manager = None
+
 cache = None
 
+# the digests of the credentials last put to the target, which lets a re-run skip the users which have not changed
+digest_store = None
+
+# the cache of the keys visited in this run, which is the Redis cache unless --visited_set is bloom
+visit_cache = None
+
+# the thread pools which write edges, credentials and permissions concurrently, by name
+thread_pools = {}
+
+checkpoint_store = None
+rate_controller = None
+
+# the entity queue, which migrate_graph publishes the entities it discovers to, and the entities of this process which
+# did not fit on it
+graph_frontier = None
+local_frontier = deque()
+
+# records nothing unless --metrics_port is set
+metrics = MetricsRecorder()
+
 
 def total_seconds(td):
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10 ** 6) / 10 ** 6
@@ -116,24 +157,24 @@ entity_name_map = {
 config = {}
 
 # URL Templates for Usergrid
-org_management_app_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_management_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_url_template = "{api_url}/{org}?client_id={client_id}&client_secret={client_secret}"
-app_url_template = "{api_url}/{org}/{app}?client_id={client_id}&client_secret={client_secret}"
-collection_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}"
-collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&client_id={client_id}&client_secret={client_secret}&limit={limit}"
-collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}&limit={limit}"
-connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}?client_id={client_id}&client_secret={client_secret}"
-connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}?client_id={client_id}&client_secret={client_secret}"
-
-connection_create_by_pairs_url_template = "{api_url}/{org}/{app}/{source_type_id}/{verb}/{target_type_id}?client_id={client_id}&client_secret={client_secret}"
-
-get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}&connections=none"
-get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
-put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
-permissions_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/permissions?client_id={client_id}&client_secret={client_secret}"
+org_management_app_url_template = "{api_url}/management/organizations/{org}/applications"
+org_management_url_template = "{api_url}/management/organizations/{org}/applications"
+org_url_template = "{api_url}/{org}"
+app_url_template = "{api_url}/{org}/{app}"
+collection_url_template = "{api_url}/{org}/{app}/{collection}"
+collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&limit={limit}"
+collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?limit={limit}"
+connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}"
+connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}"
+connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}"
+connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}"
+
+connection_create_by_pairs_url_template = "{api_url}/{org}/{app}/{source_type_id}/{verb}/{target_type_id}"
+
+get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?connections=none"
+get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
+put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
+permissions_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/permissions"
 
 user_credentials_url_template = "{api_url}/{org}/{app}/users/{uuid}/credentials"
 
@@ -149,12 +190,12 @@ class StatusListener(Process):
     def run(self):
         keep_going = True
 
-        org_results = {
-            'name': config.get('org'),
-            'apps': {},
-        }
+        aggregator = StatusAggregator(config.get('org'))
+        org_results = aggregator.org_results
 
         empty_count = 0
+        last_received = time.time()
+        last_flush = time.time()
 
         status_file_name = os.path.join(config.get('log_dir'),
                                         '%s-%s-%s-status.json' % (config.get('org'), config.get('migrate'), ECID))
@@ -162,176 +203,165 @@ class StatusListener(Process):
         while keep_going:
 
             try:
-                app, collection, status_map = self.status_queue.get(timeout=60)
+                app, collection, status_map = self.status_queue.get(timeout=1)
                 status_logger.info('Received status update for app/collection: [%s / %s]' % (app, collection))
                 empty_count = 0
-                org_results['summary'] = {
-                    'max_created': -1,
-                    'max_modified': -1,
-                    'min_created': 1584946416000,
-                    'min_modified': 1584946416000,
-                    'count': 0,
-                    'bytes': 0
-                }
-
-                if app not in org_results['apps']:
-                    org_results['apps'][app] = {
-                        'collections': {}
-                    }
-
-                org_results['apps'][app]['collections'].update(status_map)
-
-                try:
-                    for app, app_data in org_results['apps'].iteritems():
-                        app_data['summary'] = {
-                            'max_created': -1,
-                            'max_modified': -1,
-                            'min_created': 1584946416000,
-                            'min_modified': 1584946416000,
-                            'count': 0,
-                            'bytes': 0
-                        }
-
-                        if 'collections' in app_data:
-                            for collection, collection_data in app_data['collections'].iteritems():
+                last_received = time.time()
 
-                                app_data['summary']['count'] += collection_data['count']
-                                app_data['summary']['bytes'] += collection_data['bytes']
+                for collection_name, collection_status in status_map.iteritems():
+                    aggregator.apply(app, collection_name, collection_status)
 
-                                org_results['summary']['count'] += collection_data['count']
-                                org_results['summary']['bytes'] += collection_data['bytes']
-
-                                # APP
-                                if collection_data.get('max_modified') > app_data['summary']['max_modified']:
-                                    app_data['summary']['max_modified'] = collection_data.get('max_modified')
+            except KeyboardInterrupt, e:
+                status_logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
+                raise e
 
-                                if collection_data.get('min_modified') < app_data['summary']['min_modified']:
-                                    app_data['summary']['min_modified'] = collection_data.get('min_modified')
+            except Empty:
+                idle_time = time.time() - last_received
 
-                                if collection_data.get('max_created') > app_data['summary']['max_created']:
-                                    app_data['summary']['max_created'] = collection_data.get('max_created')
+                if idle_time >= 60 * (empty_count + 1):
+                    if QSIZE_OK:
+                        status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
 
-                                if collection_data.get('min_created') < app_data['summary']['min_created']:
-                                    app_data['summary']['min_created'] = collection_data.get('min_created')
+                    status_logger.warn('CURRENT status of org processed: %s' % json.dumps(org_results))
 
-                                # ORG
-                                if collection_data.get('max_modified') > org_results['summary']['max_modified']:
-                                    org_results['summary']['max_modified'] = collection_data.get('max_modified')
+                    status_logger.warning('EMPTY! Count=%s' % empty_count)
 
-                                if collection_data.get('min_modified') < org_results['summary']['min_modified']:
-                                    org_results['summary']['min_modified'] = collection_data.get('min_modified')
+                    empty_count += 1
 
-                                if collection_data.get('max_created') > org_results['summary']['max_created']:
-                                    org_results['summary']['max_created'] = collection_data.get('max_created')
+                    if empty_count >= 120:
+                        keep_going = False
 
-                                if collection_data.get('min_created') < org_results['summary']['min_created']:
-                                    org_results['summary']['min_created'] = collection_data.get('min_created')
+            except:
+                print traceback.format_exc()
 
-                        if QSIZE_OK:
-                            status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
+            # the status is written on a timer rather than for every message, the workers send one per page
+            if aggregator.dirty and time.time() - last_flush >= config.get('status_flush_interval'):
+                last_flush = time.time()
+                self.flush_status(aggregator, status_file_name)
 
-                        status_logger.warn('UPDATED status of org processed: %s' % json.dumps(org_results))
+        logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
 
-                        try:
-                            logger.info('Writing status to file: %s' % status_file_name)
+        logger.info('Writing final status to file: %s' % status_file_name)
+        self.flush_status(aggregator, status_file_name)
 
-                            with open(status_file_name, 'w') as f:
-                                json.dump(org_results, f, indent=2)
-                        except:
-                            print traceback.format_exc()
+    def flush_status(self, aggregator, status_file_name):
+        aggregator.dirty = False
+        org_results = aggregator.org_results
 
-                except KeyboardInterrupt, e:
-                    raise e
+        if QSIZE_OK:
+            status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
 
-                except:
-                    print traceback.format_exc()
+        if rate_controller is not None:
+            org_results['rate_controller'] = rate_controller.get_state()
 
-            except KeyboardInterrupt, e:
-                status_logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
-                raise e
+        status_logger.warn('UPDATED status of org processed: %s' % json.dumps(org_results))
 
-            except Empty:
-                if QSIZE_OK:
-                    status_logger.warn('CURRENT Queue Depth: %s' % self.worker_queue.qsize())
+        try:
+            logger.info('Writing status to file: %s' % status_file_name)
+            write_status_file(status_file_name, org_results)
+        except:
+            print traceback.format_exc()
 
-                status_logger.warn('CURRENT status of org processed: %s' % json.dumps(org_results))
 
-                status_logger.warning('EMPTY! Count=%s' % empty_count)
+class HostLimitedAdapter(RateControlledAdapter):
+    """
+    An HTTPAdapter which caps the number of requests in flight to any one host.  This is used by the async engine so
+    that hundreds of coroutines in one worker process do not all land on the same host at once.
+    """
 
-                empty_count += 1
+    def __init__(self, host_limit, rate_controller, *args, **kwargs):
+        self.host_limit = host_limit
+        self.host_semaphores = {}
+        self.semaphore_lock = threading.Lock()
+        super(HostLimitedAdapter, self).__init__(rate_controller, *args, **kwargs)
 
-                if empty_count >= 120:
-                    keep_going = False
+    def get_host_semaphore(self, url):
+        host = urlparse.urlparse(url).netloc
 
-            except:
-                print traceback.format_exc()
+        with self.semaphore_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_limit)
 
-        logger.warn('FINAL status of org processed: %s' % json.dumps(org_results))
+            return self.host_semaphores[host]
 
-        try:
-            logger.info('Writing final status to file: %s' % status_file_name)
-            with open(status_file_name, 'w') as f:
-                json.dump(org_results, f, indent=2)
-        except:
-            print traceback.format_exc()
+    def send(self, request, **kwargs):
+        with self.get_host_semaphore(request.url):
+            return super(HostLimitedAdapter, self).send(request, **kwargs)
 
 
 class EntityWorker(Process):
-    def __init__(self, queue, handler_function):
+    def __init__(self, queue, handler_function, page_handler_function=None):
         super(EntityWorker, self).__init__()
 
         worker_logger.debug('Creating worker!')
         self.queue = queue
         self.handler_function = handler_function
 
+        # an operation which handles a whole page of entities at once, used in place of the handler if specified
+        self.page_handler_function = page_handler_function
+        self.count_processed = 0
+        self.start_time = int(time.time())
+
     def run(self):
 
         worker_logger.info('starting run()...')
-        keep_going = True
 
-        count_processed = 0
-        empty_count = 0
-        start_time = int(time.time())
+        init_sessions()
 
-        while keep_going:
+        self.start_time = int(time.time())
 
-            try:
-                # get an entity with the app and collection name
-                app, collection_name, entity = self.queue.get(timeout=120)
-                empty_count = 0
+        metrics.register_collector(self.collect_metrics)
 
-                # if entity.get('type') == 'user':
-                #     entity = confirm_user_entity(app, entity)
+        try:
+            if config.get('engine') == 'async':
+                self.run_async()
+            else:
+                self.run_blocking()
 
-                # the handler operation is the specified operation such as migrate_graph
-                if self.handler_function is not None:
-                    try:
-                        message_start_time = int(time.time())
-                        processed = self.handler_function(app, collection_name, entity)
-                        message_end_time = int(time.time())
+        finally:
+            if not config.get('skip_cache_write', False):
+                cache.flush()
 
-                        if processed:
-                            count_processed += 1
+            worker_logger.info('Visit cache stats: %s' % json.dumps(cache.stats()))
 
-                            total_time = message_end_time - start_time
-                            avg_time_per_message = total_time / count_processed
-                            message_time = message_end_time - message_start_time
+            if visit_cache is not cache:
+                worker_logger.info('Visited set stats: %s' % json.dumps(visit_cache.stats()))
 
-                            worker_logger.debug('Processed [%sth] entity = %s / %s / %s' % (
-                                count_processed, app, collection_name, entity.get('uuid')))
+            log_connection_stats('source', session_source, worker_logger)
+            log_connection_stats('target', session_target, worker_logger)
 
-                            if count_processed % 1000 == 1:
-                                worker_logger.info(
-                                        'Processed [%sth] entity = [%s / %s / %s] in [%s]s - avg time/message [%s]' % (
-                                            count_processed, app, collection_name, entity.get('uuid'), message_time,
-                                            avg_time_per_message))
+    def collect_metrics(self, recorder):
+        stats = cache.stats()
 
-                    except KeyboardInterrupt, e:
-                        raise e
+        recorder.set_gauge('usergrid_cache_hits', stats['hits'])
+        recorder.set_gauge('usergrid_cache_misses', stats['misses'])
+        recorder.set_gauge('usergrid_cache_hit_ratio', stats['hit_ratio'])
+        recorder.set_gauge('usergrid_entities_processed', self.count_processed)
+
+    def run_blocking(self):
+        keep_going = True
+        empty_count = 0
+
+        while keep_going:
+
+            try:
+                # get a batch of entities with the app and collection name and the graph depth they were found at,
+                # the entities this process could not publish come first
+                if len(local_frontier) > 0:
+                    app, collection_name, entities, depth = local_frontier.popleft()
+                else:
+                    app, collection_name, entities, depth = self.queue.get(timeout=120)
+
+                empty_count = 0
 
-                    except Exception, e:
-                        logger.exception('Error in EntityWorker processing message')
-                        print traceback.format_exc()
+                # read the cache for the whole batch at once
+                prefetch_cache_keys(entities)
+
+                if self.page_handler_function is not None:
+                    self.process_page(app, collection_name, entities)
+                else:
+                    for entity in entities:
+                        self.process_entity(app, collection_name, entity, depth)
 
             except KeyboardInterrupt, e:
                 raise e
@@ -348,6 +378,134 @@ class EntityWorker(Process):
                 logger.exception('Error in EntityWorker run()')
                 print traceback.format_exc()
 
+    def run_async(self):
+        # gevent is only required for this engine.  Patching has to happen in the worker process before any request
+        # is made so that the sockets used by requests yield to the event loop instead of blocking it
+        from gevent import monkey
+        monkey.patch_all()
+
+        import gevent
+        from gevent.pool import Pool
+
+        init_async_sessions()
+
+        pool = Pool(size=config.get('async_concurrency', 100))
+
+        keep_going = True
+        empty_count = 0
+        last_received = time.time()
+
+        while keep_going:
+
+            try:
+                # only take more work when a coroutine is free so the queue still applies back-pressure
+                pool.wait_available()
+
+                # the multiprocessing queue is not cooperative, so poll it instead of blocking the event loop
+                if len(local_frontier) > 0:
+                    app, collection_name, entities, depth = local_frontier.popleft()
+                else:
+                    app, collection_name, entities, depth = self.queue.get_nowait()
+
+                empty_count = 0
+                last_received = time.time()
+
+                prefetch_cache_keys(entities)
+
+                if self.page_handler_function is not None:
+                    pool.spawn(self.process_page, app, collection_name, entities)
+                    continue
+
+                for entity in entities:
+                    pool.wait_available()
+                    pool.spawn(self.process_entity, app, collection_name, entity, depth)
+
+            except KeyboardInterrupt, e:
+                pool.kill()
+                raise e
+
+            except Empty:
+                idle_time = time.time() - last_received
+
+                if idle_time >= 120 * (empty_count + 1):
+                    worker_logger.warning('EMPTY! Count=%s' % empty_count)
+                    empty_count += 1
+
+                if empty_count >= 2 and pool.free_count() == pool.size:
+                    keep_going = False
+                else:
+                    gevent.sleep(0.1)
+
+            except Exception, e:
+                logger.exception('Error in EntityWorker run_async()')
+                print traceback.format_exc()
+
+        pool.join()
+
+    def process_page(self, app, collection_name, entities):
+        try:
+            message_start_time = time.time()
+
+            processed = self.page_handler_function(app, collection_name, entities)
+
+            metrics.progress()
+
+            self.count_processed += processed
+
+            worker_logger.info('Processed [%s] of [%s] entities of [%s / %s] in [%.3f]s, [%s] total' % (
+                processed, len(entities), app, collection_name, time.time() - message_start_time,
+                self.count_processed))
+
+        except KeyboardInterrupt, e:
+            raise e
+
+        except Exception, e:
+            logger.exception('Error in EntityWorker processing page')
+            print traceback.format_exc()
+
+    def process_entity(self, app, collection_name, entity, depth=0):
+
+        # if entity.get('type') == 'user':
+        #     entity = confirm_user_entity(app, entity)
+
+        # the handler operation is the specified operation such as migrate_graph
+        if self.handler_function is not None:
+            try:
+                message_start_time = int(time.time())
+
+                # only migrate_graph publishes entities below the top of the graph, the other operations take no depth
+                if depth > 0:
+                    processed = self.handler_function(app, collection_name, entity, depth=depth)
+                else:
+                    processed = self.handler_function(app, collection_name, entity)
+
+                message_end_time = int(time.time())
+
+                metrics.progress()
+
+                if processed:
+                    self.count_processed += 1
+
+                    total_time = message_end_time - self.start_time
+                    avg_time_per_message = total_time / self.count_processed
+                    message_time = message_end_time - message_start_time
+
+                    worker_logger.debug('Processed [%sth] entity = %s / %s / %s' % (
+                        self.count_processed, app, collection_name, entity.get('uuid')))
+
+                    if self.count_processed % 1000 == 1:
+                        worker_logger.info(
+                                'Processed [%sth] entity = [%s / %s / %s] in [%s]s - avg time/message [%s]' % (
+                                    self.count_processed, app, collection_name, entity.get('uuid'), message_time,
+                                    avg_time_per_message))
+
+            except KeyboardInterrupt, e:
+                raise e
+
+            except Exception, e:
+                logger.exception('Error in EntityWorker processing message')
+                print traceback.format_exc()
+
 
 class CollectionWorker(Process):
     def __init__(self, work_queue, entity_queue, response_queue):
@@ -360,6 +518,8 @@ class CollectionWorker(Process):
     def run(self):
 
         collection_worker_logger.info('starting run()...')
+        init_sessions()
+
         keep_going = True
 
         counter = 0
@@ -375,7 +535,8 @@ class CollectionWorker(Process):
             while keep_going:
 
                 try:
-                    app, collection_name = self.work_queue.get(timeout=30)
+                    app, collection_name, segment = self.work_queue.get(timeout=30)
+                    checkpoint_name = get_checkpoint_name(collection_name, segment)
 
                     status_map = {
                         collection_name: {
@@ -389,7 +550,33 @@ class CollectionWorker(Process):
                         }
                     }
 
+                    if segment is not None:
+                        status_map[collection_name]['segment'] = segment['index']
+                        status_map[collection_name]['segment_count'] = segment['count']
+
                     empty_count = 0
+                    next_status_counter = counter + 1
+
+                    checkpoint = checkpoint_store.get(app, checkpoint_name) if config.get('resume') else None
+                    cursor = None
+
+                    if checkpoint is not None:
+
+                        if checkpoint['complete']:
+                            collection_worker_logger.warning(
+                                    'Skipping app/collection [%s / %s] which was completed by run [%s]' % (
+                                        app, checkpoint_name, ECID))
+                            continue
+
+                        cursor = checkpoint['cursor']
+                        status_map[collection_name]['count'] = checkpoint['count']
+
+                        collection_worker_logger.warning(
+                                'Resuming app/collection [%s / %s] after [%s] entities from cursor [%s]' % (
+                                    app, checkpoint_name, checkpoint['count'], cursor))
+
+                    # (cursor, count) of the pages published, oldest first, which are not yet safe to checkpoint
+                    published_cursors = deque([(cursor, status_map[collection_name]['count'])])
 
                     # added a flag for using graph vs query/index
                     if config.get('graph', False):
@@ -403,64 +590,51 @@ class CollectionWorker(Process):
                                                                                      app=app,
                                                                                      collection=collection_name,
                                                                                      limit=config.get('limit'),
-                                                                                     ql="select * %s" % config.get(
-                                                                                             'ql'),
+                                                                                     ql=get_segment_ql(
+                                                                                             "select * %s" % config.get(
+                                                                                                     'ql'),
+                                                                                             segment),
                                                                                      **config.get('source_endpoint'))
 
                     logger.info('Iterating URL: %s' % source_collection_url)
 
-                    # use the UsergridQuery from the Python SDK to iterate the collection
-                    q = UsergridQueryIterator(source_collection_url,
-                                              page_delay=config.get('page_sleep_time'),
-                                              sleep_time=config.get('error_retry_sleep'))
+                    # iterate the collection a page at a time so stats are kept from the page rather than per entity
+                    q = UsergridPageIterator(source_collection_url,
+                                             session=session_source,
+                                             page_delay=get_page_sleep_time(),
+                                             cursor=cursor)
 
-                    for entity in q:
+                    page = None
 
-                        # begin entity loop
+                    for page in q:
 
-                        self.entity_queue.put((app, collection_name, entity))
-                        counter += 1
+                        # publish the page as one batch so the app and collection are sent once per page rather than
+                        # once per entity
+                        if len(page.entities) > 0:
+                            self.wait_for_watermark()
+                            self.entity_queue.put((app, collection_name, page.entities, 0))
+                            counter += len(page.entities)
 
-                        if 'created' in entity:
+                            if get_entity_sleep_time() > 0:
+                                collection_worker_logger.debug(
+                                        'sleeping for [%s]s per entity...' % (get_entity_sleep_time()))
+                                time.sleep(get_entity_sleep_time() * len(page.entities))
+                                collection_worker_logger.debug(
+                                        'STOPPED sleeping for [%s]s per entity...' % (get_entity_sleep_time()))
 
-                            try:
-                                entity_created = long(entity.get('created'))
+                        update_status_map(status_map[collection_name], page)
 
-                                if entity_created > status_map[collection_name]['max_created']:
-                                    status_map[collection_name]['max_created'] = entity_created
-                                    status_map[collection_name]['max_created_str'] = str(
-                                            datetime.datetime.fromtimestamp(entity_created / 1000))
+                        metrics.progress()
+                        metrics.inc('usergrid_entities_published_total', value=len(page.entities))
 
-                                if entity_created < status_map[collection_name]['min_created']:
-                                    status_map[collection_name]['min_created'] = entity_created
-                                    status_map[collection_name]['min_created_str'] = str(
-                                            datetime.datetime.fromtimestamp(entity_created / 1000))
-
-                            except ValueError:
-                                pass
+                        if page.cursor is not None:
+                            published_cursors.append((page.cursor, status_map[collection_name]['count']))
+                            self.save_checkpoint(app, checkpoint_name, published_cursors,
+                                                 status_map[collection_name]['count'])
 
-                        if 'modified' in entity:
+                        if counter >= next_status_counter:
+                            next_status_counter += 1000
 
-                            try:
-                                entity_modified = long(entity.get('modified'))
-
-                                if entity_modified > status_map[collection_name]['max_modified']:
-                                    status_map[collection_name]['max_modified'] = entity_modified
-                                    status_map[collection_name]['max_modified_str'] = str(
-                                            datetime.datetime.fromtimestamp(entity_modified / 1000))
-
-                                if entity_modified < status_map[collection_name]['min_modified']:
-                                    status_map[collection_name]['min_modified'] = entity_modified
-                                    status_map[collection_name]['min_modified_str'] = str(
-                                            datetime.datetime.fromtimestamp(entity_modified / 1000))
-
-                            except ValueError:
-                                pass
-
-                        status_map[collection_name]['bytes'] += count_bytes(entity)
-                        status_map[collection_name]['count'] += 1
-
-                        if counter % 1000 == 1:
                             try:
                                 collection_worker_logger.warning(
                                         'Sending stats for app/collection [%s / %s]: %s' % (
@@ -478,17 +652,14 @@ class CollectionWorker(Process):
                             collection_worker_logger.warn(
                                     'Current status of collections processed: %s' % json.dumps(status_map))
 
-                        if config.get('entity_sleep_time') > 0:
-                            collection_worker_logger.debug(
-                                    'sleeping for [%s]s per entity...' % (config.get('entity_sleep_time')))
-                            time.sleep(config.get('entity_sleep_time'))
-                            collection_worker_logger.debug(
-                                    'STOPPED sleeping for [%s]s per entity...' % (config.get('entity_sleep_time')))
-
-                    # end entity loop
-
                     status_map[collection_name]['iteration_finished'] = str(datetime.datetime.now())
 
+                    # only a collection / segment which was read to the end is skipped by a resumed run, the page
+                    # iterator raises on the errors which would end it early
+                    if page is not None and page.status_code == 200 and page.cursor is None:
+                        checkpoint_store.save(app, checkpoint_name, None, status_map[collection_name]['count'],
+                                              complete=True)
+
                     collection_worker_logger.warning(
                             'Collection [%s / %s / %s] loop complete!  Max Created entity %s' % (
                                 config.get('org'), app, collection_name, status_map[collection_name]['max_created']))
@@ -517,8 +688,56 @@ class CollectionWorker(Process):
 
         finally:
             self.response_queue.put((app, collection_name, status_map))
+            checkpoint_store.close()
+            log_connection_stats('source', session_source, collection_worker_logger)
             collection_worker_logger.info('FINISHED!')
 
+    def wait_for_watermark(self):
+        # the queue holds batches of up to a page, so the number of entities waiting is estimated from the page size
+        if not QSIZE_OK:
+            return
+
+        queued = self.entity_queue.qsize() * config.get('limit')
+
+        if queued < config.get('queue_watermark_high'):
+            return
+
+        collection_worker_logger.warning('Entity queue at [%s] entities, pausing until it reaches [%s]...' % (
+            queued, config.get('queue_watermark_low')))
+
+        while queued > config.get('queue_watermark_low'):
+            time.sleep(1)
+            queued = self.entity_queue.qsize() * config.get('limit')
+
+        collection_worker_logger.warning('Entity queue at [%s] entities, resuming' % queued)
+
+    def save_checkpoint(self, app, collection_name, published_cursors, count):
+        # entities which are published but still waiting in the queue (or being processed) would be lost if the run
+        # stopped now, so only checkpoint the newest cursor which is at least that many entities behind
+        if QSIZE_OK:
+            unprocessed = self.entity_queue.qsize() * config.get('limit')
+        else:
+            unprocessed = config.get('queue_size_max')
+
+        unprocessed += config.get('entity_workers') * config.get('limit')
+
+        while len(published_cursors) > 1 and count - published_cursors[1][1] >= unprocessed:
+            published_cursors.popleft()
+
+        cursor, cursor_count = published_cursors[0]
+
+        if cursor is not None and count - cursor_count >= unprocessed:
+            checkpoint_store.save(app, collection_name, cursor, cursor_count)
+
+
+def get_page_sleep_time():
+    # the rate controller paces the requests instead of the fixed sleeps
+    return 0 if rate_controller is not None else config.get('page_sleep_time')
+
+
+def get_entity_sleep_time():
+    return 0 if rate_controller is not None else config.get('entity_sleep_time')
+
 
 def use_name_for_collection(collection_name):
     return collection_name in config.get('use_name_for_collection', [])
@@ -577,22 +796,21 @@ def exclude_edge(collection_name, edge_name):
     return False
 
 
-def confirm_user_entity(app, source_entity, attempts=0):
-    attempts += 1
-
+def confirm_user_entity(app, source_entity):
     source_entity_url = get_entity_url_template.format(org=config.get('org'),
                                                        app=app,
                                                        collection='users',
                                                        uuid=source_entity.get('username'),
                                                        **config.get('source_endpoint'))
 
-    if attempts >= 5:
-        logger.warning('Punting after [%s] attempts to confirm user at URL [%s], will use the source entity...' % (
-            attempts, source_entity_url))
+    try:
+        r = get_retry_policy().request(session_source.get, source_entity_url)
 
-        return source_entity
+    except Exception:
+        logger.exception('Punting after error confirming user at URL [%s], will use the source entity...' % (
+            source_entity_url))
 
-    r = requests.get(url=source_entity_url)
+        return source_entity
 
     if r.status_code == 200:
         retrieved_entity = r.json().get('entities')[0]
@@ -612,15 +830,13 @@ def confirm_user_entity(app, source_entity, attempts=0):
         return source_entity
 
     else:
-        logger.error('After [%s] attempts to confirm user at URL [%s], received status [%s] message: %s...' % (
-            attempts, source_entity_url, r.status_code, r.text))
-
-        time.sleep(DEFAULT_RETRY_SLEEP)
+        logger.warning('Punting after status [%s] confirming user at URL [%s], will use the source entity: %s...' % (
+            r.status_code, source_entity_url, r.text))
 
-        return confirm_user_entity(app, source_entity, attempts)
+        return source_entity
 
 
-def create_connection(app, collection_name, source_entity, edge_name, target_entity):
+def get_connection_url(app, collection_name, source_entity, edge_name, target_entity):
     target_app, target_collection, target_org = get_target_mapping(app, collection_name)
 
     source_identifier = get_source_identifier(source_entity)
@@ -650,7 +866,7 @@ def create_connection(app, collection_name, source_entity, edge_name, target_ent
         else:
             target_type_id = '%s/%s' % ('receipts', target_entity.get('uuid'))
 
-    create_connection_url = connection_create_by_pairs_url_template.format(
+    return connection_create_by_pairs_url_template.format(
             org=target_org,
             app=target_app,
             source_type_id=source_type_id,
@@ -658,69 +874,104 @@ def create_connection(app, collection_name, source_entity, edge_name, target_ent
             target_type_id=target_type_id,
             **config.get('target_endpoint'))
 
-    if not config.get('skip_cache_read', False):
-        processed = cache.get(create_connection_url)
-
-        if processed not in [None, 'None']:
-            logger.debug('Skipping visited Edge: [%s / %s / %s] --[%s]--> [%s / %s / %s]: %s ' % (
-                app, collection_name, source_identifier, edge_name, target_app, target_entity.get('type'),
-                target_entity.get('name'), create_connection_url))
 
-            return True
+def post_connection(app, collection_name, source_entity, edge_name, target_entity, create_connection_url):
+    target_app, target_collection, target_org = get_target_mapping(app, collection_name)
 
     logger.info('Connecting entity [%s / %s / %s] --[%s]--> [%s / %s / %s]: %s ' % (
-        app, collection_name, source_identifier, edge_name, target_app, target_entity.get('type'),
+        app, collection_name, get_source_identifier(source_entity), edge_name, target_app, target_entity.get('type'),
         target_entity.get('name', target_entity.get('uuid')), create_connection_url))
 
-    attempts = 0
-
-    while attempts < 5:
-        attempts += 1
+    repaired = False
 
-        r_create = session_target.post(create_connection_url)
+    while True:
+        r_create = get_retry_policy().request(session_target.post, create_connection_url)
 
         if r_create.status_code == 200:
+            return True
 
-            if not config.get('skip_cache_write', False):
-                cache.set(create_connection_url, 1)
+        if r_create.status_code in [401, 404] and config.get('repair_data', False) and not repaired:
+            logger.warning('FAILED [%s] (WILL attempt repair) to create connection at URL=[%s]: %s' % (
+                r_create.status_code, create_connection_url, r_create.text))
+            migrate_data(app, source_entity.get('type'), source_entity, force=True)
+            migrate_data(app, target_entity.get('type'), target_entity, force=True)
+            repaired = True
 
-            return True
         else:
-            if r_create.status_code >= 500:
+            logger.critical('FAILED [%s] (WILL NOT RETRY) to create connection at URL=[%s]: %s' % (
+                r_create.status_code, create_connection_url, r_create.text))
+            return False
 
-                if attempts < 5:
-                    logger.warning('FAILED [%s] (will retry) to create connection at URL=[%s]: %s' % (
-                        r_create.status_code, create_connection_url, r_create.text))
-                    time.sleep(DEFAULT_RETRY_SLEEP)
-                else:
-                    logger.critical(
-                            'FAILED [%s] (WILL NOT RETRY - max attempts) to create connection at URL=[%s]: %s' % (
-                                r_create.status_code, create_connection_url, r_create.text))
-                    return False
 
-            elif r_create.status_code in [401, 404]:
+def init_async_sessions():
+    global session_source, session_target
 
-                if config.get('repair_data', False):
-                    logger.warning('FAILED [%s] (WILL attempt repair) to create connection at URL=[%s]: %s' % (
-                        r_create.status_code, create_connection_url, r_create.text))
-                    migrate_data(app, source_entity.get('type'), source_entity, force=True)
-                    migrate_data(app, target_entity.get('type'), target_entity, force=True)
+    # new sessions so that no connection opened before the fork (or before patching) is reused by the coroutines
+    host_concurrency = config.get('host_concurrency', 50)
 
-                else:
-                    logger.critical('FAILED [%s] (WILL NOT attempt repair) to create connection at URL=[%s]: %s' % (
-                        r_create.status_code, create_connection_url, r_create.text))
+    session_source = get_session(HostLimitedAdapter, pool_size=host_concurrency, host_limit=host_concurrency,
+                                 rate_controller=rate_controller)
+    session_target = get_session(HostLimitedAdapter, pool_size=host_concurrency, host_limit=host_concurrency,
+                                 rate_controller=rate_controller)
 
-            else:
-                logger.warning('FAILED [%s] (will retry) to create connection at URL=[%s]: %s' % (
-                    r_create.status_code, create_connection_url, r_create.text))
+    session_source.auth = BearerAuth(token_manager, 'source')
+    session_target.auth = BearerAuth(token_manager, 'target')
 
-    return False
+    add_metrics_hooks()
 
 
-def process_edges(app, collection_name, source_entity, edge_name, connection_stack):
+def get_metrics_hook(endpoint):
+    def record_request(r, *args, **kwargs):
+        labels = {'endpoint': endpoint, 'method': r.request.method}
+
+        metrics.observe('usergrid_request_duration_seconds', r.elapsed.total_seconds(), labels)
+
+        labels['status'] = r.status_code
+        metrics.inc('usergrid_requests_total', labels)
+
+    return record_request
+
+
+def add_metrics_hooks():
+    # latency is recorded from every response, split by which endpoint it came from
+    session_source.hooks['response'].append(get_metrics_hook('source'))
+    session_target.hooks['response'].append(get_metrics_hook('target'))
+
+
+def prefetch_cache_keys(entities):
+    if config.get('skip_cache_read', False):
+        return
+
+    keys = []
+    visit_keys = []
+
+    for entity in entities:
+        keys.append(entity.get('uuid'))
+        visit_keys.append('%s:graph:%s' % (key_version, entity.get('uuid')))
+
+    try:
+        if visit_cache is cache:
+            cache.prefetch(keys + visit_keys)
+        else:
+            cache.prefetch(keys)
+
+    except:
+        logger.exception('Error prefetching [%s] cache keys' % len(keys))
 
+
+def get_thread_pool(name, size):
+    # the pool is created lazily so that each worker process gets its own threads after the fork
+    if name not in thread_pools:
+        thread_pools[name] = ThreadPool(processes=size)
+
+    return thread_pools[name]
+
+
+def process_edges(app, collection_name, source_entity, edge_name, connection_stack):
     source_identifier = get_source_identifier(source_entity)
 
+    edges = []
+
     while len(connection_stack) > 0:
 
         target_entity = connection_stack.pop()
@@ -730,7 +981,54 @@ def process_edges(app, collection_name, source_entity, edge_name, connection_sta
                 app, collection_name, source_identifier, edge_name ))
             continue
 
-        create_connection(app, collection_name, source_entity, edge_name, target_entity)
+        edges.append(
+                (target_entity, get_connection_url(app, collection_name, source_entity, edge_name, target_entity)))
+
+    if len(edges) == 0:
+        return True
+
+    start_time = time.time()
+
+    # check all of the edges against the cache in one round trip instead of one GET per edge
+    if not config.get('skip_cache_read', False):
+        processed = cache.mget([create_connection_url for target_entity, create_connection_url in edges])
+
+        pending = [edge for edge, edge_processed in zip(edges, processed) if edge_processed in [None, 'None']]
+
+        logger.debug('Skipping [%s] visited Edges: [%s / %s / %s] --[%s]-->' % (
+            len(edges) - len(pending), app, collection_name, source_identifier, edge_name))
+    else:
+        pending = edges
+
+    def write_edge(edge):
+        target_entity, create_connection_url = edge
+
+        try:
+            return post_connection(app, collection_name, source_entity, edge_name, target_entity,
+                                   create_connection_url)
+        except Exception:
+            logger.exception('Error creating connection at URL=[%s]' % create_connection_url)
+            return False
+
+    results = get_thread_pool('edges', config.get('edge_write_concurrency', 8)).map(write_edge, pending)
+
+    metrics.inc('usergrid_edges_total', {'result': 'skipped'}, value=len(edges) - len(pending))
+    metrics.inc('usergrid_edges_total', {'result': 'success'}, value=results.count(True))
+    metrics.inc('usergrid_edges_total', {'result': 'failure'}, value=len(results) - results.count(True))
+
+    # the cache coalesces these into pipelined writes
+    if not config.get('skip_cache_write', False):
+        for (target_entity, create_connection_url), created in zip(pending, results):
+            if created:
+                cache.set(create_connection_url, 1)
+
+    elapsed = time.time() - start_time
+
+    logger.info('Wrote [%s] of [%s] pending Edges [%s / %s / %s] --[%s]--> in [%.3f]s (%.1f edges/sec)' % (
+        results.count(True), len(pending), app, collection_name, source_identifier, edge_name, elapsed,
+        len(pending) / elapsed if elapsed > 0 else 0))
+
+    return all(results)
 
 
 def migrate_out_graph_edge_type(app, collection_name, source_entity, edge_name, depth=0):
@@ -742,17 +1040,17 @@ def migrate_out_graph_edge_type(app, collection_name, source_entity, edge_name,
     key = '%s:edge:out:%s:%s' % (key_version, source_uuid, edge_name)
 
     if not config.get('skip_cache_read', False):
-        date_visited = cache.get(key)
+        date_visited = visit_cache.get(key)
 
         if date_visited not in [None, 'None']:
             logger.info('Skipping EDGE [%s / %s --%s-->] - visited at %s' % (
                 collection_name, source_uuid, edge_name, date_visited))
             return True
         else:
-            cache.delete(key)
+            visit_cache.delete(key)
 
     if not config.get('skip_cache_write', False):
-        cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
+        visit_cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
 
     logger.debug('Visiting EDGE [%s / %s (%s) --%s-->] at %s' % (
         collection_name, source_uuid, get_uuid_time(source_uuid), edge_name, str(datetime.datetime.utcnow())))
@@ -777,24 +1075,39 @@ def migrate_out_graph_edge_type(app, collection_name, source_entity, edge_name,
             limit=config.get('limit'),
             **config.get('source_endpoint'))
 
-    connection_query = UsergridQueryIterator(connection_query_url, sleep_time=config.get('error_retry_sleep'))
+    connection_query = UsergridPageIterator(connection_query_url, session=session_source).entities()
 
-    connection_stack = []
+    connection_stack = [target_entity for target_entity in connection_query]
 
-    for target_entity in connection_query:
-        target_connection_collection = config.get('collection_mapping', {}).get(target_entity.get('type'),
-                                                                                target_entity.get('type'))
+    # look up the visit state of all of the target entities with one round trip
+    prefetch_cache_keys(connection_stack)
 
-        target_ok = migrate_graph(app, target_entity.get('type'), source_entity=target_entity, depth=depth)
+    if depth < config.get('graph_depth', 1):
 
-        if not target_ok:
-            logger.critical(
-                    'Error migrating TARGET entity data for connection [%s / %s / %s] --[%s]--> [%s / %s / %s]' % (
-                        app, collection_name, source_identifier, edge_name, app, target_connection_collection,
-                        target_entity.get('name', target_entity.get('uuid'))))
+        # the targets have to exist before the edges to them are created, so their data is migrated here and the
+        # rest of the traversal from them is published to the other workers
+        def migrate_target(target_entity):
+            try:
+                return migrate_data(app, target_entity.get('type'), target_entity)
+            except Exception:
+                logger.exception('Error migrating TARGET entity [%s / %s / %s]' % (
+                    app, target_entity.get('type'), target_entity.get('uuid')))
+                return False
+
+        edge_writer = get_thread_pool('edges', config.get('edge_write_concurrency', 8))
+
+        for target_entity, target_ok in zip(connection_stack, edge_writer.map(migrate_target, connection_stack)):
+            if not target_ok:
+                target_connection_collection = config.get('collection_mapping', {}).get(target_entity.get('type'),
+                                                                                        target_entity.get('type'))
+                logger.critical(
+                        'Error migrating TARGET entity data for connection [%s / %s / %s] --[%s]--> [%s / %s / %s]' % (
+                            app, collection_name, source_identifier, edge_name, app, target_connection_collection,
+                            target_entity.get('name', target_entity.get('uuid'))))
+
+        publish_graph_frontier(app, connection_stack, depth)
 
-        count_edges += 1
-        connection_stack.append(target_entity)
+    count_edges += len(connection_stack)
 
     process_edges(app, collection_name, source_entity, edge_name, connection_stack)
 
@@ -851,17 +1164,17 @@ def migrate_in_graph_edge_type(app, collection_name, source_entity, edge_name, d
     key = '%s:edges:in:%s:%s' % (key_version, source_uuid, edge_name)
 
     if not config.get('skip_cache_read', False):
-        date_visited = cache.get(key)
+        date_visited = visit_cache.get(key)
 
         if date_visited not in [None, 'None']:
             logger.info('Skipping EDGE [--%s--> %s / %s] - visited at %s' % (
                 collection_name, source_uuid, edge_name, date_visited))
             return True
         else:
-            cache.delete(key)
+            visit_cache.delete(key)
 
     if not config.get('skip_cache_write', False):
-        cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
+        visit_cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
 
     logger.debug('Visiting EDGE [--%s--> %s / %s (%s)] at %s' % (
         edge_name, collection_name, source_uuid, get_uuid_time(source_uuid), str(datetime.datetime.utcnow())))
@@ -890,17 +1203,47 @@ def migrate_in_graph_edge_type(app, collection_name, source_entity, edge_name, d
             limit=config.get('limit'),
             **config.get('source_endpoint'))
 
-    connection_query = UsergridQueryIterator(connecting_query_url, sleep_time=config.get('error_retry_sleep'))
+    connection_query = UsergridPageIterator(connecting_query_url, session=session_source).entities()
 
-    response = True
+    connecting_entities = [e_connection for e_connection in connection_query]
 
-    for e_connection in connection_query:
-        logger.debug('Triggering IN->OUT edge migration on entity [%s / %s / %s] ' % (
-            app, e_connection.get('type'), e_connection.get('uuid')))
+    prefetch_cache_keys(connecting_entities)
 
-        response = migrate_graph(app, e_connection.get('type'), e_connection, depth) and response
+    # the edges are created when the connecting entities are visited and migrate their OUT edges
+    if depth < config.get('graph_depth', 1):
+        logger.debug('Triggering IN->OUT edge migration on [%s] entities connecting to [%s / %s / %s] ' % (
+            len(connecting_entities), app, collection_name, source_uuid))
 
-    return response
+        publish_graph_frontier(app, connecting_entities, depth)
+
+    return True
+
+
+def publish_graph_frontier(app, entities, depth):
+    """
+    Publishes entities found by migrate_graph at a depth to the entity queue, so that the traversal continues breadth
+    first on whichever worker is free rather than recursively in this one.  Entities already visited are not
+    published.  When the queue is full the entities are kept in the local frontier of this process instead of waiting,
+    since every worker may be waiting to publish at the same time.
+    """
+    if not config.get('skip_cache_read', False):
+        entities = [entity for entity in entities
+                    if visit_cache.get('%s:graph:%s' % (key_version, entity.get('uuid'))) in [None, 'None']]
+
+    entities_by_type = {}
+
+    for entity in entities:
+        entities_by_type.setdefault(entity.get('type'), []).append(entity)
+
+    for entity_type, typed_entities in entities_by_type.iteritems():
+        for start in xrange(0, len(typed_entities), config.get('limit')):
+            work = (app, entity_type, typed_entities[start:start + config.get('limit')], depth)
+
+            try:
+                graph_frontier.put_nowait(work)
+
+            except Full:
+                local_frontier.append(work)
 
 
 def migrate_graph(app, collection_name, source_entity, depth=0):
@@ -923,18 +1266,18 @@ def migrate_graph(app, collection_name, source_entity, depth=0):
     entity_tag = '[%s / %s / %s (%s)]' % (app, collection_name, source_uuid, get_uuid_time(source_uuid))
 
     if not config.get('skip_cache_read', False):
-        date_visited = cache.get(key)
+        date_visited = visit_cache.get(key)
 
         if date_visited not in [None, 'None']:
             logger.debug('Skipping GRAPH %s at %s' % (entity_tag, date_visited))
             return True
         else:
-            cache.delete(key)
+            visit_cache.delete(key)
 
     logger.info('Visiting GRAPH %s at %s' % (entity_tag, str(datetime.datetime.utcnow())))
 
     if not config.get('skip_cache_write', False):
-        cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
+        visit_cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
 
     # first, migrate data for current node
     response = migrate_data(app, collection_name, source_entity)
@@ -969,15 +1312,6 @@ def migrate_graph(app, collection_name, source_entity, depth=0):
     return response
 
 
-def collect_entities(q):
-    response = {}
-
-    for e in q:
-        response[e.get('uuid')] = e
-
-    return response
-
-
 def prune_edge_by_name(edge_name, app, collection_name, source_entity):
     if not include_edge(collection_name, edge_name):
         return True
@@ -1007,46 +1341,82 @@ def prune_edge_by_name(edge_name, app, collection_name, source_entity):
             limit=config.get('limit'),
             **config.get('source_endpoint'))
 
-    source_connections = collect_entities(
-            UsergridQueryIterator(source_connection_query_url, sleep_time=config.get('error_retry_sleep')))
+    # only the UUIDs of the source side are kept, the target side is streamed against them.  The connections are not
+    # returned in UUID order so a merge of the two sides is not possible
+    source_uuids = UuidSet(spill_threshold=config.get('prune_spill_threshold'), spill_dir=config.get('log_dir'))
+
+    source_connection_query = UsergridPageIterator(source_connection_query_url, session=session_source).entities()
+
+    target_connection_query = UsergridPageIterator(target_connection_query_url, session=session_target).entities()
+
+    try:
+        for source_target_entity in source_connection_query:
+            source_uuids.add(source_target_entity.get('uuid'))
+
+        delete_urls = []
+        deleted = 0
+
+        for target_target_entity in target_connection_query:
+            if target_target_entity.get('uuid') in source_uuids:
+                continue
+
+            delete_urls.append(connection_create_by_uuid_url_template.format(
+                    org=target_org,
+                    app=target_app,
+                    verb=edge_name,
+                    collection=target_collection,
+                    uuid=source_identifier,
+                    target_uuid=target_target_entity.get('uuid'),
+                    **config.get('target_endpoint')))
+
+            if len(delete_urls) >= config.get('limit'):
+                deleted += delete_connections(delete_urls)
+                delete_urls = []
+
+        deleted += delete_connections(delete_urls)
 
-    target_connections = collect_entities(
-            UsergridQueryIterator(target_connection_query_url, sleep_time=config.get('error_retry_sleep')))
+    finally:
+        source_uuids.close()
 
-    delete_uuids = Set(target_connections.keys()) - Set(source_connections.keys())
+    if deleted > 0:
+        logger.info('Pruned [%s] edges [%s] of entity %s' % (deleted, edge_name, entity_tag))
 
-    if len(delete_uuids) > 0:
-        logger.info('Found [%s] edges to delete for entity %s' % (len(delete_uuids), entity_tag))
+    return True
 
-        for delete_uuid in delete_uuids:
-            delete_connection_url = connection_create_by_uuid_url_template.format(
-                    org=target_org,
-                    app=target_app,
-                    verb=edge_name,
-                    collection=target_collection,
-                    uuid=source_identifier,
-                    target_uuid=delete_uuid,
-                    **config.get('target_endpoint'))
 
-            attempts = 0
+def delete_connections(delete_connection_urls):
+    """
+    Deletes connections on the edge writer pool, which bounds the number of deletes in flight
+
+    :return: the number of connections deleted
+    """
+
+    def delete_connection(delete_connection_url):
+        try:
+            r = get_retry_policy().request(session_target.delete, delete_connection_url)
 
-            while attempts < 5:
-                attempts += 1
+        except Exception:
+            logger.exception('Error deleting connection at URL=[%s]' % delete_connection_url)
+            return False
 
-                r = session_target.delete(delete_connection_url)
+        if not config.get('skip_cache_write'):
+            cache.delete(delete_connection_url)
 
-                if not config.get('skip_cache_write'):
-                    cache.delete(delete_connection_url)
+        if r.status_code == 200:
+            logger.info('Pruned edge URL=[%s]' % delete_connection_url)
+            return True
 
-                if r.status_code == 200:
-                    logger.info('Pruned edge on attempt [%s] URL=[%s]' % (attempts, delete_connection_url))
-                    break
-                else:
-                    logger.error('Error [%s] on attempt [%s] deleting connection at URL=[%s]: %s' % (
-                        r.status_code, attempts, delete_connection_url, r.text))
-                    time.sleep(DEFAULT_RETRY_SLEEP)
+        logger.error('Error [%s] deleting connection at URL=[%s]: %s' % (
+            r.status_code, delete_connection_url, r.text))
 
-    return True
+        return False
+
+    if len(delete_connection_urls) == 0:
+        return 0
+
+    edge_writer = get_thread_pool('edges', config.get('edge_write_concurrency', 8))
+
+    return edge_writer.map(delete_connection, delete_connection_urls).count(True)
 
 
 def prune_graph(app, collection_name, source_entity):
@@ -1055,17 +1425,17 @@ def prune_graph(app, collection_name, source_entity):
     entity_tag = '[%s / %s / %s (%s)]' % (app, collection_name, source_uuid, get_uuid_time(source_uuid))
 
     if not config.get('skip_cache_read', False):
-        date_visited = cache.get(key)
+        date_visited = visit_cache.get(key)
 
         if date_visited not in [None, 'None']:
             logger.debug('Skipping PRUNE %s at %s' % (entity_tag, date_visited))
             return True
         else:
-            cache.delete(key)
+            visit_cache.delete(key)
 
     logger.debug('pruning GRAPH %s at %s' % (entity_tag, str(datetime.datetime.utcnow())))
     if not config.get('skip_cache_write', False):
-        cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
+        visit_cache.set(name=key, value=str(int(time.time())), ex=config.get('visit_cache_ttl', 3600 * 2))
 
     if collection_name in config.get('exclude_collection', []):
         logger.debug('Excluding (Collection) entity %s' % entity_tag)
@@ -1089,7 +1459,7 @@ def reput(app, collection_name, source_entity, attempts=0):
                                                                    uuid=source_identifier,
                                                                    **config.get('target_endpoint'))
 
-        r = session_source.put(target_entity_url_by_name, data=json.dumps({}))
+        r = get_retry_policy().request(session_source.put, target_entity_url_by_name, data=json.dumps({}))
         if r.status_code != 200:
             logger.info('HTTP [%s]: %s' % (target_entity_url_by_name, r.status_code))
         else:
@@ -1103,7 +1473,43 @@ def get_uuid_time(the_uuid_string):
     return time_uuid.TimeUUID(the_uuid_string).get_datetime()
 
 
-def migrate_permissions(app, collection_name, source_entity, attempts=0):
+def get_permission_key(permission):
+    # 'put,get:/users/**' and 'get, put:/users/**' grant the same, so the verbs are compared as a set
+    verbs, separator, path = permission.partition(':')
+
+    if not separator:
+        return permission.strip()
+
+    return '%s:%s' % (','.join(sorted(verb.strip().lower() for verb in verbs.split(','))), path.strip())
+
+
+def get_permissions(session, url):
+    """
+    :return: the list of permissions at the URL, an empty list if the role or group does not exist, or None if they
+    cannot be read
+    """
+    try:
+        r = get_retry_policy().request(session.get, url)
+
+    except Exception:
+        logger.exception('Unable to get permissions due to error on GET URL [%s]' % url)
+        return None
+
+    if r.status_code == 404:
+        return []
+
+    if r.status_code != 200:
+        logger.error('Unable to get permissions due to HTTP [%s] on GET URL [%s]: %s' % (r.status_code, url, r.text))
+        return None
+
+    return r.json().get('data', [])
+
+
+def migrate_permissions(app, collection_name, source_entity):
+    """
+    Grants the target role or group the permissions of the source which it does not already have, concurrently, and
+    with --revoke_permissions also revokes the permissions it has which the source does not.
+    """
     if collection_name not in ['roles', 'role', 'group', 'groups']:
         return True
 
@@ -1117,41 +1523,92 @@ def migrate_permissions(app, collection_name, source_entity, attempts=0):
                                                              uuid=source_identifier,
                                                              **config.get('source_endpoint'))
 
-    r = session_source.get(source_permissions_url)
+    source_permissions = get_permissions(session_source, source_permissions_url)
 
-    if r.status_code != 200:
-        logger.error('Unable to get permissions at URL [%s]: %s' % (source_permissions_url, r.text))
+    if source_permissions is None:
         return False
 
-    perm_response = r.json()
+    # with nothing to grant or revoke, the permissions at the target are not needed
+    if len(source_permissions) == 0 and not config.get('revoke_permissions', False):
+        return True
 
-    perms = perm_response.get('data', [])
+    target_permissions_url = permissions_url_template.format(org=target_org,
+                                                             app=target_app,
+                                                             collection=target_collection,
+                                                             uuid=source_identifier,
+                                                             **config.get('target_endpoint'))
 
-    logger.info('Migrating [%s / %s] with permissions %s' % (collection_name, source_identifier, perms))
+    target_permissions = get_permissions(session_target, target_permissions_url)
 
-    if len(perms) > 0:
-        target_permissions_url = permissions_url_template.format(org=target_org,
-                                                                 app=target_app,
-                                                                 collection=target_collection,
-                                                                 uuid=source_identifier,
-                                                                 **config.get('target_endpoint'))
+    if target_permissions is None:
+        logger.warning('Posting all [%s] permissions of [%s / %s] since those at the target are unknown' % (
+            len(source_permissions), collection_name, source_identifier))
 
-        for permission in perms:
-            data = {'permission': permission}
+        target_permissions = []
 
-            logger.info('Posting permission %s to %s' % (json.dumps(data), target_permissions_url))
+    source_keys = set(get_permission_key(permission) for permission in source_permissions)
+    target_keys = set(get_permission_key(permission) for permission in target_permissions)
 
-            r = session_target.post(target_permissions_url, json.dumps(data))
+    missing = [permission for permission in source_permissions if get_permission_key(permission) not in target_keys]
 
-            if r.status_code != 200:
-                logger.error(
-                        'ERROR posting permission %s to URL=[%s]: %s' % (
-                            json.dumps(data), target_permissions_url, r.text))
+    extra = [permission for permission in target_permissions if get_permission_key(permission) not in source_keys] \
+        if config.get('revoke_permissions', False) else []
 
-    return True
+    logger.info('Migrating [%s / %s] with [%s] permissions: [%s] missing at the target, revoking [%s]' % (
+        collection_name, source_identifier, len(source_permissions), len(missing), len(extra)))
+
+    def grant(permission):
+        data = json.dumps({'permission': permission})
+
+        logger.info('Posting permission %s to %s' % (data, target_permissions_url))
+
+        try:
+            r = get_retry_policy().request(session_target.post, target_permissions_url, data=data)
+
+        except Exception:
+            logger.exception('ERROR posting permission %s to URL=[%s]' % (data, target_permissions_url))
+            return False
+
+        if r.status_code != 200:
+            logger.error('ERROR posting permission %s to URL=[%s]: %s' % (data, target_permissions_url, r.text))
+
+        return r.status_code == 200
+
+    def revoke(permission):
+        logger.info('Revoking permission [%s] at %s' % (permission, target_permissions_url))
+
+        try:
+            r = get_retry_policy().request(session_target.delete, target_permissions_url,
+                                           params={'permission': permission})
+
+        except Exception:
+            logger.exception('ERROR revoking permission [%s] at URL=[%s]' % (permission, target_permissions_url))
+            return False
+
+        if r.status_code != 200:
+            logger.error('ERROR revoking permission [%s] at URL=[%s]: %s' % (
+                permission, target_permissions_url, r.text))
+
+        return r.status_code == 200
+
+    # a single request is not worth handing to the pool
+    run = get_thread_pool('permissions', config.get('permissions_concurrency', 8)).map \
+        if len(missing) + len(extra) > 1 else map
 
+    granted = run(grant, missing)
+    revoked = run(revoke, extra)
 
-def migrate_data(app, collection_name, source_entity, attempts=0, force=False):
+    count_failure = granted.count(False) + revoked.count(False)
+
+    metrics.inc('usergrid_permissions_total', {'result': 'skipped'}, value=len(source_permissions) - len(missing))
+    metrics.inc('usergrid_permissions_total', {'result': 'success'}, value=granted.count(True))
+    metrics.inc('usergrid_permissions_total', {'result': 'revoked'}, value=revoked.count(True))
+    metrics.inc('usergrid_permissions_total', {'result': 'failure'}, value=count_failure)
+
+    return count_failure == 0
+
+
+def migrate_data(app, collection_name, source_entity, force=False):
     if config.get('skip_data') and not force:
         return True
 
@@ -1175,6 +1632,7 @@ def migrate_data(app, collection_name, source_entity, attempts=0, force=False):
 
                     logger.debug('Skipping ENTITY: %s / %s / %s / %s (%s) / %s (%s)' % (
                         config.get('org'), app, collection_name, e_uuid, uuid_datetime, modified, modified_date))
+                    metrics.inc('usergrid_entities_total', {'result': 'skipped'})
                     return True
                 else:
                     logger.debug('DELETING CACHE: %s ' % (source_entity.get('uuid')))
@@ -1203,54 +1661,53 @@ def migrate_data(app, collection_name, source_entity, attempts=0, force=False):
 
     target_app, target_collection, target_org = get_target_mapping(app, collection_name)
 
-    try:
-        target_entity_url_by_name = put_entity_url_template.format(org=target_org,
-                                                                   app=target_app,
-                                                                   collection=target_collection,
-                                                                   uuid=source_identifier,
-                                                                   **config.get('target_endpoint'))
+    target_entity_url_by_name = put_entity_url_template.format(org=target_org,
+                                                               app=target_app,
+                                                               collection=target_collection,
+                                                               uuid=source_identifier,
+                                                               **config.get('target_endpoint'))
 
-        r = session_target.put(url=target_entity_url_by_name, data=json.dumps(entity_copy))
+    retry_policy = get_retry_policy()
+    attempts = 0
 
-        if attempts > 1:
-            logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, collection_name, source_identifier, target_entity_url_by_name))
-        else:
-            logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, collection_name, source_identifier, target_entity_url_by_name))
+    while True:
+        attempts = retry_policy.next_attempt(attempts)
 
-        if r.status_code == 200:
-            # Worked => WE ARE DONE
-            logger.info(
-                    'migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
-                        True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
-                        source_entity.get('modified'),))
+        try:
+            r = session_target.put(url=target_entity_url_by_name, data=json.dumps(entity_copy))
 
-            if not config.get('skip_cache_write', False):
-                logger.debug('SETTING CACHE | uuid=[%s] | modified=[%s]' % (
-                    source_entity.get('uuid'), str(source_entity.get('modified'))))
+            if attempts > 1:
+                logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, collection_name, source_identifier, target_entity_url_by_name))
+            else:
+                logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, collection_name, source_identifier, target_entity_url_by_name))
 
-                cache.set(source_entity.get('uuid'), str(source_entity.get('modified')))
+            if r.status_code == 200:
+                # Worked => WE ARE DONE
+                logger.info(
+                        'migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
+                            True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
+                            source_entity.get('modified'),))
 
-            if collection_name in ['role', 'group', 'roles', 'groups']:
-                migrate_permissions(app, collection_name, source_entity, attempts=0)
+                if not config.get('skip_cache_write', False):
+                    logger.debug('SETTING CACHE | uuid=[%s] | modified=[%s]' % (
+                        source_entity.get('uuid'), str(source_entity.get('modified'))))
 
-            if collection_name in ['users', 'user']:
-                migrate_user_credentials(app, collection_name, source_entity, attempts=0)
+                    cache.set(source_entity.get('uuid'), str(source_entity.get('modified')))
 
-            return True
+                metrics.inc('usergrid_entities_total', {'result': 'success'})
 
-        else:
-            logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
-                r.status_code, attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
+                if collection_name in ['role', 'group', 'roles', 'groups']:
+                    migrate_permissions(app, collection_name, source_entity)
 
-            if attempts >= 5:
-                logger.critical(
-                        'ABORT migrate_data | success=[%s] | attempts=[%s] | created=[%s] | modified=[%s] %s / %s / %s' % (
-                            True, attempts, source_entity.get('created'), source_entity.get('modified'), app,
-                            collection_name, source_identifier))
+                if collection_name in ['users', 'user']:
+                    migrate_user_credentials(app, collection_name, source_entity)
 
-                return False
+                return True
+
+            logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
+                r.status_code, attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
 
             if r.status_code == 400:
 
@@ -1267,26 +1724,33 @@ def migrate_data(app, collection_name, source_entity, attempts=0, force=False):
 
                     return False
 
-            elif r.status_code == 403:
-                logger.critical(
-                        'ABORT migrate_data | success=[%s] | attempts=[%s] | created=[%s] | modified=[%s] %s / %s / %s' % (
-                            False, attempts, source_entity.get('created'), source_entity.get('modified'), app,
-                            collection_name, source_identifier))
-                return False
+            retryable = is_retryable_status(r.status_code)
 
-    except:
-        logger.error(traceback.format_exc())
-        logger.error('error in migrate_data on entity: %s' % json.dumps(source_entity))
+        except Exception, e:
+            logger.error(traceback.format_exc())
+            logger.error('error in migrate_data on entity: %s' % json.dumps(source_entity))
+
+            retryable = is_retryable_exception(e)
+
+        if not retryable or not retry_policy.should_retry(attempts):
+            logger.critical(
+                    'ABORT migrate_data | success=[%s] | attempts=[%s] | created=[%s] | modified=[%s] %s / %s / %s' % (
+                        False, attempts, source_entity.get('created'), source_entity.get('modified'), app,
+                        collection_name, source_identifier))
 
-    logger.warn(
-            'UNSUCCESSFUL migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
-                True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
-                source_entity.get('modified'),))
+            metrics.inc('usergrid_entities_total', {'result': 'failure'})
+
+            return False
+
+        logger.warn(
+                'UNSUCCESSFUL migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
+                    False, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
+                    source_entity.get('modified'),))
 
-    return migrate_data(app, collection_name, source_entity, attempts=attempts + 1)
+        retry_policy.wait(attempts)
 
 
-def handle_user_migration_conflict(app, collection_name, source_entity, attempts=0, depth=0):
+def handle_user_migration_conflict(app, collection_name, source_entity, depth=0):
     if collection_name in ['users', 'user']:
         return False
 
@@ -1299,14 +1763,7 @@ def handle_user_migration_conflict(app, collection_name, source_entity, attempts
                                                        uuid=username,
                                                        **config.get('target_endpoint'))
 
-    # There is retry build in, here is the short circuit
-    if attempts >= 5:
-        logger.critical(
-                'Aborting after [%s] attempts to audit user [%s] at URL [%s]' % (attempts, username, target_entity_url))
-
-        return False
-
-    r = session_target.get(url=target_entity_url)
+    r = get_retry_policy().request(session_target.get, target_entity_url)
 
     if r.status_code == 200:
         target_entity = r.json().get('entities')[0]
@@ -1314,19 +1771,10 @@ def handle_user_migration_conflict(app, collection_name, source_entity, attempts
         if source_entity.get('created') < target_entity.get('created'):
             return repair_user_role(app, collection_name, source_entity)
 
-    elif r.status_code / 100 == 5:
-        audit_logger.warning(
-                'CONFLICT: handle_user_migration_conflict failed attempt [%s] GET [%s] on TARGET URL=[%s] - : %s' % (
-                    attempts, r.status_code, target_entity_url, r.text))
-
-        time.sleep(DEFAULT_RETRY_SLEEP)
-
-        return handle_user_migration_conflict(app, collection_name, source_entity, attempts)
-
     else:
         audit_logger.error(
-                'CONFLICT: Failed handle_user_migration_conflict attempt [%s] GET [%s] on TARGET URL=[%s] - : %s' % (
-                    attempts, r.status_code, target_entity_url, r.text))
+                'CONFLICT: Failed handle_user_migration_conflict GET [%s] on TARGET URL=[%s] - : %s' % (
+                    r.status_code, target_entity_url, r.text))
 
         return False
 
@@ -1350,7 +1798,7 @@ def get_best_source_entity(app, collection_name, source_entity, depth=0):
                                                                uuid=target_name,
                                                                **config.get('source_endpoint'))
 
-    r_get_source_entity = session_source.get(source_entity_url_by_name)
+    r_get_source_entity = get_retry_policy().request(session_source.get, source_entity_url_by_name)
 
     # if we are able to get at the source by PK...
     if r_get_source_entity.status_code == 200:
@@ -1372,7 +1820,7 @@ def get_best_source_entity(app, collection_name, source_entity, depth=0):
 
         logger.info('Attempting to determine best entity from query on URL %s' % source_entity_query_url)
 
-        q = UsergridQueryIterator(source_entity_query_url, sleep_time=config.get('error_retry_sleep'))
+        q = UsergridPageIterator(source_entity_query_url, session=session_source).entities()
 
         desired_entity = None
 
@@ -1424,7 +1872,7 @@ def repair_user_role(app, collection_name, source_entity, attempts=0, depth=0):
 
     logger.warning('Repairing: Deleting name=[%s] entity at URL=[%s]' % (target_name, target_entity_url_by_name))
 
-    r = session_target.delete(target_entity_url_by_name)
+    r = get_retry_policy().request(session_target.delete, target_entity_url_by_name)
 
     if r.status_code == 200 or (r.status_code in [404, 401] and 'service_resource_not_found' in r.text):
         logger.info('Deletion of entity at URL=[%s] was [%s]' % (target_entity_url_by_name, r.status_code))
@@ -1437,7 +1885,8 @@ def repair_user_role(app, collection_name, source_entity, attempts=0, depth=0):
                                                                    uuid=best_source_entity.get('uuid'),
                                                                    **config.get('target_endpoint'))
 
-        r = session_target.put(target_entity_url_by_uuid, data=json.dumps(best_source_entity))
+        r = get_retry_policy().request(session_target.put, target_entity_url_by_uuid,
+                                       data=json.dumps(best_source_entity))
 
         if r.status_code == 200:
             logger.info('Successfully repaired user at URL=[%s]' % target_entity_url_by_uuid)
@@ -1567,6 +2016,29 @@ def parse_args():
                         type=float,
                         default=30)
 
+    parser.add_argument('--max_retry_attempts',
+                        help='The max number of attempts for a request which fails with a retryable error, such as a '
+                             'connection error, 429 or 5xx',
+                        type=int,
+                        default=5)
+
+    parser.add_argument('--retry_base_delay',
+                        help='The cap in seconds on the random wait before the first retry, doubled for each retry '
+                             'up to --error_retry_sleep',
+                        type=float,
+                        default=0.5)
+
+    parser.add_argument('--retry_budget',
+                        help='The number of retries each worker process may make per request, so that workers stop '
+                             'retrying when most requests are failing',
+                        type=float,
+                        default=0.2)
+
+    parser.add_argument('--status_flush_interval',
+                        help='The number of seconds between updates of the status of the org',
+                        type=float,
+                        default=5)
+
     parser.add_argument('--page_sleep_time',
                         help='The number of seconds to wait between retrieving pages from the UsergridQueryIterator',
                         type=float,
@@ -1577,6 +2049,59 @@ def parse_args():
                         type=float,
                         default=0)
 
+    parser.add_argument('--metrics_port',
+                        help='Serve live metrics in the Prometheus text format at http://localhost:<port>/metrics',
+                        type=int)
+
+    parser.add_argument('--rate_control',
+                        help='Adjust the request rate and the number of requests in flight across all workers to hold '
+                             'the p99 latency of the source and target at --target_latency, backing off on 5xx/429 '
+                             'responses.  Replaces --page_sleep_time and --entity_sleep_time',
+                        action='store_true')
+
+    parser.add_argument('--target_latency',
+                        help='The p99 request latency in seconds to hold with --rate_control',
+                        type=float,
+                        default=1.0)
+
+    parser.add_argument('--min_request_rate',
+                        help='The lowest total requests per second --rate_control will reduce to',
+                        type=float,
+                        default=5)
+
+    parser.add_argument('--max_request_rate',
+                        help='The highest total requests per second --rate_control will increase to',
+                        type=float,
+                        default=1000)
+
+    parser.add_argument('--max_request_concurrency',
+                        help='The highest total number of requests in flight --rate_control will increase to',
+                        type=int,
+                        default=200)
+
+    parser.add_argument('--engine',
+                        help='The I/O engine for the entity workers: one entity at a time per process, or many '
+                             'concurrent entities per process on an event loop (requires gevent)',
+                        type=str,
+                        choices=['process', 'async'],
+                        default='process')
+
+    parser.add_argument('--async_concurrency',
+                        help='With --engine async, the number of entities each entity worker processes concurrently',
+                        type=int,
+                        default=100)
+
+    parser.add_argument('--host_concurrency',
+                        help='With --engine async, the max number of requests each entity worker has in flight to '
+                             'any one host',
+                        type=int,
+                        default=50)
+
+    parser.add_argument('--edge_write_concurrency',
+                        help='The number of connection (edge) create requests each entity worker keeps in flight',
+                        type=int,
+                        default=8)
+
     parser.add_argument('--collection_workers',
                         help='The number of worker processes to do the migration',
                         type=int,
@@ -1626,6 +2151,12 @@ def parse_args():
                         help='Prune the graph while processing (instead of the prune operation)',
                         action='store_true')
 
+    parser.add_argument('--prune_spill_threshold',
+                        help='The number of connection UUIDs of one entity to hold in memory when pruning, past which '
+                             'they are kept in a temporary file in --log_dir',
+                        type=int,
+                        default=1000000)
+
     parser.add_argument('--skip_data',
                         help='Skip migrating data (useful for connections only)',
                         action='store_true')
@@ -1634,6 +2165,27 @@ def parse_args():
                         help='Skip migrating credentials',
                         action='store_true')
 
+    parser.add_argument('--credentials_concurrency',
+                        help='The number of credentials requests each entity worker keeps in flight for a page of '
+                             'users',
+                        type=int,
+                        default=8)
+
+    parser.add_argument('--ignore_credentials_digest',
+                        help='Put the credentials of every user, including those whose credentials are unchanged '
+                             'since they were last put',
+                        action='store_true')
+
+    parser.add_argument('--permissions_concurrency',
+                        help='The number of permission requests each entity worker keeps in flight for a role or group',
+                        type=int,
+                        default=8)
+
+    parser.add_argument('--revoke_permissions',
+                        help='Revoke the permissions of target roles and groups which the source role or group does '
+                             'not have, so that the target matches the source',
+                        action='store_true')
+
     parser.add_argument('--skip_cache_read',
                         help='Skip reading the cache (modified timestamps and graph edges)',
                         dest='skip_cache_read',
@@ -1644,6 +2196,41 @@ def parse_args():
                         dest='skip_cache_write',
                         action='store_true')
 
+    parser.add_argument('--cache_local_size',
+                        help='The max number of cache keys each worker process keeps in memory in front of Redis',
+                        type=int,
+                        default=100000)
+
+    parser.add_argument('--cache_flush_size',
+                        help='The number of buffered cache writes which are sent to Redis in one pipeline',
+                        type=int,
+                        default=500)
+
+    parser.add_argument('--cache_flush_interval',
+                        help='The max number of seconds a cache write is buffered before it is sent to Redis',
+                        type=float,
+                        default=1.0)
+
+    parser.add_argument('--visited_set',
+                        help='Where the graph and edge keys visited in this run are kept: in the Redis cache, or in a '
+                             'Bloom filter in memory shared by the worker processes',
+                        type=str,
+                        choices=['redis', 'bloom'],
+                        default='redis')
+
+    parser.add_argument('--visited_set_capacity',
+                        help='The number of keys the Bloom filter of the visited set is sized for',
+                        type=int,
+                        default=10000000)
+
+    parser.add_argument('--visited_set_error_rate',
+                        help='The false positive rate of the Bloom filter of the visited set, at which keys which were '
+                             'not visited are skipped',
+                        type=float,
+                        default=0.0001)
+
+    add_http_arguments(parser)
+
     parser.add_argument('--create_apps',
                         help='Create apps at the target if they do not exist',
                         dest='create_apps',
@@ -1672,6 +2259,19 @@ def parse_args():
                         help='Name of the org to migrate',
                         action='store_true')
 
+    parser.add_argument('--resume',
+                        help='The ECID of a previous run with the same org and --migrate operation to resume.  Each '
+                             'collection continues from the last cursor which was checkpointed by that run',
+                        type=str,
+                        metavar='ECID')
+
+    parser.add_argument('--collection_segments',
+                        help='The number of segments to split each collection into by created timestamp, so that '
+                             'multiple collection workers can iterate a single large collection in parallel.  Not '
+                             'used with --graph',
+                        type=int,
+                        default=1)
+
     parser.add_argument('--map_app',
                         help="Multiple allowed: A colon-separated string such as 'apples:oranges' which indicates to"
                              " put data from the app named 'apples' from the source endpoint into app named 'oranges' "
@@ -1699,7 +2299,7 @@ def parse_args():
 
 
 def init():
-    global config
+    global config, rate_controller, token_manager
 
     if config.get('migrate') == 'credentials':
 
@@ -1709,6 +2309,30 @@ def init():
             logger.critical(message)
             exit()
 
+    if config.get('engine') == 'async':
+
+        try:
+            import gevent
+
+        except ImportError:
+            message = 'ABORT: In order to use the async engine, gevent is required (pip install gevent)'
+            print message
+            logger.critical(message)
+            exit()
+
+    if config.get('http2') and not HTTP2_AVAILABLE:
+        message = 'ABORT: In order to use HTTP/2, hyper is required (pip install hyper)'
+        print message
+        logger.critical(message)
+        exit()
+
+    if config.get('http2'):
+        message = 'ABORT: HTTP/2 cannot be used by the data migrator, whose requests are paced by the rate control ' \
+                  'and host limits of its HTTP/1.1 connection pools'
+        print message
+        logger.critical(message)
+        exit()
+
     config['collection_mapping'] = {}
     config['app_mapping'] = {}
     config['org_mapping'] = {}
@@ -1747,6 +2371,13 @@ def init():
     if config['exclude_collection'] is None:
         config['exclude_collection'] = []
 
+    configure_retry_policy(max_attempts=config.get('max_retry_attempts'),
+                           base_delay=config.get('retry_base_delay'),
+                           max_delay=config.get('error_retry_sleep'),
+                           budget_ratio=config.get('retry_budget'))
+
+    configure_http_client_from_args(config)
+
     config['source_endpoint'] = config['source_config'].get('endpoint').copy()
     config['source_endpoint'].update(config['source_config']['credentials'][config['org']])
 
@@ -1755,6 +2386,49 @@ def init():
     config['target_endpoint'] = config['target_config'].get('endpoint').copy()
     config['target_endpoint'].update(config['target_config']['credentials'][target_org])
 
+    if config.get('rate_control', False):
+        # created before the worker processes are started so that they all share one rate and concurrency limit
+        rate_controller = RateController(target_latency=config.get('target_latency'),
+                                         min_rate=config.get('min_request_rate'),
+                                         max_rate=config.get('max_request_rate'),
+                                         max_concurrency=config.get('max_request_concurrency'))
+
+    # registered before the worker processes are started so that they share the tokens
+    token_manager = TokenManager()
+    token_manager.register('source', config['source_endpoint'])
+    token_manager.register('target', config['target_endpoint'])
+
+    if config.get('su_username') is not None:
+        token_manager.register('source_superuser', config['source_endpoint'], username=config.get('su_username'),
+                               password=config.get('su_password'))
+        token_manager.register('target_superuser', config['target_endpoint'], username=config.get('su_username'),
+                               password=config.get('su_password'))
+
+    init_sessions()
+
+
+def init_sessions():
+    global session_source, session_target
+
+    # called again by each worker process after the fork, so that no process shares the pooled keep-alive connections
+    # of another, including those of the session the tokens are requested with
+    token_manager.reset_session()
+
+    # size the keep-alive pools so that concurrent writes reuse connections instead of reconnecting.  The thread pools
+    # can all be sending at once, as the edge writers migrate targets whose permissions and credentials are written by
+    # the other two
+    pool_size = max(config.get('http_pool_size'),
+                    config.get('edge_write_concurrency', 8) + config.get('permissions_concurrency', 8) +
+                    config.get('credentials_concurrency', 8))
+
+    session_source = get_session(RateControlledAdapter, pool_size=pool_size, rate_controller=rate_controller)
+    session_target = get_session(RateControlledAdapter, pool_size=pool_size, rate_controller=rate_controller)
+
+    session_source.auth = BearerAuth(token_manager, 'source')
+    session_target.auth = BearerAuth(token_manager, 'target')
+
+    add_metrics_hooks()
+
 
 def wait_for(threads, label, sleep_time=60):
     wait = True
@@ -1779,66 +2453,143 @@ def wait_for(threads, label, sleep_time=60):
     logger.warn('All workers [%s] done!' % label)
 
 
-def count_bytes(entity):
-    entity_copy = entity.copy()
+def update_status_map(collection_status, page):
+    # the bytes are those of the response body the page was parsed from, so the entities are not serialized again
+    collection_status['bytes'] += page.byte_count
+    collection_status['count'] += len(page.entities)
 
-    if 'metadata' in entity_copy:
-        del entity_copy['metadata']
+    for field in ['created', 'modified']:
+        min_value, max_value = page.get_range(field)
+
+        if max_value is not None and max_value > collection_status['max_%s' % field]:
+            collection_status['max_%s' % field] = max_value
+            collection_status['max_%s_str' % field] = str(datetime.datetime.fromtimestamp(max_value / 1000))
+
+        if min_value is not None and min_value < collection_status['min_%s' % field]:
+            collection_status['min_%s' % field] = min_value
+            collection_status['min_%s_str' % field] = str(datetime.datetime.fromtimestamp(min_value / 1000))
 
-    entity_str = json.dumps(entity_copy)
 
-    return len(entity_str)
+def get_superuser_auth(endpoint_name):
+    """
+    :return: the auth for the credentials endpoints, which need the superuser: the cached superuser token of the
+    source or target, or basic auth if no token can be obtained
+    """
+    if config.get('su_username') is None:
+        return None
 
+    return BearerAuth(token_manager, '%s_superuser' % endpoint_name,
+                      fallback_auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
 
-def migrate_user_credentials(app, collection_name, source_entity, attempts=0):
+
+def migrate_user_credentials(app, collection_name, source_entity):
+    return migrate_user_credentials_page(app, collection_name, [source_entity]) > 0
+
+
+def migrate_user_credentials_page(app, collection_name, source_entities):
+    """
+    Migrates the credentials of a page of users: the credentials are read from the source concurrently, and only those
+    whose digest differs from the digest stored when they were last put to the target are put, concurrently.
+
+    :return: the number of users whose credentials were migrated or were already up to date at the target
+    """
     # this only applies to users
     if collection_name not in ['users', 'user'] \
             or config.get('skip_credentials', False):
-        return False
-
-    source_identifier = get_source_identifier(source_entity)
+        return 0
 
     target_app, target_collection, target_org = get_target_mapping(app, collection_name)
 
-    # get the URLs for the source and target users
+    source_auth = get_superuser_auth('source')
+    target_auth = get_superuser_auth('target')
+
+    def get_credentials(source_entity):
+        source_identifier = get_source_identifier(source_entity)
 
-    source_url = user_credentials_url_template.format(org=config.get('org'),
-                                                      app=app,
-                                                      uuid=source_identifier,
-                                                      **config.get('source_endpoint'))
+        source_url = user_credentials_url_template.format(org=config.get('org'),
+                                                          app=app,
+                                                          uuid=source_identifier,
+                                                          **config.get('source_endpoint'))
 
-    target_url = user_credentials_url_template.format(org=target_org,
-                                                      app=target_app,
-                                                      uuid=source_identifier,
-                                                      **config.get('target_endpoint'))
+        try:
+            r = get_retry_policy().request(session_source.get, source_url, auth=source_auth)
 
-    # this endpoint for some reason uses basic auth...
-    r = requests.get(source_url, auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
+        except Exception:
+            logger.exception('Unable to migrate credentials due to error on GET URL [%s]' % source_url)
+            return None
 
-    if r.status_code != 200:
-        logger.error('Unable to migrate credentials due to HTTP [%s] on GET URL [%s]: %s' % (
-            r.status_code, source_url, r.text))
+        if r.status_code != 200:
+            logger.error('Unable to migrate credentials due to HTTP [%s] on GET URL [%s]: %s' % (
+                r.status_code, source_url, r.text))
+            return None
 
-        return False
+        # serialized with sorted keys so that the digest of unchanged credentials is the same on every run
+        body = json.dumps(r.json(), sort_keys=True)
 
-    source_credentials = r.json()
+        return source_identifier, body, hashlib.sha1(body).hexdigest()
 
-    logger.info('Putting credentials to [%s]...' % target_url)
+    def put_credentials(credentials):
+        source_identifier, body, digest = credentials
 
-    r = requests.put(target_url,
-                     data=json.dumps(source_credentials),
-                     auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
+        target_url = user_credentials_url_template.format(org=target_org,
+                                                          app=target_app,
+                                                          uuid=source_identifier,
+                                                          **config.get('target_endpoint'))
 
-    if r.status_code != 200:
-        logger.error(
-                'Unable to migrate credentials due to HTTP [%s] on PUT URL [%s]: %s' % (
-                    r.status_code, target_url, r.text))
-        return False
+        logger.info('Putting credentials to [%s]...' % target_url)
 
-    logger.info('migrate_user_credentials | success=[%s] | app/collection/name = %s/%s/%s' % (
-        True, app, collection_name, source_entity.get('uuid')))
+        try:
+            r = get_retry_policy().request(session_target.put, target_url, data=body, auth=target_auth)
 
-    return True
+        except Exception:
+            logger.exception('Unable to migrate credentials due to error on PUT URL [%s]' % target_url)
+            return False
+
+        if r.status_code != 200:
+            logger.error(
+                    'Unable to migrate credentials due to HTTP [%s] on PUT URL [%s]: %s' % (
+                        r.status_code, target_url, r.text))
+            return False
+
+        logger.info('migrate_user_credentials | success=[%s] | app/collection/name = %s/%s/%s' % (
+            True, app, collection_name, source_identifier))
+
+        return True
+
+    # a single user, from migrate_data, is not worth handing to the pool
+    run = get_thread_pool('credentials', config.get('credentials_concurrency', 8)).map \
+        if len(source_entities) > 1 else map
+
+    fetched = [credentials for credentials in run(get_credentials, source_entities) if credentials is not None]
+
+    # the target endpoint is part of the scope so that an org/app of the same name on another target is not skipped
+    digest_scope = '%s/%s/%s' % (config.get('target_endpoint').get('api_url'), target_org, target_app)
+
+    if config.get('ignore_credentials_digest', False):
+        stored_digests = {}
+    else:
+        stored_digests = digest_store.get_many(digest_scope, [credentials[0] for credentials in fetched])
+
+    pending = [credentials for credentials in fetched if stored_digests.get(credentials[0]) != credentials[2]]
+
+    results = run(put_credentials, pending)
+
+    digest_store.save_many(digest_scope, dict((credentials[0], credentials[2])
+                                              for credentials, put in zip(pending, results) if put))
+
+    count_skipped = len(fetched) - len(pending)
+    count_success = results.count(True)
+    count_failure = len(source_entities) - count_skipped - count_success
+
+    if count_skipped > 0:
+        logger.info('Skipped [%s] users in [%s / %s] whose credentials are unchanged' % (
+            count_skipped, app, collection_name))
+
+    metrics.inc('usergrid_credentials_total', {'result': 'skipped'}, value=count_skipped)
+    metrics.inc('usergrid_credentials_total', {'result': 'success'}, value=count_success)
+    metrics.inc('usergrid_credentials_total', {'result': 'failure'}, value=count_failure)
+
+    return count_skipped + count_success
 
 
 def check_response_status(r, url, exit_on_error=True):
@@ -1850,14 +2601,54 @@ def check_response_status(r, url, exit_on_error=True):
             exit()
 
 
-def do_operation(apps_and_collections, operation):
+def get_segments(app, collection_name):
+    # segments are windows of a query, so a collection iterated using the graph is always scanned as a whole
+    if config.get('graph', False):
+        return [None]
+
+    # the cursors checkpointed by the run belong to the windows it computed, which are not the same once entities
+    # are created or --collection_segments is changed, so a resumed run scans the saved windows
+    if config.get('resume'):
+        segments = checkpoint_store.get_segments(app, collection_name)
+
+        if segments is not None:
+            logger.info('Resuming app/collection [%s / %s] with the segments of run [%s]: %s' % (
+                app, collection_name, ECID, segments))
+            return segments
+
+    if config.get('collection_segments') <= 1:
+        segments = [None]
+
+    else:
+        def url_for_ql(ql):
+            return collection_query_url_template.format(org=config.get('org'),
+                                                        app=app,
+                                                        collection=collection_name,
+                                                        limit=1,
+                                                        ql=ql,
+                                                        **config.get('source_endpoint'))
+
+        segments = get_collection_segments(session_source, url_for_ql, config.get('collection_segments'))
+
+        if segments[0] is not None:
+            logger.info('Split app/collection [%s / %s] into segments: %s' % (app, collection_name, segments))
+
+    checkpoint_store.save_segments(app, collection_name, segments)
+
+    return segments
+
+
+def do_operation(apps_and_collections, operation, page_operation=None):
+    global metrics, graph_frontier
+
     status_map = {}
 
     logger.info('Creating queues...')
 
     # Mac, for example, does not support the max_size for a queue in Python
     if _platform == "linux" or _platform == "linux2":
-        entity_queue = Queue(maxsize=config.get('queue_size_max'))
+        # the entity queue holds batches of up to a page, so --queue_size_max is converted to a number of batches
+        entity_queue = Queue(maxsize=max(1, config.get('queue_size_max') / config.get('limit')))
         collection_queue = Queue(maxsize=config.get('queue_size_max'))
         collection_response_queue = Queue(maxsize=config.get('queue_size_max'))
     else:
@@ -1865,11 +2656,14 @@ def do_operation(apps_and_collections, operation):
         collection_queue = Queue()
         collection_response_queue = Queue()
 
+    graph_frontier = entity_queue
+
     logger.info('Starting entity_workers...')
 
     collection_count = 0
     # create the entity workers, but only start them (later) if there is work to do
-    entity_workers = [EntityWorker(entity_queue, operation) for x in xrange(config.get('entity_workers'))]
+    entity_workers = [EntityWorker(entity_queue, operation, page_operation) for x in
+                      xrange(config.get('entity_workers'))]
 
     # create the collection workers, but only start them (later) if there is work to do
     collection_workers = [CollectionWorker(collection_queue, entity_queue, collection_response_queue) for x in
@@ -1877,8 +2671,22 @@ def do_operation(apps_and_collections, operation):
 
     status_listener = StatusListener(collection_response_queue, entity_queue)
 
+    metrics_listener = None
+
+    if config.get('metrics_port') is not None:
+        # the recorder is created before the workers are started so that each of them sends to the listener
+        metrics_queue = Queue(maxsize=10000)
+        metrics = MetricsRecorder(metrics_queue)
+        metrics_listener = MetricsListener(metrics_queue,
+                                           config.get('metrics_port'),
+                                           queues={
+                                               'entity': entity_queue,
+                                               'collection': collection_queue,
+                                               'status': collection_response_queue
+                                           })
+
     try:
-        # for each app, publish the (app_name, collection_name) to the queue.
+        # for each app, publish the (app_name, collection_name, segment) to the queue.
         # this is received by a collection worker who iterates the collection and publishes
         # entities into a queue.  These are received by an individual entity worker which
         # executes the specified operation on the entity
@@ -1899,17 +2707,27 @@ def do_operation(apps_and_collections, operation):
 
             # iterate the collections which are returned.
             for collection_name in app_data.get('collections'):
-                logger.info('Publishing app / collection: %s / %s' % (app, collection_name))
+                segments = get_segments(app, collection_name)
+
+                logger.info('Publishing app / collection: %s / %s in [%s] segment(s)' % (
+                    app, collection_name, len(segments)))
 
-                collection_count += 1
-                collection_queue.put((app, collection_name))
+                for segment in segments:
+                    collection_count += 1
+                    collection_queue.put((app, collection_name, segment))
 
             logger.info('Finished publishing [%s] collections for app [%s] !' % (collection_count, app))
 
+        # the segments were saved through a connection which must not be shared with the workers forked below
+        checkpoint_store.close()
+
         # only start the threads if there is work to do
         if collection_count > 0:
             status_listener.start()
 
+            if metrics_listener is not None:
+                metrics_listener.start()
+
             # start the worker processes which will iterate the collections
             [w.start() for w in collection_workers]
 
@@ -1924,6 +2742,9 @@ def do_operation(apps_and_collections, operation):
 
             status_listener.terminate()
 
+            if metrics_listener is not None:
+                metrics_listener.terminate()
+
     except KeyboardInterrupt:
         logger.warning('Keyboard Interrupt, aborting...')
         entity_queue.close()
@@ -1938,6 +2759,9 @@ def do_operation(apps_and_collections, operation):
         [w.terminate() for w in collection_workers]
         status_listener.terminate()
 
+        if metrics_listener is not None:
+            metrics_listener.terminate()
+
     logger.info('entity_workers DONE!')
 
 
@@ -1976,20 +2800,11 @@ def filter_apps_and_collections(org_apps):
                                                      **config.get('source_endpoint'))
             logger.info('GET %s' % source_app_url)
 
-            r_collections = session_source.get(source_app_url)
-
-            collection_attempts = 0
-
-            # sometimes this call was not working so I put it in a loop to force it...
-            while r_collections.status_code != 200 and collection_attempts < 5:
-                collection_attempts += 1
-                logger.warning('FAILED: GET (%s) [%s] URL: %s' % (r_collections.elapsed, r_collections.status_code,
-                                                                  source_app_url))
-                time.sleep(DEFAULT_RETRY_SLEEP)
-                r_collections = session_source.get(source_app_url)
+            r_collections = get_retry_policy().request(session_source.get, source_app_url)
 
-            if collection_attempts >= 5:
-                logger.critical('Unable to get collections at URL %s, skipping app' % source_app_url)
+            if r_collections.status_code != 200:
+                logger.critical('Unable to get collections at URL %s, skipping app: [%s] %s' % (
+                    source_app_url, r_collections.status_code, r_collections.text))
                 continue
 
             app_response = r_collections.json()
@@ -2025,7 +2840,7 @@ def confirm_target_org_apps(apps_and_collections):
                                                  app=target_app,
                                                  **config.get('target_endpoint'))
         logger.info('GET %s' % target_app_url)
-        r_target_apps = session_target.get(target_app_url)
+        r_target_apps = get_retry_policy().request(session_target.get, target_app_url)
 
         if r_target_apps.status_code != 200:
 
@@ -2034,7 +2849,7 @@ def confirm_target_org_apps(apps_and_collections):
                                                                         app=target_app,
                                                                         **config.get('target_endpoint'))
                 app_request = {'name': target_app}
-                r = session_target.post(create_app_url, data=json.dumps(app_request))
+                r = get_retry_policy().request(session_target.post, create_app_url, data=json.dumps(app_request))
 
                 if r.status_code != 200:
                     logger.critical('--create_apps specified and unable to create app [%s] at URL=[%s]: %s' % (
@@ -2050,24 +2865,49 @@ def confirm_target_org_apps(apps_and_collections):
 
 
 def main():
-    global config, cache
+    global config, cache, visit_cache, checkpoint_store, digest_store, ECID
 
     config = parse_args()
+
+    # a resumed run takes over the execution id so that its logs, status and checkpoints are found
+    if config.get('resume') is not None:
+        ECID = config.get('resume')
+
     init()
     init_logging()
 
     logger.warn('Script starting')
 
+    checkpoint_file_name = os.path.join(config.get('log_dir'), '%s-%s-%s-checkpoint.db' % (
+        config.get('org'), config.get('migrate'), ECID))
+
+    if config.get('resume') is not None:
+        if os.path.isfile(checkpoint_file_name):
+            logger.warn('Resuming run [%s] from checkpoints in [%s]' % (ECID, checkpoint_file_name))
+        else:
+            logger.warn('No checkpoints found for run [%s] at [%s], starting from the beginning' % (
+                ECID, checkpoint_file_name))
+
+    checkpoint_store = CheckpointStore(checkpoint_file_name)
+
+    # not per run, so that the digests of earlier runs of the org are found
+    digest_store = DigestStore(os.path.join(config.get('log_dir'), '%s-credentials-digest.db' % config.get('org')))
+
     try:
         if config.get('redis_socket') is not None:
-            cache = redis.Redis(unix_socket_path=config.get('redis_socket'))
+            redis_client = redis.Redis(unix_socket_path=config.get('redis_socket'))
 
         else:
             # this does not try to connect to redis
-            cache = redis.StrictRedis(host='localhost', port=6379, db=0)
+            redis_client = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+        cache = VisitCache(redis_client,
+                           max_local_keys=config.get('cache_local_size'),
+                           flush_size=config.get('cache_flush_size'),
+                           flush_interval=config.get('cache_flush_interval'))
 
         # this is necessary to test the connection to redis
-        cache.get('usergrid')
+        redis_client.get('usergrid')
 
     except:
         logger.error(
@@ -2081,6 +2921,13 @@ def main():
         config['skip_cache_read'] = True
         config['skip_cache_write'] = True
 
+    # the filter is created before the worker processes are forked so that they all share it
+    if config.get('visited_set') == 'bloom':
+        visit_cache = BloomVisitCache(SharedBloomFilter(capacity=config.get('visited_set_capacity'),
+                                                        error_rate=config.get('visited_set_error_rate')))
+    else:
+        visit_cache = cache
+
     org_apps = {
     }
 
@@ -2104,7 +2951,7 @@ def main():
         try:
             # list the apps for the SOURCE org
             logger.info('GET %s' % source_org_mgmt_url)
-            r = session_source.get(source_org_mgmt_url)
+            r = get_retry_policy().request(session_source.get, source_org_mgmt_url)
 
             if r.status_code != 200:
                 logger.critical(
@@ -2150,6 +2997,9 @@ def main():
     else:
         operation = None
 
+    # the credentials of a page of users are migrated together
+    page_operation = migrate_user_credentials_page if config.get('migrate') == 'credentials' else None
+
     # filter out the apps and collections based on the -c and --exclude_collection directives
     apps_and_collections = filter_apps_and_collections(org_apps)
 
@@ -2159,7 +3009,7 @@ def main():
     confirm_target_org_apps(apps_and_collections)
 
     # execute the operation over apps and collections
-    do_operation(apps_and_collections, operation)
+    do_operation(apps_and_collections, operation, page_operation)
 
     logger.warn('Script finished')
 
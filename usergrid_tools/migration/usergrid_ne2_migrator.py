@@ -19,10 +19,14 @@ from sys import platform as _platform
 import signal
 
 from requests.auth import HTTPBasicAuth
-from usergrid import UsergridQueryIterator
 import urllib3
 import urllib
 import urlparse
+from usergrid_tools.general.http_client import add_http_arguments, configure_http_client_from_args, get_session, \
+    log_connection_stats, HTTP2_AVAILABLE
+from usergrid_tools.general.token_manager import BearerAuth, TokenManager
+from usergrid_tools.general.retry import get_retry_policy, is_retryable_exception, is_retryable_status
+from usergrid_tools.iterators.usergrid_page_iterator import UsergridPageIterator
 
 __author__ = 'Jeff West @ ApigeeCorporation'
 
@@ -39,7 +43,6 @@ status_logger = logging.getLogger('StatusLogger')
 urllib3.disable_warnings()
 
 DEFAULT_CREATE_APPS = False
-DEFAULT_RETRY_SLEEP = 10
 DEFAULT_PROCESSING_SLEEP = 1
 
 queue = Queue()
@@ -54,6 +57,9 @@ except:
 session_source = requests.Session()
 session_target = requests.Session()
 
+# gets the access tokens sent in place of the client credentials, shared by the worker processes
+token_manager = None
+
 cache = None
 
 
@@ -114,20 +120,20 @@ entity_name_map = {
 config = {}
 
 # URL Templates for Usergrid
-org_management_app_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_management_url_template = "{api_url}/management/organizations/{org}/applications?client_id={client_id}&client_secret={client_secret}"
-org_url_template = "{api_url}/{org}?client_id={client_id}&client_secret={client_secret}"
-app_url_template = "{api_url}/{org}/{app}?client_id={client_id}&client_secret={client_secret}"
-collection_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}"
-collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&client_id={client_id}&client_secret={client_secret}&limit={limit}"
-collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?client_id={client_id}&client_secret={client_secret}&limit={limit}"
-connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}?client_id={client_id}&client_secret={client_secret}"
-connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}?client_id={client_id}&client_secret={client_secret}"
-connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}?client_id={client_id}&client_secret={client_secret}"
-get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}&connections=none"
-get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
-put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?client_id={client_id}&client_secret={client_secret}"
+org_management_app_url_template = "{api_url}/management/organizations/{org}/applications"
+org_management_url_template = "{api_url}/management/organizations/{org}/applications"
+org_url_template = "{api_url}/{org}"
+app_url_template = "{api_url}/{org}/{app}"
+collection_url_template = "{api_url}/{org}/{app}/{collection}"
+collection_query_url_template = "{api_url}/{org}/{app}/{collection}?ql={ql}&limit={limit}"
+collection_graph_url_template = "{api_url}/{org}/{app}/{collection}?limit={limit}"
+connection_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}"
+connecting_query_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/connecting/{verb}"
+connection_create_by_uuid_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_uuid}"
+connection_create_by_name_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}/{verb}/{target_type}/{target_name}"
+get_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}?connections=none"
+get_entity_url_with_connections_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
+put_entity_url_template = "{api_url}/{org}/{app}/{collection}/{uuid}"
 
 user_credentials_url_template = "{api_url}/{org}/{app}/users/{uuid}/credentials"
 
@@ -304,6 +310,8 @@ class EntityWorker(Process):
     def run(self):
 
         worker_logger.info('starting run()...')
+        init_sessions()
+
         keep_going = True
 
         count_processed = 0
@@ -359,6 +367,9 @@ class EntityWorker(Process):
                 logger.exception('Error in EntityWorker run()')
                 print traceback.format_exc()
 
+        log_connection_stats('source', session_source, worker_logger)
+        log_connection_stats('target', session_target, worker_logger)
+
 
 class CollectionWorker(Process):
     def __init__(self, work_queue, entity_queue, response_queue):
@@ -371,6 +382,8 @@ class CollectionWorker(Process):
     def run(self):
 
         collection_worker_logger.info('starting run()...')
+        init_sessions()
+
         keep_going = True
 
         counter = 0
@@ -418,10 +431,10 @@ class CollectionWorker(Process):
                                                                                              'ql'),
                                                                                      **config.get('source_endpoint'))
 
-                    # use the UsergridQuery from the Python SDK to iterate the collection
-                    q = UsergridQueryIterator(source_collection_url,
-                                              page_delay=config.get('page_sleep_time'),
-                                              sleep_time=config.get('error_retry_sleep'))
+                    # iterate the collection through the retry policy
+                    q = UsergridPageIterator(source_collection_url,
+                                             session=session_source,
+                                             page_delay=config.get('page_sleep_time')).entities()
 
                     for entity in q:
 
@@ -526,6 +539,7 @@ class CollectionWorker(Process):
 
         finally:
             self.response_queue.put((app, collection_name, status_map))
+            log_connection_stats('source', session_source, collection_worker_logger)
             collection_worker_logger.info('FINISHED!')
 
 
@@ -619,7 +633,7 @@ def migrate_out_graph_edge_type(app, collection_name, source_entity, edge_name,
             limit=config.get('limit'),
             **config.get('source_endpoint'))
 
-    connection_query = UsergridQueryIterator(connection_query_url, sleep_time=config.get('error_retry_sleep'))
+    connection_query = UsergridPageIterator(connection_query_url, session=session_source).entities()
 
     connection_stack = []
 
@@ -687,41 +701,21 @@ def migrate_out_graph_edge_type(app, collection_name, source_entity, edge_name,
             app, collection_name, source_identifier, edge_name, target_app, e_connection.get('type'),
             e_connection.get('name', e_connection.get('uuid')), create_connection_url))
 
-        attempts = 0
-
-        while attempts < 5:
-            attempts += 1
+        r_create = get_retry_policy().request(session_target.post, create_connection_url)
 
-            r_create = session_target.post(create_connection_url)
+        if r_create.status_code == 200:
 
-            if r_create.status_code == 200:
-
-                if not config.get('skip_cache_write', False):
-                    cache.set(create_connection_url, create_connection_url)
-
-                response = True and response
-                break
-
-            elif r_create.status_code >= 500:
+            if not config.get('skip_cache_write', False):
+                cache.set(create_connection_url, create_connection_url)
 
-                if attempts < 5:
-                    logger.warning('FAILED (will retry) to create connection at URL=[%s]: %s' % (
-                        create_connection_url, r_create.text))
-                    time.sleep(DEFAULT_RETRY_SLEEP)
-                else:
-                    response = False
-                    connection_stack = []
-                    logger.critical(
-                            'FAILED [%s] (WILL NOT RETRY - max attempts) to create connection at URL=[%s]: %s' % (
-                                r_create.status_code, create_connection_url, r_create.text))
+            response = True and response
 
-            elif r_create.status_code in [401, 404]:
-                logger.critical(
-                        'FAILED [%s] (WILL NOT RETRY - 401/404) to create connection at URL=[%s]: %s' % (
-                            r_create.status_code, create_connection_url, r_create.text))
+        else:
+            logger.critical('FAILED [%s] (WILL NOT RETRY) to create connection at URL=[%s]: %s' % (
+                r_create.status_code, create_connection_url, r_create.text))
 
-                response = False
-                connection_stack = []
+            response = False
+            connection_stack = []
 
     return response
 
@@ -804,7 +798,7 @@ def migrate_in_graph_edge_type(app, collection_name, source_entity, edge_name, d
             limit=config.get('limit'),
             **config.get('source_endpoint'))
 
-    connection_query = UsergridQueryIterator(connecting_query_url, sleep_time=config.get('error_retry_sleep'))
+    connection_query = UsergridPageIterator(connecting_query_url, session=session_source).entities()
 
     response = True
 
@@ -875,7 +869,7 @@ def migrate_graph(app, collection_name, source_entity, depth=0):
     return response
 
 
-def confirm_user_entity(app, source_entity, attempts=0):
+def confirm_user_entity(app, source_entity):
     source_entity_url = get_entity_url_template.format(org=config.get('org'),
                                                        app=app,
                                                        collection='users',
@@ -883,14 +877,15 @@ def confirm_user_entity(app, source_entity, attempts=0):
                                                        limit=config.get('limit'),
                                                        **config.get('source_endpoint'))
 
-    if attempts >= 5:
-        logger.error('Punting after [%s] attempts to confirm user at URL [%s], will use the source entity...' % (
-            attempts, source_entity_url))
+    try:
+        r = get_retry_policy().request(session_source.get, source_entity_url)
+
+    except Exception:
+        logger.exception('Punting after error confirming user at URL [%s], will use the source entity...' % (
+            source_entity_url))
 
         return source_entity
 
-    r = session_source.get(url=source_entity_url)
-
     if r.status_code == 200:
         retrieved_entity = r.json().get('entities')[0]
 
@@ -909,12 +904,10 @@ def confirm_user_entity(app, source_entity, attempts=0):
         return source_entity
 
     else:
-        logger.error('After [%s] attempts to confirm user at URL [%s], received status [%s] message: %s...' % (
-            attempts, source_entity_url, r.status_code, r.text))
+        logger.error('Punting after status [%s] confirming user at URL [%s], will use the source entity: %s...' % (
+            r.status_code, source_entity_url, r.text))
 
-        time.sleep(DEFAULT_RETRY_SLEEP)
-
-        return confirm_user_entity(app, source_entity, attempts)
+        return source_entity
 
 
 def reput(app, collection_name, source_entity, attempts=0):
@@ -928,7 +921,7 @@ def reput(app, collection_name, source_entity, attempts=0):
                                                                    uuid=source_identifier,
                                                                    **config.get('target_endpoint'))
 
-        r = session_source.put(target_entity_url_by_name, data=json.dumps({}))
+        r = get_retry_policy().request(session_source.put, target_entity_url_by_name, data=json.dumps({}))
         if r.status_code != 200:
             logger.info('HTTP [%s]: %s' % (target_entity_url_by_name, r.status_code))
         else:
@@ -980,7 +973,7 @@ def get_devices_from_users(source_entity):
     return devices
 
 
-def migrate_device(device, target_org, target_app, attempts=0):
+def migrate_device(device, target_org, target_app):
     device_identifier = get_source_identifier(device)
     target_entity_url_by_name = put_entity_url_template.format(org=target_org,
                                                                app=target_app,
@@ -988,49 +981,53 @@ def migrate_device(device, target_org, target_app, attempts=0):
                                                                uuid=device_identifier,
                                                                **config.get('target_endpoint'))
 
+    retry_policy = get_retry_policy()
+    attempts = 0
 
-    try:
+    while True:
+        attempts = retry_policy.next_attempt(attempts)
 
-        if attempts >= 5:
-            traceback.print_stack()
-            logger.critical(
-                'ABORT migrate_users_to_devices | success=[%s] | attempts=[%s] %s / %s / %s' % (
-                    True, attempts, target_app, 'devices', device_identifier))
-
-            return False
+        try:
 
-        if attempts > 1:
-            logger.warn(traceback.print_stack())
-            logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, 'devices', device_identifier, target_entity_url_by_name))
-        else:
-            logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, 'devices', device_identifier, target_entity_url_by_name))
+            if attempts > 1:
+                logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, 'devices', device_identifier, target_entity_url_by_name))
+            else:
+                logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, 'devices', device_identifier, target_entity_url_by_name))
 
-        r = session_target.put(url=target_entity_url_by_name, data=json.dumps(device))
+            r = session_target.put(url=target_entity_url_by_name, data=json.dumps(device))
 
-        if r.status_code == 200:
-            # Worked => WE ARE DONE
-            logger.debug(
-                'migrate_users_to_devices | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
-                    True, attempts, target_org, target_app, device_identifier))
+            if r.status_code == 200:
+                # Worked => WE ARE DONE
+                logger.debug(
+                    'migrate_users_to_devices | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
+                        True, attempts, target_org, target_app, device_identifier))
 
-            return True
+                return True
 
-        else:
             logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
                 r.status_code, attempts, target_entity_url_by_name, json.dumps(device), r.text))
 
-            return False
+            retryable = is_retryable_status(r.status_code)
 
-    except:
-        logger.error(traceback.format_exc())
-        logger.error('error in migrate_users_to_devices on entity: %s' % json.dumps(device))
+        except Exception, e:
+            logger.error(traceback.format_exc())
+            logger.error('error in migrate_users_to_devices on entity: %s' % json.dumps(device))
 
-    logger.warn('UNSUCCESSFUL migrate_users_to_devices | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
-        True, attempts, target_org, target_app, device_identifier))
+            retryable = is_retryable_exception(e)
 
-    return migrate_device(device, target_org, target_app, attempts=attempts + 1)
+        if not retryable or not retry_policy.should_retry(attempts):
+            logger.critical(
+                'ABORT migrate_users_to_devices | success=[%s] | attempts=[%s] %s / %s / %s' % (
+                    False, attempts, target_app, 'devices', device_identifier))
+
+            return False
+
+        logger.warn('UNSUCCESSFUL migrate_users_to_devices | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
+            False, attempts, target_org, target_app, device_identifier))
+
+        retry_policy.wait(attempts)
 
 
 def connect_user_to_device(device, user, target_org, target_app):
@@ -1048,39 +1045,18 @@ def connect_user_to_device(device, user, target_org, target_app):
         target_app, 'users', source_identifier, 'devices', target_app, 'device',
         device.get('name'), create_connection_url))
 
-    attempts = 0
-    while attempts < 5:
-        attempts += 1
-
-        try:
-
-            r_create = session_target.post(create_connection_url)
-
-            if r_create.status_code == 200:
-                return True
-
-            elif r_create.status_code >= 500:
-                if attempts < 5:
-                    logger.warning('FAILED (will retry) to create connection at URL=[%s]: %s' % (
-                        create_connection_url, r_create.text))
-                    time.sleep(DEFAULT_RETRY_SLEEP)
-
-                else:
-                    logger.critical(
-                        'FAILED [%s] (WILL NOT RETRY - max attempts) to create connection at URL=[%s]: %s' % (
-                            r_create.status_code, create_connection_url, r_create.text))
-
-                    return False
+    try:
+        r_create = get_retry_policy().request(session_target.post, create_connection_url)
 
-            elif r_create.status_code in [401, 404]:
-                logger.critical(
-                    'FAILED [%s] (WILL NOT RETRY - 401/404) to create connection at URL=[%s]: %s' % (
-                        r_create.status_code, create_connection_url, r_create.text))
+    except Exception:
+        logger.exception('FAILED (WILL NOT RETRY) to create connection at URL=[%s]' % create_connection_url)
+        return False
 
-                return False
+    if r_create.status_code != 200:
+        logger.critical('FAILED [%s] (WILL NOT RETRY) to create connection at URL=[%s]: %s' % (
+            r_create.status_code, create_connection_url, r_create.text))
 
-        except:
-            continue
+        return False
 
     return True
 
@@ -1120,22 +1096,15 @@ def migrate_device_to_tokenmap(device, target_org, target_app):
     except:
         return False
 
+    retry_policy = get_retry_policy()
     attempts = 0
-    while attempts < 5:
-        attempts += 1
 
-        try:
-
-            if attempts >= 5:
-                traceback.print_stack()
-                logger.critical(
-                    'ABORT migrate_device_to_tokenmap | success=[%s] | attempts=[%s] | %s / %s / %s' % (
-                        True, attempts, target_app, 'devicetokens', source_identifier))
+    while True:
+        attempts = retry_policy.next_attempt(attempts)
 
-                return False
+        try:
 
             if attempts > 1:
-                logger.warn(traceback.print_stack())
                 logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
                     attempts, 'devicetokens', source_identifier, target_entity_url_by_name))
             else:
@@ -1152,29 +1121,33 @@ def migrate_device_to_tokenmap(device, target_org, target_app):
 
                 return True
 
-            else:
-                logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
-                    r.status_code, attempts, target_entity_url_by_name, json.dumps(token_entity), r.text))
-
-                if r.status_code in [400, 401, 404]:
-                    logger.error(
-                        'WILL NOT RETRY [%s] attempts to PUT url=[%s], entity=[%s] response=[%s]' % (
-                            attempts, target_entity_url_by_name, json.dumps(token_entity), r.text))
-
-                    return False
+            logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
+                r.status_code, attempts, target_entity_url_by_name, json.dumps(token_entity), r.text))
 
-                logger.warn(
-                    'UNSUCCESSFUL migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
-                        True, attempts, config.get('org'), target_app, source_identifier))
+            retryable = is_retryable_status(r.status_code)
 
-        except:
+        except Exception, e:
+            logger.error(traceback.format_exc())
             logger.error('Failure on attempt [%s] to PUT url=[%s], entity=[%s]' % (
                 attempts, target_entity_url_by_name, json.dumps(token_entity)))
 
-    return True
+            retryable = is_retryable_exception(e)
 
+        if not retryable or not retry_policy.should_retry(attempts):
+            logger.critical(
+                'ABORT migrate_device_to_tokenmap | success=[%s] | attempts=[%s] | %s / %s / %s' % (
+                    False, attempts, target_app, 'devicetokens', source_identifier))
+
+            return False
+
+        logger.warn(
+            'UNSUCCESSFUL migrate_device_to_tokenmap | success=[%s] | attempts=[%s] | entity=[%s / %s / %s]' % (
+                False, attempts, config.get('org'), target_app, source_identifier))
 
-def migrate_data(app, collection_name, source_entity, attempts=0):
+        retry_policy.wait(attempts)
+
+
+def migrate_data(app, collection_name, source_entity):
     if not config.get('skip_cache_read', False):
         try:
             str_modified = cache.get(source_entity.get('uuid'))
@@ -1233,83 +1206,90 @@ def migrate_data(app, collection_name, source_entity, attempts=0):
                                                                uuid=source_identifier,
                                                                **config.get('target_endpoint'))
 
-    try:
-
-        if attempts >= 5:
-            traceback.print_stack()
-            logger.critical(
-                'ABORT migrate_data | success=[%s] | attempts=[%s] | created=[%s] | modified=[%s] %s / %s / %s' % (
-                    True, attempts, source_entity.get('created'), source_entity.get('modified'), app,
-                    collection_name, source_identifier))
+    retry_policy = get_retry_policy()
+    attempts = 0
 
-            return False
+    while True:
+        attempts = retry_policy.next_attempt(attempts)
 
-        if attempts > 1:
-            logger.warn(traceback.print_stack())
-            logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, collection_name, source_identifier, target_entity_url_by_name))
-        else:
-            logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
-                attempts, collection_name, source_identifier, target_entity_url_by_name))
+        try:
 
-        r = session_target.put(url=target_entity_url_by_name, data=json.dumps(entity_copy))
+            if attempts > 1:
+                logger.warn('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, collection_name, source_identifier, target_entity_url_by_name))
+            else:
+                logger.debug('Attempt [%s] to migrate entity [%s / %s] at URL [%s]' % (
+                    attempts, collection_name, source_identifier, target_entity_url_by_name))
 
-        if r.status_code == 200:
-            # Worked => WE ARE DONE
-            logger.debug(
-                'migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
-                    True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
-                    source_entity.get('modified'),))
+            r = session_target.put(url=target_entity_url_by_name, data=json.dumps(entity_copy))
 
-            if not config.get('skip_cache_write', False):
-                logger.debug('SETTING CACHE | uuid=[%s] | modified=[%s]' % (
-                    source_entity.get('uuid'), str(source_entity.get('modified'))))
+            if r.status_code == 200:
+                # Worked => WE ARE DONE
+                logger.debug(
+                    'migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
+                        True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
+                        source_entity.get('modified'),))
 
                 if not config.get('skip_cache_write', False):
+                    logger.debug('SETTING CACHE | uuid=[%s] | modified=[%s]' % (
+                        source_entity.get('uuid'), str(source_entity.get('modified'))))
+
                     cache.set(source_entity.get('uuid'), str(source_entity.get('modified')))
 
-            # migrate devices into deviceTokenMap collection
-            if source_entity_type in ['device']:
-                migrate_device_to_tokenmap(entity_copy, target_org, target_app)
+                # migrate devices into deviceTokenMap collection
+                if source_entity_type in ['device']:
+                    migrate_device_to_tokenmap(entity_copy, target_org, target_app)
 
-            # migrate users into devices and create connections
-            if source_entity_type in ['user'] and target_collection in ['users']:
-                migrate_users_to_devices(entity_copy, target_org, target_app)
+                # migrate users into devices and create connections
+                if source_entity_type in ['user'] and target_collection in ['users']:
+                    migrate_users_to_devices(entity_copy, target_org, target_app)
 
-            return True
+                return True
 
-        else:
-            logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
-                r.status_code, attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
+            else:
+                logger.error('Failure [%s] on attempt [%s] to PUT url=[%s], entity=[%s] response=[%s]' % (
+                    r.status_code, attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
 
-            if r.status_code == 400:
+                if r.status_code == 400:
 
-                if target_collection in ['roles', 'role']:
-                    return repair_user_role(app, collection_name, source_entity)
+                    if target_collection in ['roles', 'role']:
+                        return repair_user_role(app, collection_name, source_entity)
 
-                elif target_collection in ['users', 'user']:
-                    return handle_user_migration_conflict(app, collection_name, source_entity)
+                    elif target_collection in ['users', 'user']:
+                        return handle_user_migration_conflict(app, collection_name, source_entity)
 
-                elif 'duplicate_unique_property_exists' in r.text:
-                    logger.error(
-                        'WILL NOT RETRY (duplicate) [%s] attempts to PUT url=[%s], entity=[%s] response=[%s]' % (
-                            attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
+                    elif 'duplicate_unique_property_exists' in r.text:
+                        logger.error(
+                            'WILL NOT RETRY (duplicate) [%s] attempts to PUT url=[%s], entity=[%s] response=[%s]' % (
+                                attempts, target_entity_url_by_name, json.dumps(source_entity), r.text))
 
-                    return False
+                        return False
 
-    except:
-        logger.error(traceback.format_exc())
-        logger.error('error in migrate_data on entity: %s' % json.dumps(source_entity))
+            retryable = is_retryable_status(r.status_code)
 
-    logger.warn(
-        'UNSUCCESSFUL migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
-            True, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
-            source_entity.get('modified'),))
+        except Exception, e:
+            logger.error(traceback.format_exc())
+            logger.error('error in migrate_data on entity: %s' % json.dumps(source_entity))
 
-    return migrate_data(app, collection_name, source_entity, attempts=attempts + 1)
+            retryable = is_retryable_exception(e)
 
+        if not retryable or not retry_policy.should_retry(attempts):
+            logger.critical(
+                    'ABORT migrate_data | success=[%s] | attempts=[%s] | created=[%s] | modified=[%s] %s / %s / %s' % (
+                        False, attempts, source_entity.get('created'), source_entity.get('modified'), app,
+                        collection_name, source_identifier))
 
-def handle_user_migration_conflict(app, collection_name, source_entity, attempts=0, depth=0):
+            return False
+
+        logger.warn(
+                'UNSUCCESSFUL migrate_data | success=[%s] | attempts=[%s] | entity=[%s / %s / %s] | created=[%s] | modified=[%s]' % (
+                    False, attempts, config.get('org'), app, source_identifier, source_entity.get('created'),
+                    source_entity.get('modified'),))
+
+        retry_policy.wait(attempts)
+
+
+def handle_user_migration_conflict(app, collection_name, source_entity, depth=0):
     if collection_name in ['users', 'user']:
         return False
 
@@ -1322,14 +1302,7 @@ def handle_user_migration_conflict(app, collection_name, source_entity, attempts
                                                        uuid=username,
                                                        **config.get('target_endpoint'))
 
-    # There is retry build in, here is the short circuit
-    if attempts >= 5:
-        logger.critical(
-                'Aborting after [%s] attempts to audit user [%s] at URL [%s]' % (attempts, username, target_entity_url))
-
-        return False
-
-    r = session_target.get(url=target_entity_url)
+    r = get_retry_policy().request(session_target.get, target_entity_url)
 
     if r.status_code == 200:
         target_entity = r.json().get('entities')[0]
@@ -1337,19 +1310,10 @@ def handle_user_migration_conflict(app, collection_name, source_entity, attempts
         if source_entity.get('created') < target_entity.get('created'):
             return repair_user_role(app, collection_name, source_entity)
 
-    elif r.status_code / 100 == 5:
-        audit_logger.warning(
-                'CONFLICT: handle_user_migration_conflict failed attempt [%s] GET [%s] on TARGET URL=[%s] - : %s' % (
-                    attempts, r.status_code, target_entity_url, r.text))
-
-        time.sleep(DEFAULT_RETRY_SLEEP)
-
-        return handle_user_migration_conflict(app, collection_name, source_entity, attempts)
-
     else:
         audit_logger.error(
-                'CONFLICT: Failed handle_user_migration_conflict attempt [%s] GET [%s] on TARGET URL=[%s] - : %s' % (
-                    attempts, r.status_code, target_entity_url, r.text))
+                'CONFLICT: Failed handle_user_migration_conflict GET [%s] on TARGET URL=[%s] - : %s' % (
+                    r.status_code, target_entity_url, r.text))
 
         return False
 
@@ -1373,7 +1337,7 @@ def get_best_source_entity(app, collection_name, source_entity, depth=0):
                                                                uuid=target_name,
                                                                **config.get('source_endpoint'))
 
-    r_get_source_entity = session_source.get(source_entity_url_by_name)
+    r_get_source_entity = get_retry_policy().request(session_source.get, source_entity_url_by_name)
 
     # if we are able to get at the source by PK...
     if r_get_source_entity.status_code == 200:
@@ -1395,7 +1359,7 @@ def get_best_source_entity(app, collection_name, source_entity, depth=0):
 
         logger.info('Attempting to determine best entity from query on URL %s' % source_entity_query_url)
 
-        q = UsergridQueryIterator(source_entity_query_url, sleep_time=config.get('error_retry_sleep'))
+        q = UsergridPageIterator(source_entity_query_url, session=session_source).entities()
 
         desired_entity = None
 
@@ -1447,7 +1411,7 @@ def repair_user_role(app, collection_name, source_entity, attempts=0, depth=0):
 
     logger.warning('Repairing: Deleting name=[%s] entity at URL=[%s]' % (target_name, target_entity_url_by_name))
 
-    r = session_target.delete(target_entity_url_by_name)
+    r = get_retry_policy().request(session_target.delete, target_entity_url_by_name)
 
     if r.status_code == 200 or (r.status_code in [404, 401] and 'service_resource_not_found' in r.text):
         logger.info('Deletion of entity at URL=[%s] was [%s]' % (target_entity_url_by_name, r.status_code))
@@ -1460,7 +1424,8 @@ def repair_user_role(app, collection_name, source_entity, attempts=0, depth=0):
                                                                    uuid=best_source_entity.get('uuid'),
                                                                    **config.get('target_endpoint'))
 
-        r = session_target.put(target_entity_url_by_uuid, data=json.dumps(best_source_entity))
+        r = get_retry_policy().request(session_target.put, target_entity_url_by_uuid,
+                                       data=json.dumps(best_source_entity))
 
         if r.status_code == 200:
             logger.info('Successfully repaired user at URL=[%s]' % target_entity_url_by_uuid)
@@ -1639,6 +1604,8 @@ def parse_args():
                         dest='skip_cache_write',
                         action='store_true')
 
+    add_http_arguments(parser)
+
     parser.add_argument('--create_apps',
                         dest='create_apps',
                         action='store_true')
@@ -1706,7 +1673,7 @@ def parse_args():
 
 
 def init():
-    global config
+    global config, token_manager
 
     if config.get('migrate') == 'credentials':
 
@@ -1716,6 +1683,14 @@ def init():
             logger.critical(message)
             exit()
 
+    if config.get('http2') and not HTTP2_AVAILABLE:
+        message = 'ABORT: In order to use HTTP/2, hyper is required (pip install hyper)'
+        print message
+        logger.critical(message)
+        exit()
+
+    configure_http_client_from_args(config)
+
     config['collection_mapping'] = {}
     config['app_mapping'] = {}
     config['org_mapping'] = {}
@@ -1762,6 +1737,27 @@ def init():
     config['target_endpoint'] = config['target_config'].get('endpoint').copy()
     config['target_endpoint'].update(config['target_config']['credentials'][target_org])
 
+    # registered before the worker processes are started so that they share the tokens
+    token_manager = TokenManager()
+    token_manager.register('source', config['source_endpoint'])
+    token_manager.register('target', config['target_endpoint'])
+
+    init_sessions()
+
+
+def init_sessions():
+    global session_source, session_target
+
+    # called again by each worker process after the fork, so that no process shares the pooled keep-alive connections
+    # of another, including those of the session the tokens are requested with
+    token_manager.reset_session()
+
+    session_source = get_session()
+    session_target = get_session()
+
+    session_source.auth = BearerAuth(token_manager, 'source')
+    session_target.auth = BearerAuth(token_manager, 'target')
+
 
 def wait_for(threads, label, sleep_time=60):
     wait = True
@@ -1819,7 +1815,8 @@ def migrate_user_credentials(app, collection_name, source_entity, attempts=0):
                                                       **config.get('target_endpoint'))
 
     # this endpoint for some reason uses basic auth...
-    r = requests.get(source_url, auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
+    r = get_retry_policy().request(session_source.get, source_url,
+                                   auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
 
     if r.status_code != 200:
         logger.error('Unable to migrate credentials due to HTTP [%s] on GET URL [%s]: %s' % (
@@ -1831,9 +1828,9 @@ def migrate_user_credentials(app, collection_name, source_entity, attempts=0):
 
     logger.info('Putting credentials to [%s]...' % target_url)
 
-    r = requests.put(target_url,
-                     data=json.dumps(source_credentials),
-                     auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
+    r = get_retry_policy().request(session_target.put, target_url,
+                                   data=json.dumps(source_credentials),
+                                   auth=HTTPBasicAuth(config.get('su_username'), config.get('su_password')))
 
     if r.status_code != 200:
         logger.error(
@@ -1891,7 +1888,7 @@ def main():
         try:
             # list the apps for the SOURCE org
             logger.info('GET %s' % source_org_mgmt_url)
-            r = session_source.get(source_org_mgmt_url)
+            r = get_retry_policy().request(session_source.get, source_org_mgmt_url)
 
             if r.status_code != 200:
                 logger.critical('Abort processing: Unable to retrieve apps from [%s]: %s' % (source_org_mgmt_url, r.text))
@@ -1989,7 +1986,7 @@ def main():
                                                      app=target_app,
                                                      **config.get('target_endpoint'))
             logger.info('GET %s' % target_app_url)
-            r_target_apps = session_target.get(target_app_url)
+            r_target_apps = get_retry_policy().request(session_target.get, target_app_url)
 
             if r_target_apps.status_code != 200:
 
@@ -1998,7 +1995,7 @@ def main():
                                                                             app=target_app,
                                                                             **config.get('target_endpoint'))
                     app_request = {'name': target_app}
-                    r = session_target.post(create_app_url, data=json.dumps(app_request))
+                    r = get_retry_policy().request(session_target.post, create_app_url, data=json.dumps(app_request))
 
                     if r.status_code != 200:
                         logger.critical(
@@ -2018,20 +2015,11 @@ def main():
                                                      **config.get('source_endpoint'))
             logger.info('GET %s' % source_app_url)
 
-            r_collections = session_source.get(source_app_url)
-
-            collection_attempts = 0
-
-            # sometimes this call was not working so I put it in a loop to force it...
-            while r_collections.status_code != 200 and collection_attempts < 5:
-                collection_attempts += 1
-                logger.warning('FAILED: GET (%s) [%s] URL: %s' % (r_collections.elapsed, r_collections.status_code,
-                                                                  source_app_url))
-                time.sleep(DEFAULT_RETRY_SLEEP)
-                r_collections = session_source.get(source_app_url)
+            r_collections = get_retry_policy().request(session_source.get, source_app_url)
 
-            if collection_attempts >= 5:
-                logger.critical('Unable to get collections at URL %s, skipping app' % source_app_url)
+            if r_collections.status_code != 200:
+                logger.critical('Unable to get collections at URL %s, skipping app: [%s] %s' % (
+                    source_app_url, r_collections.status_code, r_collections.text))
                 continue
 
             app_response = r_collections.json()
@@ -0,0 +1,94 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import uuid
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('UuidSet')
+
+
+def get_uuid_key(uuid_string):
+    # 16 bytes rather than the 36 character string, anything which is not a UUID is kept as it is
+    try:
+        return uuid.UUID(uuid_string).bytes
+    except (ValueError, TypeError, AttributeError):
+        return str(uuid_string)
+
+
+class UuidSet(object):
+    """
+    A set of UUIDs which holds only the 16 byte form of each UUID in memory, and moves to a temporary SQLite file once
+    it holds more than `spill_threshold` UUIDs, so that the memory used is bounded however many UUIDs are added.
+    """
+
+    def __init__(self, spill_threshold=1000000, spill_dir=None):
+        """
+        :param spill_threshold: The number of UUIDs held in memory before the set is moved to disk
+        :param spill_dir: The directory of the temporary file, the system default if not specified
+        """
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+
+        self.keys = set()
+        self.connection = None
+        self.spill_path = None
+        self.count = 0
+
+    def spill(self):
+        handle, self.spill_path = tempfile.mkstemp(prefix='uuid-set-', suffix='.db', dir=self.spill_dir)
+        os.close(handle)
+
+        logger.info('Moving [%s] UUIDs to disk at [%s]' % (len(self.keys), self.spill_path))
+
+        # the file is temporary, so durability is traded for speed
+        self.connection = sqlite3.connect(self.spill_path)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE uuids (uuid BLOB NOT NULL PRIMARY KEY) WITHOUT ROWID')
+        self.connection.executemany('INSERT OR IGNORE INTO uuids (uuid) VALUES (?)',
+                                    ((sqlite3.Binary(key),) for key in self.keys))
+        self.connection.commit()
+
+        self.keys = None
+
+    def add(self, uuid_string):
+        key = get_uuid_key(uuid_string)
+
+        if self.connection is None:
+            if key not in self.keys:
+                self.keys.add(key)
+                self.count += 1
+
+            if len(self.keys) > self.spill_threshold:
+                self.spill()
+
+        else:
+            cursor = self.connection.execute('INSERT OR IGNORE INTO uuids (uuid) VALUES (?)', (sqlite3.Binary(key),))
+            self.count += cursor.rowcount
+
+    def update(self, uuid_strings):
+        for uuid_string in uuid_strings:
+            self.add(uuid_string)
+
+    def __contains__(self, uuid_string):
+        key = get_uuid_key(uuid_string)
+
+        if self.connection is None:
+            return key in self.keys
+
+        return self.connection.execute('SELECT 1 FROM uuids WHERE uuid = ?', (sqlite3.Binary(key),)).fetchone() \
+               is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            os.remove(self.spill_path)
+
+        self.keys = set()
+        self.count = 0
@@ -0,0 +1,258 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('VisitCache')
+
+
+class VisitCache(object):
+    """
+    A cache which sits in front of the Redis client used by the migrators.  It keeps a bounded LRU of recently seen
+    keys in the process, batches lookups for many keys into a single MGET and coalesces writes into pipelined
+    SET/DELETE flushes.
+
+    The get/set/delete/mget methods follow the redis-py signatures so it can be used in place of the Redis client.
+    Values are remembered for a bounded time only: keys which were not found for a few seconds, so that a key visited
+    by another worker process is seen shortly after it was written, and values for at most `positive_ttl` or the
+    expiry of the key, so that keys which expired or were deleted by another process are not seen forever.
+    """
+
+    def __init__(self,
+                 redis_client,
+                 max_local_keys=100000,
+                 flush_size=500,
+                 flush_interval=1.0,
+                 negative_ttl=5.0,
+                 positive_ttl=60.0):
+        """
+        :param redis_client: The redis.Redis / redis.StrictRedis client to use
+        :param max_local_keys: The max number of keys to keep in the in-process LRU
+        :param flush_size: The number of buffered writes which triggers a flush to Redis
+        :param flush_interval: The max number of seconds a buffered write waits before it is flushed
+        :param negative_ttl: The number of seconds to remember that a key was not found in Redis
+        :param positive_ttl: The max number of seconds to remember the value of a key
+        """
+        self.redis_client = redis_client
+        self.max_local_keys = max_local_keys
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.negative_ttl = negative_ttl
+        self.positive_ttl = positive_ttl
+
+        # key -> (value, expires_at)
+        self.local = OrderedDict()
+
+        # key -> (value, ex) for a SET or None for a DELETE, in the order they were issued
+        self.pending_writes = OrderedDict()
+
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.round_trips = 0
+        self.flushed_writes = 0
+
+    def remember(self, key, value, ex=None):
+        now = time.time()
+
+        if value is None:
+            expires_at = now + self.negative_ttl
+        elif ex is not None:
+            expires_at = now + min(ex, self.positive_ttl)
+        else:
+            expires_at = now + self.positive_ttl
+
+        self.local.pop(key, None)
+        self.local[key] = (value, expires_at)
+
+        while len(self.local) > self.max_local_keys:
+            self.local.popitem(last=False)
+
+    def lookup_local(self, key, now):
+        if key in self.pending_writes:
+            pending = self.pending_writes[key]
+            return True, pending[0] if pending is not None else None
+
+        if key in self.local:
+            value, expires_at = self.local.pop(key)
+
+            if expires_at > now:
+                # re-insert to mark the key as most recently used
+                self.local[key] = (value, expires_at)
+                return True, value
+
+        return False, None
+
+    def get(self, name):
+        return self.mget([name])[0]
+
+    def mget(self, keys):
+        keys = list(keys)
+        results = [None] * len(keys)
+        missing = []
+        now = time.time()
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                found, value = self.lookup_local(key, now)
+
+                if found:
+                    self.hits += 1
+                    results[i] = value
+                else:
+                    self.misses += 1
+                    missing.append(i)
+
+        if len(missing) > 0:
+            values = self.redis_client.mget([keys[i] for i in missing])
+
+            with self.lock:
+                self.round_trips += 1
+
+                for i, value in zip(missing, values):
+                    results[i] = value
+                    self.remember(keys[i], value)
+
+        return results
+
+    def prefetch(self, keys):
+        """
+        Loads the keys which are not already known locally with one MGET so that subsequent get() calls for a page
+        of entities are answered from memory.
+        """
+        keys = [key for key in set(keys) if key is not None]
+
+        if len(keys) > 0:
+            self.mget(keys)
+
+    def set(self, name, value, ex=None):
+        value = str(value)
+
+        with self.lock:
+            self.remember(name, value, ex)
+            self.pending_writes.pop(name, None)
+            self.pending_writes[name] = (value, ex)
+
+        self.maybe_flush()
+        return True
+
+    def delete(self, *names):
+        with self.lock:
+            for name in names:
+                self.remember(name, None)
+                self.pending_writes.pop(name, None)
+                self.pending_writes[name] = None
+
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if len(self.pending_writes) >= self.flush_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            writes = self.pending_writes
+            self.pending_writes = OrderedDict()
+            self.last_flush = time.time()
+
+        if len(writes) == 0:
+            return
+
+        pipe = self.redis_client.pipeline(transaction=False)
+
+        for name, write in writes.iteritems():
+            if write is None:
+                pipe.delete(name)
+            else:
+                value, ex = write
+                pipe.set(name, value, ex=ex)
+
+        try:
+            pipe.execute()
+
+        except Exception:
+            logger.exception('Error flushing [%s] writes to Redis' % len(writes))
+
+            # put the writes back so that they are attempted on the next flush, unless they were superseded
+            with self.lock:
+                for name, write in writes.iteritems():
+                    if name not in self.pending_writes:
+                        self.pending_writes[name] = write
+
+            return
+
+        with self.lock:
+            self.round_trips += 1
+            self.flushed_writes += len(writes)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups > 0 else 0.0,
+            'round_trips': self.round_trips,
+            'flushed_writes': self.flushed_writes,
+            'local_keys': len(self.local),
+            'pending_writes': len(self.pending_writes)
+        }
+
+
+class BloomVisitCache(object):
+    """
+    Keeps the keys visited in this run in a SharedBloomFilter rather than in Redis, so that the graph and edge visit
+    checks of all of the worker processes are answered from shared memory.  It has the get/set/delete/mget methods of
+    VisitCache for the visit keys only: the value of a set() is not kept, a get() of a key which was set returns
+    VISITED, and delete() does nothing since keys cannot be removed from a Bloom filter.  A false positive makes a key
+    which was never set look visited, at the error rate the filter was created with.
+    """
+
+    VISITED = 'earlier in this run'
+
+    def __init__(self, bloom_filter):
+        """
+        :param bloom_filter: The SharedBloomFilter to keep the keys in, created before the worker processes are forked
+        """
+        self.bloom_filter = bloom_filter
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        if name in self.bloom_filter:
+            self.hits += 1
+            return self.VISITED
+
+        self.misses += 1
+        return None
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def prefetch(self, keys):
+        pass
+
+    def set(self, name, value, ex=None):
+        self.bloom_filter.add(name)
+        return True
+
+    def delete(self, *names):
+        pass
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups > 0 else 0.0,
+            'keys': len(self.bloom_filter)
+        }
@@ -0,0 +1,142 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('IdMap')
+
+
+class IdMap(object):
+    """
+    The map of Parse objectId -> Usergrid UUID of an import, and the pointers between entities which are connected once
+    all of the entities are saved.  Both are kept in a temporary SQLite file, with the most recently used UUIDs held in
+    memory, so that the memory used is bounded however large the export is.  The map is shared by the threads of the
+    import, so every call holds a lock.
+    """
+
+    def __init__(self, cache_size=100000, spill_dir=None, batch_size=1000):
+        """
+        :param cache_size: The number of UUIDs held in memory
+        :param spill_dir: The directory of the temporary file, the system default if not specified
+        :param batch_size: The number of UUIDs or pointers written to the file at once
+        """
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+
+        self.cache = OrderedDict()
+        self.pending_ids = {}
+        self.pending_pointers = []
+        self.count = 0
+        self.lock = threading.Lock()
+
+        handle, self.path = tempfile.mkstemp(prefix='parse-id-map-', suffix='.db', dir=spill_dir)
+        os.close(handle)
+
+        logger.info('Keeping the Parse id map at [%s]' % self.path)
+
+        # the file is temporary, so durability is traded for speed
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('CREATE TABLE ids (object_id TEXT NOT NULL PRIMARY KEY, uuid TEXT NOT NULL) '
+                                'WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE pointers (collection TEXT NOT NULL, uuid TEXT NOT NULL, '
+                                'to_object_id TEXT NOT NULL, to_collection TEXT NOT NULL)')
+
+    def cache_uuid(self, object_id, entity_uuid):
+        self.cache.pop(object_id, None)
+        self.cache[object_id] = entity_uuid
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def flush_ids(self):
+        if len(self.pending_ids) > 0:
+            self.connection.executemany('INSERT OR REPLACE INTO ids (object_id, uuid) VALUES (?, ?)',
+                                        self.pending_ids.iteritems())
+            self.connection.commit()
+            self.pending_ids = {}
+
+    def flush_pointers(self):
+        if len(self.pending_pointers) > 0:
+            self.connection.executemany('INSERT INTO pointers (collection, uuid, to_object_id, to_collection) '
+                                        'VALUES (?, ?, ?, ?)', self.pending_pointers)
+            self.connection.commit()
+            self.pending_pointers = []
+
+    def __setitem__(self, object_id, entity_uuid):
+        with self.lock:
+            self.count += 1
+            self.cache_uuid(object_id, entity_uuid)
+            self.pending_ids[object_id] = entity_uuid
+
+            if len(self.pending_ids) >= self.batch_size:
+                self.flush_ids()
+
+    def get(self, object_id, default=None):
+        with self.lock:
+            entity_uuid = self.cache.get(object_id)
+
+            if entity_uuid is None:
+                entity_uuid = self.pending_ids.get(object_id)
+
+            if entity_uuid is None:
+                row = self.connection.execute('SELECT uuid FROM ids WHERE object_id = ?', (object_id,)).fetchone()
+                entity_uuid = row[0] if row is not None else None
+
+            if entity_uuid is None:
+                return default
+
+            self.cache_uuid(object_id, entity_uuid)
+
+            return entity_uuid
+
+    def add_pointers(self, collection, entity_uuid, connections):
+        """
+        :param connections: The dict of objectId -> collection of the entities the entity points to
+        """
+        with self.lock:
+            self.pending_pointers.extend((collection, entity_uuid, to_object_id, to_collection)
+                                         for to_object_id, to_collection in connections.iteritems())
+
+            if len(self.pending_pointers) >= self.batch_size:
+                self.flush_pointers()
+
+    def iter_pointers(self):
+        """
+        :return: a generator of (collection, uuid, to_object_id, to_collection) for each pointer added, read from the
+        file a batch at a time
+        """
+        with self.lock:
+            self.flush_pointers()
+
+        last_rowid = 0
+
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT rowid, collection, uuid, to_object_id, to_collection '
+                                               'FROM pointers WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                                               (last_rowid, self.batch_size)).fetchall()
+
+            if len(rows) == 0:
+                return
+
+            for row in rows:
+                yield row[1:]
+
+            last_rowid = rows[-1][0]
+
+    def __len__(self):
+        # objectIds which are set again are counted each time
+        return self.count
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+                os.remove(self.path)
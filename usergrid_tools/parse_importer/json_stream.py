@@ -0,0 +1,137 @@
+import json
+import re
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DELIMITERS = ' \t\n\r,]}'
+
+decoder = json.JSONDecoder()
+
+
+class JsonStream(object):
+    """
+    Reads JSON values one at a time from a file, holding only the part of the file which has not been decoded yet in
+    memory rather than the whole file.
+    """
+
+    def __init__(self, f, chunk_size=1048576):
+        """
+        :param f: The file, or any object with read(), to read from
+        :param chunk_size: The number of bytes read at a time
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def read_more(self):
+        chunk = self.f.read(self.chunk_size)
+
+        if not chunk:
+            self.eof = True
+            return False
+
+        # drop what has been decoded, so that the buffer holds at most one value and a chunk
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+        return True
+
+    def skip_whitespace(self):
+        while True:
+            self.position = WHITESPACE.match(self.buffer, self.position).end()
+
+            if self.position < len(self.buffer) or not self.read_more():
+                return
+
+    def next_char(self):
+        """
+        :return: the next character which is not whitespace, or None at the end of the file, without consuming it
+        """
+        self.skip_whitespace()
+
+        return self.buffer[self.position] if self.position < len(self.buffer) else None
+
+    def expect(self, char):
+        found = self.next_char()
+
+        if found != char:
+            raise ValueError('Expected [%s] but found [%s] at position [%s] of the buffer' % (
+                char, found, self.position))
+
+        self.position += 1
+
+    def decode(self):
+        """
+        :return: the next JSON value, reading until the whole value is in the buffer
+        """
+        self.skip_whitespace()
+
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+
+                # a number cut off by the end of the buffer, such as 1. of 1.5, is decoded without error, so a number
+                # is only complete once it is followed by something which cannot continue it
+                if self.eof or not isinstance(value, (int, long, float)) or isinstance(value, bool) \
+                        or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.position = end
+                    return value
+
+            except ValueError:
+                if self.eof:
+                    raise
+
+            if not self.read_more():
+                value, self.position = decoder.raw_decode(self.buffer, self.position)
+                return value
+
+
+def iter_json_array(f, key='results', chunk_size=1048576):
+    """
+    Yields the elements of the array `key` of the JSON object in the file as they are read, such as the entities of
+    the {"results": [...]} object of a Parse export file, so that the memory used does not grow with the size of the
+    file.  The other members of the object are decoded and discarded.
+
+    :raises ValueError: when the file is not valid JSON, after yielding the elements before the error
+    """
+    stream = JsonStream(f, chunk_size)
+
+    stream.expect('{')
+
+    if stream.next_char() == '}':
+        return
+
+    while True:
+        name = stream.decode()
+        stream.expect(':')
+
+        if name != key:
+            stream.decode()
+
+        elif stream.next_char() == 'n':
+            # "results": null
+            stream.decode()
+
+        else:
+            stream.expect('[')
+
+            if stream.next_char() == ']':
+                stream.position += 1
+
+            else:
+                while True:
+                    yield stream.decode()
+
+                    if stream.next_char() == ']':
+                        stream.position += 1
+                        break
+
+                    stream.expect(',')
+
+        if stream.next_char() == '}':
+            return
+
+        stream.expect(',')
@@ -1,24 +1,35 @@
-import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
-from os import listdir
 import zipfile
-from os.path import isfile
 import sys
 import argparse
 import traceback
+from functools import partial
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from usergrid import Usergrid
 from usergrid.UsergridClient import UsergridEntity
 
+from usergrid_tools.general.http_client import get_session, log_connection_stats
+from usergrid_tools.parse_importer.id_map import IdMap
+from usergrid_tools.parse_importer.json_stream import iter_json_array
+from usergrid_tools.parse_importer.zip_export import ZipExport
+
 __author__ = 'Jeff West @ ApigeeCorporation'
 
 logger = logging.getLogger('UsergridParseImporter')
 
-parse_id_to_uuid_map = {}
-global_connections = {}
+# the Parse objectId -> Usergrid UUID of the entities saved, and the pointers between them, kept on disk
+parse_id_to_uuid_map = None
 config = {}
+pool = None
+file_pool = None
+
+# the files which are not imported as entities of a class: users and roles are imported first, the others not at all
+ROLE_JOIN_FILES = ['_Join:roles:_Role.json', '_Join:users:_Role.json']
+SKIPPED_FILES = ['_User.json', '_Role.json', '_Product.json', '_Installation.json'] + ROLE_JOIN_FILES
 
 
 def init_logging(stdout_enabled=True):
@@ -74,201 +85,199 @@ def build_usergrid_entity(collection, entity_uuid, data=None):
     return UsergridEntity(data)
 
 
-def load_users_and_roles(working_directory):
-    with open(os.path.join(working_directory, '_User.json'), 'r') as f:
-        users = json.load(f).get('results', [])
-        logger.info('Loaded [%s] Users' % len(users))
+def run_all(function, items):
+    """
+    Calls the function with each of the items, on the pool if --concurrency is more than 1.  The items are taken a
+    batch at a time so that only one batch of them is held in memory.
 
-    for i, parse_user in enumerate(users):
-        logger.info('Loading user [%s]: [%s / %s]' % (i, parse_user['username'], parse_user['objectId']))
-        usergrid_user, connections = convert_parse_entity('users', parse_user)
-        res = usergrid_user.save()
+    :return: the number of calls which returned True and the number which did not
+    """
+    items = iter(items)
+    batch_size = config.get('concurrency', 1) * 16
+    count_success = 0
+    count_failure = 0
 
-        if res.ok:
-            logger.info('Saved user [%s]: [%s / %s]' % (i, parse_user['username'], parse_user['objectId']))
+    while True:
+        batch = list(islice(items, batch_size))
 
-            if 'uuid' in usergrid_user.entity_data:
-                parse_id_to_uuid_map[parse_user['objectId']] = usergrid_user.get('uuid')
-        else:
-            logger.error(
-                    'Error saving user [%s]: [%s / %s] - %s' % (i, parse_user['username'], parse_user['objectId'], res))
+        if len(batch) == 0:
+            return count_success, count_failure
 
-    with open(os.path.join(working_directory, '_Role.json'), 'r') as f:
-        roles = json.load(f).get('results', [])
-        logger.info('Loaded [%s] Roles' % len(roles))
+        results = pool.map(function, batch) if pool is not None else map(function, batch)
 
-    for i, parse_role in enumerate(roles):
-        logger.info('Loading role [%s]: [%s / %s]' % (i, parse_role['name'], parse_role['objectId']))
-        usergrid_role, connections = convert_parse_entity('roles', parse_role)
-        res = usergrid_role.save()
+        count_success += results.count(True)
+        count_failure += len(results) - results.count(True)
 
-        if res.ok:
-            logger.info('Saved role [%s]: [%s / %s]' % (i, parse_role['name'], parse_role['objectId']))
 
-            if 'uuid' in usergrid_role.entity_data:
-                parse_id_to_uuid_map[parse_role['objectId']] = usergrid_role.get('uuid')
-
-        else:
-            logger.error(
-                    'Error saving role [%s]: [%s / %s] - %s' % (i, parse_role['name'], parse_role['objectId'], res))
+def import_file(export, file_name, function, label):
+    """
+    Calls the function with each of the results of a Parse export file as they are read from the zip, so that the
+    memory used does not grow with the size of the file.
+    """
+    if export.size(file_name) == 0:
+        logger.info('No %s to load' % label)
+        return
 
-    join_file = os.path.join(working_directory, '_Join:users:_Role.json')
+    logger.info('Loading %s from [%s]' % (label, file_name))
 
-    if os.path.isfile(join_file) and os.path.getsize(join_file) > 0:
-        with open(join_file, 'r') as f:
-            users_to_roles = json.load(f).get('results', [])
-            logger.info('Loaded [%s] User->Roles' % len(users_to_roles))
+    with export.open(file_name) as f:
+        try:
+            success, failure = run_all(function, iter_json_array(f, 'results'))
 
-            for user_to_role in users_to_roles:
-                role_id = user_to_role['owningId']
-                role_uuid = parse_id_to_uuid_map.get(role_id)
+        except (ValueError, zipfile.BadZipfile), e:
+            print traceback.format_exc(e)
+            logger.error('Unable to process file: %s' % file_name)
+            return
 
-                target_role_id = user_to_role['relatedId']
-                target_role_uuid = parse_id_to_uuid_map.get(target_role_id)
+    logger.info('Loaded [%s] %s, [%s] failed' % (success, label, failure))
 
-                if role_uuid is None or target_role_uuid is None:
-                    logger.error('Failed on assigning role [%s] to user [%s]' % (role_uuid, target_role_uuid))
-                    continue
 
-                target_role_entity = build_usergrid_entity('user', target_role_uuid)
+def import_files(export, files):
+    """
+    Imports the files at the same time, up to --file_concurrency of them, and returns once all of them are imported.
 
-                res = Usergrid.assign_role(role_uuid, target_role_entity)
+    :param files: A list of (file name, function, label) of each file, see import_file()
+    """
+    def import_one(file_args):
+        try:
+            import_file(export, *file_args)
 
-                if res.ok:
-                    logger.info('Assigned role [%s] to user [%s]' % (role_uuid, target_role_uuid))
-                else:
-                    logger.error('Failed on assigning role [%s] to user [%s]' % (role_uuid, target_role_uuid))
+        except Exception:
+            logger.exception('Error importing file [%s]' % file_args[0])
 
+    if file_pool is not None:
+        file_pool.map(import_one, files)
     else:
-        logger.info('No Users -> Roles to load')
+        map(import_one, files)
+
+
+def save_parse_entity(collection, parse_entity):
+    parse_id = parse_entity['objectId']
+    usergrid_entity, connections = convert_parse_entity(collection, parse_entity)
+    label = parse_entity.get('username') if collection == 'users' else parse_entity.get('name')
+
+    try:
+        response = usergrid_entity.save()
+
+    except Exception:
+        logger.exception('Error saving %s [%s / %s]' % (collection, label, parse_id))
+        return False
+
+    if not response.ok:
+        logger.error('Error saving %s [%s / %s] - %s' % (collection, label, parse_id, response))
+        return False
 
-    join_file = os.path.join(working_directory, '_Join:roles:_Role.json')
+    logger.info('Saved %s [%s / %s]' % (collection, label, parse_id))
 
-    if os.path.isfile(join_file) and os.path.getsize(join_file) > 0:
-        with open(join_file, 'r') as f:
-            users_to_roles = json.load(f).get('results', [])
-            logger.info('Loaded [%s] Roles->Roles' % len(users_to_roles))
+    entity_uuid = usergrid_entity.get('uuid')
 
-            for user_to_role in users_to_roles:
-                role_id = user_to_role['owningId']
-                role_uuid = parse_id_to_uuid_map.get(role_id)
+    if entity_uuid is not None:
+        parse_id_to_uuid_map[parse_id] = entity_uuid
 
-                target_role_id = user_to_role['relatedId']
-                target_role_uuid = parse_id_to_uuid_map.get(target_role_id)
+        if len(connections) > 0:
+            parse_id_to_uuid_map.add_pointers(collection, entity_uuid, connections)
 
-                if role_uuid is None or target_role_uuid is None:
-                    logger.error('Failed on assigning role [%s] to role [%s]' % (role_uuid, target_role_uuid))
-                    continue
+    return True
 
-                target_role_entity = build_usergrid_entity('role', target_role_uuid)
 
-                res = Usergrid.assign_role(role_uuid, target_role_entity)
+def assign_role(entity_type, user_to_role):
+    role_uuid = parse_id_to_uuid_map.get(user_to_role['owningId'])
+    target_role_uuid = parse_id_to_uuid_map.get(user_to_role['relatedId'])
 
-                if res.ok:
-                    logger.info('Assigned role [%s] to role [%s]' % (role_uuid, target_role_uuid))
-                else:
-                    logger.error('Failed on assigning role [%s] to role [%s]' % (role_uuid, target_role_uuid))
+    if role_uuid is None or target_role_uuid is None:
+        logger.error('Failed on assigning role [%s] to %s [%s]' % (role_uuid, entity_type, target_role_uuid))
+        return False
 
+    target_role_entity = build_usergrid_entity(entity_type, target_role_uuid)
+
+    res = Usergrid.assign_role(role_uuid, target_role_entity)
+
+    if res.ok:
+        logger.info('Assigned role [%s] to %s [%s]' % (role_uuid, entity_type, target_role_uuid))
     else:
-        logger.info('No Roles -> Roles to load')
+        logger.error('Failed on assigning role [%s] to %s [%s]' % (role_uuid, entity_type, target_role_uuid))
+
+    return res.ok
+
 
+def load_users_and_roles(export):
+    import_files(export, [('_User.json', partial(save_parse_entity, 'users'), 'Users'),
+                          ('_Role.json', partial(save_parse_entity, 'roles'), 'Roles')])
 
-def process_join_file(working_directory, join_file):
-    file_path = os.path.join(working_directory, join_file)
+    # roles are assigned once both the users and the roles are saved
+    import_files(export, [('_Join:users:_Role.json', partial(assign_role, 'user'), 'User->Roles'),
+                          ('_Join:roles:_Role.json', partial(assign_role, 'role'), 'Roles->Roles')])
 
-    logger.warn('Processing Join file: %s' % file_path)
 
+def get_join_file_import(join_file):
+    """
+    :return: the (file name, function, label) to import a _Join:<relation>:<class>.json file with, or None if the name
+    is not of that form
+    """
     parts = join_file.split(':')
 
     if len(parts) != 3:
         logger.warn('Did not find expected 3 parts in JOIN filename: %s' % join_file)
-        return
+        return None
 
     related_type = parts[1]
     owning_type = parts[2].split('.')[0]
 
     owning_type = owning_type[1:] if owning_type[0] == '_' else owning_type
 
-    with open(file_path, 'r') as f:
-        try:
-            json_data = json.load(f)
+    return join_file, partial(join_entities, owning_type, related_type), '%s->%s joins' % (owning_type, related_type)
 
-        except ValueError, e:
-            print traceback.format_exc(e)
-            logger.error('Unable to process file: %s' % file_path)
-            return
-
-        entities = json_data.get('results')
 
-        for join in entities:
-            owning_id = join.get('owningId')
-            related_id = join.get('relatedId')
+def join_entities(owning_type, related_type, join):
+    owning_entity = build_usergrid_entity(owning_type, parse_id_to_uuid_map.get(join.get('owningId')))
+    related_entity = build_usergrid_entity(related_type, parse_id_to_uuid_map.get(join.get('relatedId')))
 
-            owning_entity = build_usergrid_entity(owning_type, parse_id_to_uuid_map.get(owning_id))
-            related_entity = build_usergrid_entity(related_type, parse_id_to_uuid_map.get(related_id))
+    forward = connect_entities(owning_entity, related_entity, 'joins')
+    reverse = connect_entities(related_entity, owning_entity, 'joins')
 
-            connect_entities(owning_entity, related_entity, 'joins')
-            connect_entities(related_entity, owning_entity, 'joins')
+    return forward and reverse
 
 
-def load_entities(working_directory):
-    files = [
-        f for f in listdir(working_directory)
+def load_entities(export):
+    class_files = []
+    join_files = []
 
-        if isfile(os.path.join(working_directory, f))
-        and os.path.getsize(os.path.join(working_directory, f)) > 0
-        and f not in ['_Join:roles:_Role.json',
-                      '_Join:users:_Role.json',
-                      '_User.json',
-                      '_Product.json',
-                      '_Installation.json',
-                      '_Role.json']
-        ]
+    for data_file in export.names():
+        if data_file in SKIPPED_FILES or export.size(data_file) == 0:
+            continue
 
-    # sort to put join files last...
-    for data_file in sorted(files):
         if data_file[0:6] == '_Join:':
-            process_join_file(working_directory, data_file)
+            join_import = get_join_file_import(data_file)
+
+            if join_import is not None:
+                join_files.append(join_import)
+
             continue
 
-        file_path = os.path.join(working_directory, data_file)
         collection = data_file.split('.')[0]
 
         if collection[0] == '_':
             logger.warn('Found internal type: [%s]' % collection)
             collection = collection[1:]
 
-        if collection not in global_connections:
-            global_connections[collection] = {}
-
-        with open(file_path, 'r') as f:
+        class_files.append((data_file, partial(save_parse_entity, collection), 'entities of type [%s]' % collection))
 
-            try:
-                json_data = json.load(f)
+    import_files(export, class_files)
 
-            except ValueError, e:
-                print traceback.format_exc(e)
-                logger.error('Unable to process file: %s' % file_path)
-                continue
-
-            entities = json_data.get('results')
-
-            logger.info('Found [%s] entities of type [%s]' % (len(entities), collection))
-
-            for parse_entity in entities:
-                usergrid_entity, connections = convert_parse_entity(collection, parse_entity)
-                response = usergrid_entity.save()
-
-                global_connections[collection][usergrid_entity.get('uuid')] = connections
-
-                if response.ok:
-                    logger.info('Saved Entity: %s' % parse_entity)
-                else:
-                    logger.info('Error saving entity %s: %s' % (parse_entity, response))
+    # the joins are between entities of any of the classes, so they are imported once all of the entities are saved
+    import_files(export, join_files)
 
 
 def connect_entities(from_entity, to_entity, connection_name):
-    connect_response = from_entity.connect(connection_name, to_entity)
+    try:
+        connect_response = from_entity.connect(connection_name, to_entity)
+
+    except ValueError, e:
+        # an entity which was not saved has no UUID
+        logger.error('Unable to connect [%s / %s]--[%s]-->[%s / %s]: %s' % (
+            from_entity.get('type'), from_entity.get('uuid'), connection_name, to_entity.get('type'),
+            to_entity.get('uuid'), e))
+        return False
 
     if connect_response.ok:
         logger.info('Successfully connected [%s / %s]--[%s]-->[%s / %s]' % (
@@ -279,18 +288,24 @@ def connect_entities(from_entity, to_entity, connection_name):
             from_entity.get('type'), from_entity.get('uuid'), connection_name, to_entity.get('type'),
             to_entity.get('uuid'), connect_response))
 
+    return connect_response.ok
 
-def create_connections():
-    for from_collection, entity_map in global_connections.iteritems():
 
-        for from_entity_uuid, entity_connections in entity_map.iteritems():
-            from_entity = build_usergrid_entity(from_collection, from_entity_uuid)
+def connect_pointer(pointer):
+    from_collection, from_entity_uuid, to_entity_id, to_entity_collection = pointer
+
+    from_entity = build_usergrid_entity(from_collection, from_entity_uuid)
+    to_entity = build_usergrid_entity(to_entity_collection, parse_id_to_uuid_map.get(to_entity_id))
+
+    forward = connect_entities(from_entity, to_entity, 'pointers')
+    reverse = connect_entities(to_entity, from_entity, 'pointers')
+
+    return forward and reverse
 
-            for to_entity_id, to_entity_collection in entity_connections.iteritems():
-                to_entity = build_usergrid_entity(to_entity_collection, parse_id_to_uuid_map.get(to_entity_id))
 
-                connect_entities(from_entity, to_entity, 'pointers')
-                connect_entities(to_entity, from_entity, 'pointers')
+def create_connections():
+    success, failure = run_all(connect_pointer, parse_id_to_uuid_map.iter_pointers())
+    logger.info('Connected [%s] pointers, [%s] failed' % (success, failure))
 
 
 def parse_args():
@@ -317,8 +332,9 @@ def parse_args():
                         type=str)
 
     parser.add_argument('--tmp_dir',
-                        help='Directory where data file will be unzipped',
-                        required=True,
+                        help='Directory of the temporary file of the Parse objectId -> UUID map, the system temporary '
+                             'directory if not specified',
+                        required=False,
                         type=str)
 
     parser.add_argument('--client_id',
@@ -331,13 +347,30 @@ def parse_args():
                         required=False,
                         type=str)
 
+    parser.add_argument('--concurrency',
+                        help='The number of entities, roles and connections to save at once',
+                        type=int,
+                        default=8)
+
+    parser.add_argument('--file_concurrency',
+                        help='The number of files of the export to import at once, where the order of the files '
+                             'allows it',
+                        type=int,
+                        default=4)
+
+    parser.add_argument('--id_map_cache_size',
+                        help='The number of Parse objectId -> UUID mappings held in memory, the rest are kept in a '
+                             'temporary file in --tmp_dir',
+                        type=int,
+                        default=100000)
+
     my_args = parser.parse_args(sys.argv[1:])
 
     return vars(my_args)
 
 
 def main():
-    global config
+    global config, parse_id_to_uuid_map, pool, file_pool
     config = parse_args()
 
     init_logging()
@@ -348,6 +381,11 @@ def main():
                   client_id=config.get('client_id'),
                   client_secret=config.get('client_secret'))
 
+    # the client's session keeps too few connections open for the pool, the headers hold its access token
+    session = get_session(pool_size=config.get('concurrency'))
+    session.headers.update(Usergrid.client.session.headers)
+    Usergrid.client.session = session
+
     tmp_dir = config.get('tmp_dir')
     file_path = config.get('file')
 
@@ -356,29 +394,44 @@ def main():
         logger.critical('Unable to continue')
         exit(1)
 
-    if not os.path.isdir(tmp_dir):
+    if tmp_dir is not None and not os.path.isdir(tmp_dir):
         logger.critical('Temp Directory path specified [%s] is not a directory!' % tmp_dir)
         logger.critical('Unable to continue')
         exit(1)
 
-    file_name = os.path.basename(file_path).split('.')[0]
-    working_directory = os.path.join(tmp_dir, file_name)
-
     try:
-        with zipfile.ZipFile(file_path, 'r') as z:
-            logger.warn('Extracting files to directory: %s' % working_directory)
-            z.extractall(working_directory)
-            logger.warn('Extraction complete')
+        export = ZipExport(file_path)
 
     except Exception, e:
         logger.critical(traceback.format_exc(e))
-        logger.critical('Extraction failed')
+        logger.critical('Unable to read zip file [%s]' % file_path)
         logger.critical('Unable to continue')
         exit(1)
 
-    load_users_and_roles(working_directory)
-    load_entities(working_directory)
-    create_connections()
+    logger.info('Importing [%s] files from [%s]' % (len(export.names()), file_path))
+
+    parse_id_to_uuid_map = IdMap(cache_size=config.get('id_map_cache_size'), spill_dir=tmp_dir)
+
+    if config.get('concurrency') > 1:
+        pool = ThreadPool(processes=config.get('concurrency'))
+
+    if config.get('file_concurrency') > 1:
+        file_pool = ThreadPool(processes=config.get('file_concurrency'))
+
+    try:
+        load_users_and_roles(export)
+        load_entities(export)
+        create_connections()
+
+    finally:
+        for thread_pool in [file_pool, pool]:
+            if thread_pool is not None:
+                thread_pool.close()
+                thread_pool.join()
+
+        export.close()
+        parse_id_to_uuid_map.close()
+        log_connection_stats('target', session, logger)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,48 @@
+import logging
+import posixpath
+import zipfile
+
+__author__ = 'Jeff West @ ApigeeCorporation'
+
+logger = logging.getLogger('ZipExport')
+
+
+class ZipExport(object):
+    """
+    The files of a Parse export, read straight out of the zip file as they are imported instead of being extracted to
+    disk first.  Files are looked up by name wherever they are in the zip, and each file is read through its own file
+    handle so that several can be read at once.
+    """
+
+    def __init__(self, path):
+        self.zip_file = zipfile.ZipFile(path, 'r')
+        self.members = {}
+
+        for info in self.zip_file.infolist():
+            name = posixpath.basename(info.filename)
+
+            # directories, and the resource forks of zips made on a Mac
+            if not name or name.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+
+            if name in self.members:
+                logger.warning('Found [%s] more than once in the export, using [%s]' % (name, info.filename))
+
+            self.members[name] = info
+
+    def names(self):
+        return sorted(self.members.keys())
+
+    def size(self, name):
+        """
+        :return: the uncompressed size of the file, 0 if it is not in the export
+        """
+        info = self.members.get(name)
+
+        return info.file_size if info is not None else 0
+
+    def open(self, name):
+        return self.zip_file.open(self.members[name], 'r')
+
+    def close(self):
+        self.zip_file.close()